@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import sys
+from io import StringIO
+from os import path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from openmm import __version__ as openmm_version
+from openmm.unit import angstroms
+from pdbfixer import PDBFixer
+
+from phases.structure_preparer import _create_PDBFixer_template, _get_CCD_store
+
+# records in the format of components.cif, NH2 has bonds and leaving atom, ZN has no category chem_comp_bond
+CCD_TEMPLATES = """data_NH2
+#
+_chem_comp.id                                    NH2
+_chem_comp.name                                  "AMINO GROUP"
+_chem_comp.type                                  NON-POLYMER
+_chem_comp.pdbx_type                             ATOMN
+_chem_comp.formula                               "H2 N"
+_chem_comp.formula_weight                        16.023
+_chem_comp.three_letter_code                     NH2
+#
+loop_
+_chem_comp_atom.comp_id
+_chem_comp_atom.atom_id
+_chem_comp_atom.alt_atom_id
+_chem_comp_atom.type_symbol
+_chem_comp_atom.charge
+_chem_comp_atom.pdbx_align
+_chem_comp_atom.pdbx_aromatic_flag
+_chem_comp_atom.pdbx_leaving_atom_flag
+_chem_comp_atom.pdbx_stereo_config
+_chem_comp_atom.model_Cartn_x
+_chem_comp_atom.model_Cartn_y
+_chem_comp_atom.model_Cartn_z
+_chem_comp_atom.pdbx_model_Cartn_x_ideal
+_chem_comp_atom.pdbx_model_Cartn_y_ideal
+_chem_comp_atom.pdbx_model_Cartn_z_ideal
+_chem_comp_atom.pdbx_component_atom_id
+_chem_comp_atom.pdbx_component_comp_id
+_chem_comp_atom.pdbx_ordinal
+NH2 N   N   N 0 1 N N N 11.068 3.823 10.046 0.000  0.000 0.000 N   NH2 1
+NH2 HN1 1HN H 0 1 N N N 11.435 4.735 9.725  -0.334 0.943 0.000 HN1 NH2 2
+NH2 HN2 2HN H 0 1 N Y N 11.699 3.088 9.754  -0.334 -0.471 -0.816 HN2 NH2 3
+#
+loop_
+_chem_comp_bond.comp_id
+_chem_comp_bond.atom_id_1
+_chem_comp_bond.atom_id_2
+_chem_comp_bond.value_order
+_chem_comp_bond.pdbx_aromatic_flag
+_chem_comp_bond.pdbx_stereo_config
+_chem_comp_bond.pdbx_ordinal
+NH2 N HN1 SING N N 1
+NH2 N HN2 SING N N 2
+#
+data_ZN
+#
+_chem_comp.id                                    ZN
+_chem_comp.name                                  "ZINC ION"
+_chem_comp.type                                  NON-POLYMER
+_chem_comp.pdbx_type                             HETAI
+_chem_comp.formula                               Zn
+_chem_comp.formula_charge                        2
+_chem_comp.three_letter_code                     ZN
+#
+_chem_comp_atom.comp_id                          ZN
+_chem_comp_atom.atom_id                          ZN
+_chem_comp_atom.alt_atom_id                      ZN
+_chem_comp_atom.type_symbol                      ZN
+_chem_comp_atom.charge                           2
+_chem_comp_atom.pdbx_align                       0
+_chem_comp_atom.pdbx_aromatic_flag               N
+_chem_comp_atom.pdbx_leaving_atom_flag           N
+_chem_comp_atom.pdbx_stereo_config               N
+_chem_comp_atom.model_Cartn_x                    0.000
+_chem_comp_atom.model_Cartn_y                    0.000
+_chem_comp_atom.model_Cartn_z                    0.000
+_chem_comp_atom.pdbx_model_Cartn_x_ideal         0.000
+_chem_comp_atom.pdbx_model_Cartn_y_ideal         0.000
+_chem_comp_atom.pdbx_model_Cartn_z_ideal         0.000
+_chem_comp_atom.pdbx_component_atom_id           ZN
+_chem_comp_atom.pdbx_component_comp_id           ZN
+_chem_comp_atom.pdbx_ordinal                     1
+#
+"""
+
+# structure loaded by PDBFixer, which registers the templates
+PDB_BLOCK = "HETATM    1 ZN    ZN A   1       0.000   0.000   0.000  1.00  0.00          ZN  \nEND\n"
+
+# expected templates, tuples (residue name, [(atom name, element symbol, leaving atom flag, ideal coordinates in angstroms)], bonds)
+EXPECTED_TEMPLATES = [("NH2",
+                       [("N", "N", False, (0.0, 0.0, 0.0)),
+                        ("HN1", "H", False, (-0.334, 0.943, 0.0)),
+                        ("HN2", "H", True, (-0.334, -0.471, -0.816))],
+                       {("N", "HN1"), ("N", "HN2")}),
+                      ("ZN",
+                       [("ZN", "Zn", False, (0.0, 0.0, 0.0))],
+                       set())]
+
+
+def check_template(CCD_mmCIF_record: str,
+                   expected_template: tuple):
+    """
+    :return: list of differences of the template created from the record from the expected template
+    """
+    expected_name, expected_atoms, expected_bonds = expected_template
+    topology, positions, terminal = _create_PDBFixer_template(CCD_mmCIF_record)
+    residue = next(topology.residues())
+    atoms = [(atom.name, atom.element.symbol if atom.element else None, leaving, tuple(round(coordinate, 3) for coordinate in position))
+             for atom, leaving, position in zip(topology.atoms(), terminal, positions.value_in_unit(angstroms))]
+    bonds = {(atom_1.name, atom_2.name) for atom_1, atom_2 in topology.bonds()}
+    differences = []
+    if residue.name != expected_name:
+        differences.append(f"residue name {residue.name}, expected {expected_name}")
+    if atoms != expected_atoms:
+        differences.append(f"atoms {atoms}, expected {expected_atoms}")
+    if bonds != expected_bonds:
+        differences.append(f"bonds {bonds}, expected {expected_bonds}")
+    # PDBFixer must accept the template
+    fixer = PDBFixer(pdbfile=StringIO(PDB_BLOCK))
+    try:
+        fixer.registerTemplate(topology, positions, terminal)
+    except ValueError as error:
+        differences.append(f"PDBFixer refused the template: {error}")
+    return differences
+
+
+if __name__ == "__main__":
+    print(f"\nChecking PDBFixer templates created from CCD in mmCIF format (openmm {openmm_version})... ", end="")
+    failures = []
+    with TemporaryDirectory() as directory:
+        CCD_templates_file = f"{directory}/components.cif"
+        with open(CCD_templates_file, "w") as templates_file:
+            templates_file.write(CCD_TEMPLATES)
+        CCD_store = _get_CCD_store(CCD_templates_file)
+        for expected_template in EXPECTED_TEMPLATES:
+            CCD_mmCIF_record = CCD_store.get(expected_template[0])
+            if CCD_mmCIF_record is None:
+                failures.append(f"{expected_template[0]}: record not found in CCD")
+                continue
+            failures.extend(f"{expected_template[0]}: {difference}" for difference in check_template(CCD_mmCIF_record, expected_template))
+        if CCD_store.get("XXX") is not None:
+            failures.append("XXX: record of component missing in CCD was found")
+    if failures:
+        exit("\nERROR! Templates differ from the expected ones:\n" + "\n".join(failures) + "\n")
+    print("ok")
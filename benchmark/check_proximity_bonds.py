@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from os import listdir, path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import numpy as np
+from rdkit import Chem
+
+from phases.bonds import find_proximity_bonds
+
+REPOSITORY_DIRECTORY = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def load_arguments():
+    print("\nParsing arguments... ",
+          end="")
+    parser = argparse.ArgumentParser(description="Compares bonds found by phases/bonds.py with the proximity bonds of RDKit "
+                                                 "(Chem.MolFromPDBBlock without CONECT records) on the first models of structures from directory examples.")
+    parser.add_argument("--examples",
+                        help="Names of structures from directory examples to be checked (e.g. 1a6b 1tqn). All structures by default.",
+                        type=str,
+                        nargs="+")
+    args = parser.parse_args()
+    if args.examples is None:
+        args.examples = sorted(file[:-4] for file in listdir(f"{REPOSITORY_DIRECTORY}/examples") if file.endswith(".pdb"))
+    print("ok")
+    return args
+
+
+def first_model_block(PDB_file: str):
+    """
+    :return: PDB block with atoms of the first model without CONECT records, so RDKit finds all bonds by proximity
+    """
+    lines = []
+    with open(PDB_file) as PDB_file_handle:
+        for line in PDB_file_handle:
+            if line.startswith(("ATOM", "HETATM")):
+                lines.append(line)
+            elif line.startswith("ENDMDL"):
+                break
+    return "".join(lines) + "END\n"
+
+
+def compare_bonds(PDB_file: str):
+    """
+    :return: number of atoms, number of RDKit bonds, bonds found only by RDKit and bonds found only by find_proximity_bonds
+    """
+    molecule = Chem.MolFromPDBBlock(first_model_block(PDB_file),
+                                    removeHs=False,
+                                    sanitize=False)
+    atoms = list(molecule.GetAtoms())
+    residue_infos = [atom.GetPDBResidueInfo() for atom in atoms]
+    bonds = find_proximity_bonds(elements=[atom.GetSymbol() for atom in atoms],
+                                 coords=molecule.GetConformer().GetPositions(),
+                                 residue_keys=[(info.GetChainId(), info.GetResidueNumber(), info.GetInsertionCode(), info.GetResidueName())
+                                               for info in residue_infos],
+                                 residue_names=[info.GetResidueName().strip() for info in residue_infos])
+    RDKit_bonds = {tuple(sorted((bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()))) for bond in molecule.GetBonds()}
+    found_bonds = {tuple(bond) for bond in bonds.tolist()}
+    return len(atoms), len(RDKit_bonds), sorted(RDKit_bonds - found_bonds), sorted(found_bonds - RDKit_bonds)
+
+
+if __name__ == "__main__":
+    args = load_arguments()
+    differing_examples = []
+    for example in args.examples:
+        atoms_count, RDKit_bonds_count, only_RDKit_bonds, only_found_bonds = compare_bonds(f"{REPOSITORY_DIRECTORY}/examples/{example}.pdb")
+        print(f"{example}: {atoms_count} atoms, {RDKit_bonds_count} bonds of RDKit, "
+              f"{len(only_RDKit_bonds)} missing, {len(only_found_bonds)} extra")
+        if only_RDKit_bonds or only_found_bonds:
+            differing_examples.append(example)
+            print(f"  missing {only_RDKit_bonds[:10]}, extra {only_found_bonds[:10]}")
+    if differing_examples:
+        exit(f"\nERROR! Bonds differ from RDKit for: {' '.join(differing_examples)}\n")
+    print("\nBonds are the same as the proximity bonds of RDKit.")
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime
+from os import environ, listdir, makedirs, path, pathsep, wait4, waitstatus_to_exitcode, walk
+from platform import node
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import numpy as np
+
+REPOSITORY_DIRECTORY = path.dirname(path.dirname(path.abspath(__file__)))
+BENCHMARK_DIRECTORY = f"{REPOSITORY_DIRECTORY}/benchmark"
+
+# phases of the workflow, the name of each phase is the category of its spans in trace.json (see phases/tracer.py)
+# and the name of its data directory
+PHASES = ["structure_preparer", "hydrogen_optimiser", "charge_calculator"]
+
+# differences smaller than these are considered to be noise and are never reported as regressions
+MIN_TIME_DIFFERENCE = 1 # seconds
+MIN_MEMORY_DIFFERENCE = 50 * 1024 ** 2 # bytes
+
+
+def load_arguments():
+    print("\nParsing arguments... ",
+          end="")
+    parser = argparse.ArgumentParser(description="Benchmarks the workflow on the structures from directory examples. "
+                                                 "Each structure is calculated by calculate_charges_workflow.py in its own process "
+                                                 "and wall times of phases, numbers of xtb jobs, peak resident memory, "
+                                                 "bytes retained in data directories of phases and deviations of charges from the reference charges are recorded. "
+                                                 "With --fragment_core_radius, the deviations of charges of fragments from the per-atom reference charges are recorded. "
+                                                 "Results are appended to the history file and compared with the last comparable run "
+                                                 "(same host, workers, xtb and arguments of the workflow). "
+                                                 "Unknown arguments are passed to the workflow.")
+    parser.add_argument("--CCD_file",
+                        help="SDF file (components-pub.sdf) or mmCIF file (components.cif) with Chemical Component Dictionary.",
+                        type=str,
+                        required=True)
+    parser.add_argument("--examples",
+                        help="Names of structures from directory examples to be benchmarked (e.g. 1a6b 1tqn). All structures by default.",
+                        type=str,
+                        nargs="+")
+    parser.add_argument("--workers",
+                        help="Number of worker processes of the workflow.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--fake_xtb",
+                        help="Replace xtb by the stand-in from benchmark/fake_xtb, which returns immediately, "
+                             "so only the overhead of the workflow outside of quantum chemistry is measured. "
+                             "Charges are then compared with the references from benchmark/references_fake_xtb.",
+                        action="store_true")
+    parser.add_argument("--references_dir",
+                        help="Directory with reference charges, <name of structure>/charges.txt. "
+                             "Default is benchmark/references, or benchmark/references_fake_xtb with --fake_xtb.",
+                        type=str)
+    parser.add_argument("--update_references",
+                        help="Store calculated charges as the new reference charges.",
+                        action="store_true")
+    parser.add_argument("--fragment_core_radius",
+                        help="Fragment core radius of the workflow (see calculate_charges_workflow.py). "
+                             "With a radius above 0, charges are compared with the reference charges calculated per atom "
+                             "and their deviation is recorded as the deviation of fragments. It is reported as regression "
+                             "if it increases by more than --charges_tolerance against the last comparable run. "
+                             "References cannot be updated with a radius above 0 and the deviation is not recorded with --fake_xtb.",
+                        type=float,
+                        default=0)
+    parser.add_argument("--history_file",
+                        help="File to which one json record of the benchmark is appended per run.",
+                        type=str,
+                        default=f"{BENCHMARK_DIRECTORY}/history.jsonl")
+    parser.add_argument("--work_dir",
+                        help="Directory for data directories of benchmarked structures. "
+                             "Temporary directory removed after the benchmark by default (kept if the workflow failed).",
+                        type=str)
+    parser.add_argument("--time_tolerance",
+                        help="Relative increase of wall time of structure or phase which is reported as regression.",
+                        type=float,
+                        default=0.2)
+    parser.add_argument("--memory_tolerance",
+                        help="Relative increase of peak resident memory which is reported as regression.",
+                        type=float,
+                        default=0.2)
+    parser.add_argument("--charges_tolerance",
+                        help="Maximal absolute deviation of charges from the reference charges which is not reported as regression.",
+                        type=float,
+                        default=0.001)
+    args, args.workflow_arguments = parser.parse_known_args()
+    if not path.isfile(args.CCD_file):
+        exit(f"\nERROR! File {args.CCD_file} does not exist!\n")
+    available_examples = sorted(file[:-4] for file in listdir(f"{REPOSITORY_DIRECTORY}/examples") if file.endswith(".pdb"))
+    if args.examples is None:
+        args.examples = available_examples
+    for example in args.examples:
+        if example not in available_examples:
+            exit(f"\nERROR! Structure {example} is not in directory examples!\n")
+    if args.fragment_core_radius < 0:
+        exit(f"\nERROR! Fragment core radius must be non-negative!\n")
+    if args.fragment_core_radius and args.update_references:
+        exit(f"\nERROR! Reference charges must be calculated per atom, --update_references cannot be used with --fragment_core_radius!\n")
+    if args.references_dir is None:
+        args.references_dir = f"{BENCHMARK_DIRECTORY}/references{'_fake_xtb' if args.fake_xtb else ''}"
+    if args.work_dir is not None and path.exists(args.work_dir) and listdir(args.work_dir):
+        exit(f"\nError! Directory with name {args.work_dir} exists and is not empty. "
+             f"Remove existed directory or change --work_dir argument!\n")
+    print("ok")
+    return args
+
+
+def directory_size(directory: str):
+    """
+    :return: sum of sizes of all files in the directory and its subdirectories in bytes
+    """
+    return sum(path.getsize(f"{root}/{file}") for root, _, files in walk(directory) for file in files)
+
+
+def read_charges(charges_file: str):
+    """
+    :return: array of charges from charges.txt written by the charge calculator, nan for atoms without charge
+    """
+    with open(charges_file) as charges_file_handle:
+        return np.array([float(charge) if charge != "None" else np.nan for charge in charges_file_handle.read().split()])
+
+
+def charges_deviation(charges: np.ndarray,
+                      reference_charges: np.ndarray):
+    """
+    :return: maximal and root mean square deviation of charges of atoms charged in both arrays
+             and the number of atoms charged in only one of them
+    """
+    if len(charges) != len(reference_charges):
+        return {"error": f"{len(charges)} atoms charged, reference has {len(reference_charges)} atoms"}
+    charged = ~np.isnan(charges) & ~np.isnan(reference_charges)
+    deviations = np.abs(charges[charged] - reference_charges[charged])
+    return {"max": float(deviations.max()) if len(deviations) else 0.0,
+            "rms": float(np.sqrt(np.mean(deviations ** 2))) if len(deviations) else 0.0,
+            "uncharged_atoms": int(np.isnan(charges).sum()),
+            "mismatched_atoms": int((np.isnan(charges) != np.isnan(reference_charges)).sum())}
+
+
+def run_workflow(example: str,
+                 data_dir: str,
+                 args: argparse.Namespace):
+    """
+    Runs calculate_charges_workflow.py with tracing and collects the measurements of the run.
+
+    :return: dictionary with measurements of the run of the workflow
+    """
+    command = [sys.executable, f"{REPOSITORY_DIRECTORY}/calculate_charges_workflow.py",
+               "--PDB_file", f"{REPOSITORY_DIRECTORY}/examples/{example}.pdb",
+               "--data_dir", data_dir,
+               "--CCD_file", args.CCD_file,
+               "--workers", str(args.workers),
+               "--fragment_core_radius", str(args.fragment_core_radius),
+               "--trace"] + args.workflow_arguments
+    environment = dict(environ)
+    if args.fake_xtb:
+        environment["PATH"] = f"{BENCHMARK_DIRECTORY}/fake_xtb{pathsep}{environment['PATH']}"
+    start = time()
+    with open(f"{data_dir}.log", "w") as log_file:
+        process = subprocess.Popen(command,
+                                   stdout=log_file,
+                                   stderr=subprocess.STDOUT,
+                                   env=environment)
+        # resource usage of the workflow includes its terminated and waited-for descendants (workers and xtb processes),
+        # CPU time is their sum, but ru_maxrss is the peak RSS of the largest single process among them, not the sum of their peaks
+        _, status, resource_usage = wait4(process.pid, 0)
+        process.returncode = waitstatus_to_exitcode(status)
+    measurements = {"exit_code": process.returncode,
+                    "wall_time": time() - start,
+                    "cpu_time": resource_usage.ru_utime + resource_usage.ru_stime,
+                    "peak_rss_bytes": resource_usage.ru_maxrss * 1024}
+    trace_file = f"{data_dir}/results_{example}/trace.json"
+    if process.returncode or not path.isfile(trace_file):
+        measurements["error"] = f"workflow failed, see {data_dir}.log"
+        return measurements
+
+    phases_times = defaultdict(float)
+    xtb_jobs = defaultdict(lambda: defaultdict(int))
+    scratch_bytes = defaultdict(int)
+    with open(trace_file) as trace_file_handle:
+        for event in json.load(trace_file_handle)["traceEvents"]:
+            if event["ph"] != "X":
+                continue
+            if event["tid"] == 0:
+                phases_times[event["cat"]] += event["dur"] / 1e6
+            elif event["tid"] == 1:
+                xtb_jobs[event["cat"]][event["args"]["status"]] += 1
+            else:
+                scratch_bytes[event["cat"]] += event["args"]["scratch_bytes"]
+    # scratch bytes are the estimated bytes written by the xtb jobs of the phase (reserved by ScratchManager, cached jobs are not run),
+    # retained bytes are the size of files left in the data directory of the phase after the run,
+    # files of xtb jobs removed by --delete_auxiliary_files or written into --scratch_dir are not included
+    measurements["phases"] = {phase: {"wall_time": phases_times[phase],
+                                      "xtb_jobs": dict(xtb_jobs[phase]),
+                                      "scratch_bytes": scratch_bytes[phase],
+                                      "retained_bytes": directory_size(f"{data_dir}/{phase}")}
+                              for phase in PHASES}
+    measurements["charges"] = read_charges(f"{data_dir}/charge_calculator/charges.txt")
+    return measurements
+
+
+def find_regressions(record: dict,
+                     previous_record: dict,
+                     args: argparse.Namespace):
+    """
+    :return: list of descriptions of regressions of the record against the previous record and the reference charges
+    """
+    regressions = []
+
+    def compare(name: str,
+                value: float,
+                previous_value: float,
+                tolerance: float,
+                min_difference: float,
+                unit: str):
+        if previous_value and value > previous_value * (1 + tolerance) and value - previous_value > min_difference:
+            regressions.append(f"{name} increased from {previous_value:.1f} {unit} to {value:.1f} {unit}")
+
+    for example, measurements in record["examples"].items():
+        if "error" in measurements:
+            regressions.append(f"{example}: {measurements['error']}")
+            continue
+        deviation = measurements.get("charges_deviation")
+        if deviation and "error" in deviation:
+            regressions.append(f"{example}: {deviation['error']}")
+        elif deviation and (deviation["max"] > args.charges_tolerance or deviation["mismatched_atoms"]):
+            regressions.append(f"{example}: charges deviate from the reference charges by {deviation['max']:.4f} at most, "
+                               f"{deviation['mismatched_atoms']} atoms charged only in one of them")
+        previous_measurements = previous_record["examples"].get(example) if previous_record else None
+        # charges of fragments deviate from the per-atom references by design, only the increase of the deviation is a regression
+        fragments_deviation = measurements.get("fragments_deviation")
+        previous_fragments_deviation = previous_measurements.get("fragments_deviation") if previous_measurements else None
+        if fragments_deviation and "error" in fragments_deviation:
+            regressions.append(f"{example}: {fragments_deviation['error']}")
+        elif fragments_deviation and fragments_deviation["mismatched_atoms"]:
+            regressions.append(f"{example}: {fragments_deviation['mismatched_atoms']} atoms charged only in fragments or only in the reference")
+        elif fragments_deviation and previous_fragments_deviation and "error" not in previous_fragments_deviation \
+                and fragments_deviation["max"] > previous_fragments_deviation["max"] + args.charges_tolerance:
+            regressions.append(f"{example}: charges of fragments deviate from the per-atom reference charges by {fragments_deviation['max']:.4f} at most, "
+                               f"previously by {previous_fragments_deviation['max']:.4f}")
+        if not previous_measurements or "error" in previous_measurements:
+            continue
+        compare(f"{example}: wall time", measurements["wall_time"], previous_measurements["wall_time"],
+                args.time_tolerance, MIN_TIME_DIFFERENCE, "s")
+        compare(f"{example}: peak resident memory", measurements["peak_rss_bytes"] / 1024 ** 2, previous_measurements["peak_rss_bytes"] / 1024 ** 2,
+                args.memory_tolerance, MIN_MEMORY_DIFFERENCE / 1024 ** 2, "MB")
+        for phase in PHASES:
+            phase_measurements = measurements["phases"][phase]
+            previous_phase_measurements = previous_measurements["phases"][phase]
+            compare(f"{example}: wall time of {phase}", phase_measurements["wall_time"], previous_phase_measurements["wall_time"],
+                    args.time_tolerance, MIN_TIME_DIFFERENCE, "s")
+            xtb_jobs_count = sum(count for status, count in phase_measurements["xtb_jobs"].items() if status != "cached")
+            previous_xtb_jobs_count = sum(count for status, count in previous_phase_measurements["xtb_jobs"].items() if status != "cached")
+            if xtb_jobs_count > previous_xtb_jobs_count:
+                regressions.append(f"{example}: number of xtb jobs of {phase} increased from {previous_xtb_jobs_count} to {xtb_jobs_count}")
+    return regressions
+
+
+def read_previous_record(history_file: str,
+                         record: dict):
+    """
+    :return: the last record of the history with the same host, workers, xtb, fragment core radius and arguments of the workflow or None
+    """
+    if not path.isfile(history_file):
+        return None
+    previous_record = None
+    with open(history_file) as history_file_handle:
+        for line in history_file_handle:
+            history_record = json.loads(line)
+            if all(history_record.get(key) == record[key] for key in ("host", "workers", "fake_xtb", "fragment_core_radius", "workflow_arguments")):
+                previous_record = history_record
+    return previous_record
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", REPOSITORY_DIRECTORY, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = load_arguments()
+    work_dir = path.abspath(args.work_dir or mkdtemp(prefix="pdbcharges_benchmark_"))
+    makedirs(work_dir, exist_ok=True)
+    record = {"date": datetime.now().isoformat(timespec="seconds"),
+              "commit": git_commit(),
+              "host": node(),
+              "workers": args.workers,
+              "fake_xtb": args.fake_xtb,
+              "fragment_core_radius": args.fragment_core_radius,
+              "workflow_arguments": args.workflow_arguments,
+              "examples": {}}
+    for example_i, example in enumerate(args.examples, start=1):
+        print(f"Benchmarking {example} ({example_i}/{len(args.examples)})... ", end="", flush=True)
+        data_dir = f"{work_dir}/{example}"
+        measurements = run_workflow(example, data_dir, args)
+        if "error" not in measurements:
+            charges = measurements.pop("charges")
+            reference_charges_file = f"{args.references_dir}/{example}/charges.txt"
+            deviation_key = "fragments_deviation" if args.fragment_core_radius else "charges_deviation"
+            if args.fragment_core_radius and args.fake_xtb:
+                pass # charges of the stand-in of xtb depend only on the total charge of the substructure, deviation of fragments is meaningless
+            elif path.isfile(reference_charges_file):
+                measurements[deviation_key] = charges_deviation(charges, read_charges(reference_charges_file))
+            # structures without reference charges are reported as "no reference" in the table, not as regressions
+            if args.update_references:
+                subprocess.run(["mkdir", "-p", f"{args.references_dir}/{example}"], check=True)
+                subprocess.run(["cp", f"{data_dir}/charge_calculator/charges.txt", reference_charges_file], check=True)
+        record["examples"][example] = measurements
+        print(f"{measurements['wall_time']:.1f} s" if "error" not in measurements else measurements["error"])
+
+    previous_record = read_previous_record(args.history_file, record)
+    regressions = find_regressions(record, previous_record, args)
+    with open(args.history_file, "a") as history_file:
+        history_file.write(json.dumps(record) + "\n")
+
+    if args.fragment_core_radius:
+        print(f"\nDeviations are the deviations of charges of fragments with core radius {args.fragment_core_radius} A from the per-atom reference charges.")
+    print(f"\n{'structure':<12}{'wall [s]':>10}{'preparer [s]':>14}{'optimiser [s]':>15}{'charges [s]':>13}"
+          f"{'xtb jobs':>10}{'peak RSS [MB]':>15}{'scratch [MB]':>14}{'retained [MB]':>15}{'max dev':>10}{'RMS dev':>10}")
+    for example, measurements in record["examples"].items():
+        if "error" in measurements:
+            print(f"{example:<12}{measurements['error']}")
+            continue
+        phases = measurements["phases"]
+        deviation = measurements.get("fragments_deviation" if args.fragment_core_radius else "charges_deviation")
+        if deviation is None:
+            deviation_columns = f"{'not measured' if args.fragment_core_radius and args.fake_xtb else 'no reference':>20}"
+        elif "error" in deviation:
+            deviation_columns = f"  {deviation['error']}"
+        else:
+            deviation_columns = f"{deviation['max']:>10.4f}{deviation['rms']:>10.4f}"
+        print(f"{example:<12}{measurements['wall_time']:>10.1f}"
+              f"{phases['structure_preparer']['wall_time']:>14.1f}{phases['hydrogen_optimiser']['wall_time']:>15.1f}{phases['charge_calculator']['wall_time']:>13.1f}"
+              f"{sum(count for phase in PHASES for status, count in phases[phase]['xtb_jobs'].items() if status != 'cached'):>10}"
+              f"{measurements['peak_rss_bytes'] / 1024 ** 2:>15.0f}{sum(phases[phase]['scratch_bytes'] for phase in PHASES) / 1024 ** 2:>14.1f}"
+              f"{sum(phases[phase]['retained_bytes'] for phase in PHASES) / 1024 ** 2:>15.1f}{deviation_columns}")
+    print(f"\nResults appended to {args.history_file}, "
+          f"{'compared with the run of ' + previous_record['date'] if previous_record else 'no previous comparable run'}.")
+    if args.work_dir is None and all("error" not in measurements for measurements in record["examples"].values()):
+        rmtree(work_dir)
+    else:
+        print(f"Data directories and logs of workflow are kept in {work_dir}.")
+    if regressions:
+        print(f"\n{len(regressions)} regressions found:")
+        for regression in regressions:
+            print(f"  {regression}")
+        exit(1)
+    print("No regression found.")
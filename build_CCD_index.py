@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import argparse
+from os import path
+
+from phases.ccd_store import CCDStore
+
+
+def load_arguments():
+    print("\nParsing arguments... ",
+          end="")
+    parser = argparse.ArgumentParser(description="Builds offset index of Chemical Component Dictionary. "
+                                                 "The index is stored next to the CCD file and it is used by the workflow "
+                                                 "to read only the needed components. Without the index, the workflow "
+                                                 "builds it itself by streaming the CCD file at the first use.")
+    parser.add_argument("--CCD_file",
+                        help="SDF file (components-pub.sdf) or mmCIF file (components.cif) with Chemical Component Dictionary.",
+                        type=str,
+                        required=True)
+    args = parser.parse_args()
+    if not path.isfile(args.CCD_file):
+        exit(f"\nERROR! File {args.CCD_file} does not exist!\n")
+    print("ok")
+    return args
+
+
+if __name__ == "__main__":
+    args = load_arguments()
+    print("Indexing CCD file... ", end="")
+    CCD_store = CCDStore(args.CCD_file)
+    CCD_store.index = CCD_store.build_index()
+    if not path.isfile(CCD_store.index_file):
+        exit(f"\nERROR! Index file {CCD_store.index_file} cannot be written!\n")
+    print("ok")
+    print(f"{len(CCD_store.index)} components indexed in {CCD_store.index_file}")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import argparse
+import traceback
+from os import path, listdir
+
+from calculate_charges_workflow import add_calculation_arguments, check_calculation_arguments, calculate_charges, create_job_pool
+from phases.scratch import ScratchManager
+from phases.xtb_cache import XtbCache
+
+
+def load_arguments():
+    print("\nParsing arguments... ",
+          end="")
+    parser = argparse.ArgumentParser(description="Calculates partial atomic charges for many structures in one process. "
+                                                 "Libraries, Chemical Component Dictionary and force field are loaded only once "
+                                                 "and xtb calculations of all structures are run by one pool of worker processes. "
+                                                 "Structures are calculated one after another, so the pool is reused by them, "
+                                                 "but xtb jobs of different structures do not run at the same time. "
+                                                 "Failure of a structure is recorded in its results and the batch continues.")
+    parser.add_argument("--PDB_files",
+                        help="PDB files with protein structures, directories with PDB files "
+                             "or text files with one path to PDB file per line.",
+                        type=str,
+                        nargs="+",
+                        required=True)
+    parser.add_argument("--data_dir",
+                        help="Directory for saving results. Results of each structure are saved "
+                             "in its own subdirectory named by the PDB file.",
+                        type=str,
+                        required=True)
+    add_calculation_arguments(parser)
+
+    args = parser.parse_args()
+    check_calculation_arguments(args)
+    args.PDB_files = find_PDB_files(args.PDB_files)
+    if not args.PDB_files:
+        exit(f"\nERROR! No PDB file found!\n")
+    entry_names = [path.basename(PDB_file)[:-4].lower() for PDB_file in args.PDB_files]
+    if len(set(entry_names)) != len(entry_names):
+        exit(f"\nERROR! Names of PDB files must be unique!\n")
+    if not args.resume:
+        for entry_name in entry_names:
+            entry_data_dir = f"{args.data_dir}/{entry_name}"
+            if path.exists(entry_data_dir) and listdir(entry_data_dir):
+                exit(f"\nError! Directory with name {entry_data_dir} exists and is not empty. "
+                     f"Remove existed directory, change --data_dir argument or use --resume!\n")
+    print("ok")
+    return args
+
+
+def find_PDB_files(paths: list):
+    """
+    :param paths: PDB files, directories with PDB files or text files with one path to PDB file per line
+    :return: list of PDB files
+    """
+    PDB_files = []
+    for input_path in paths:
+        if path.isdir(input_path):
+            PDB_files.extend(sorted(f"{input_path}/{file}" for file in listdir(input_path) if file.lower().endswith(".pdb")))
+        elif input_path.lower().endswith(".pdb"):
+            if not path.isfile(input_path):
+                exit(f"\nERROR! File {input_path} does not exist!\n")
+            PDB_files.append(input_path)
+        elif path.isfile(input_path):
+            PDB_files.extend(find_PDB_files([line.strip() for line in open(input_path) if line.strip()]))
+        else:
+            exit(f"\nERROR! File {input_path} does not exist!\n")
+    return PDB_files
+
+
+if __name__ == "__main__":
+    args = load_arguments()
+    if args.xtb_cache_dir:
+        xtb_cache = XtbCache(directory=args.xtb_cache_dir,
+                             max_size=int(args.xtb_cache_size * 1024 ** 3))
+    else:
+        xtb_cache = None
+    if args.scratch_dir:
+        scratch = ScratchManager(directory=args.scratch_dir,
+                                 max_size=int(args.scratch_size * 1024 ** 3))
+    else:
+        scratch = None
+    job_pool = create_job_pool(args)
+    failed_PDB_files = []
+    for entry_i, PDB_file in enumerate(args.PDB_files, start=1):
+        print(f"\n\nSTRUCTURE {PDB_file} ({entry_i}/{len(args.PDB_files)})")
+        try:
+            calculate_charges(PDB_file=PDB_file,
+                              data_dir=f"{args.data_dir}/{path.basename(PDB_file)[:-4].lower()}",
+                              args=args,
+                              xtb_cache=xtb_cache,
+                              job_pool=job_pool,
+                              scratch=scratch)
+        except (Exception, SystemExit): # one failed structure does not stop the batch
+            traceback.print_exc()
+            failed_PDB_files.append(PDB_file)
+    job_pool.shutdown()
+    if scratch:
+        scratch.close()
+
+    print(f"\nCharges calculated for {len(args.PDB_files) - len(failed_PDB_files)} of {len(args.PDB_files)} structures.")
+    if failed_PDB_files:
+        print(f"Calculation failed for: {' '.join(failed_PDB_files)}")
+        exit(1)
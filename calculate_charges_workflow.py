@@ -1,13 +1,215 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
+import traceback
 from collections import defaultdict
+from contextlib import nullcontext
 from os import path, system, listdir
 
 from phases.charge_calculator import ChargeCalculator
+from phases.components_cache import ComponentsCache
+from phases.dry_run import report_estimate, summarise_jobs
 from phases.structure_preparer import StructurePreparer
 from phases.hydrogen_optimiser import HydrogenOptimiser
+from phases.job_planner import JobPlanner
+from phases.job_pool import JobPool
+from phases.profiler import Profiler
+from phases.recovery_policy import RECOVERY_POLICIES, RecoveryPolicy
+from phases.scratch import ScratchManager
+from phases.tracer import Tracer
+from phases.xtb_cache import XtbCache
+from phases.xtb_engine import XTB_ENGINES
+
+# arguments changing the results of the calculation, resumed calculation must have the same values of them
+RESULTS_ARGUMENTS = ["CCD_file", "CCD_templates_file", "download_CCD_templates", "fragment_core_radius",
+                     "xtb_engine", "recovery_policy", "xtb_time_limit", "xtb_memory_limit"]
+
+def add_calculation_arguments(parser: argparse.ArgumentParser):
+    """Adds arguments shared by the workflow and the batch mode."""
+    parser.add_argument("--CCD_file",
+                        help="SDF file with Chemical Component Dictionary.",
+                        type=str,
+                        required=True)
+    parser.add_argument("--CCD_templates_file",
+                        help="mmCIF file with Chemical Component Dictionary (components.cif). PDBFixer templates "
+                             "of heteroresidues are created from it. Without it, heteroresidues have no templates "
+                             "and their missing heavy atoms are not added, unless --download_CCD_templates is given.",
+                        type=str,
+                        default=None)
+    parser.add_argument("--download_CCD_templates",
+                        help="Download PDBFixer templates of heteroresidues missing in --CCD_templates_file from PDB. "
+                             "By default, nothing is downloaded, so the calculation does not need network access.",
+                        action="store_true")
+    parser.add_argument("--delete_auxiliary_files",
+                        help="Auxiliary calculation files can be large. With this argument, "
+                             "the auxiliary files will be continuously deleted during the calculation.",
+                        action="store_true")
+    parser.add_argument("--workers",
+                        help="Number of processes processing residues, optimising hydrogens and calculating partial atomic charges "
+                             "of substructures concurrently.",
+                        type=int,
+                        default=1)
+    parser.add_argument("--cores",
+                        help="Budget of cores shared by all xtb calculations. Each calculation gets OpenMP threads "
+                             "by the size of its substructure and calculations run concurrently (at most --workers) "
+                             "only while their threads fit into the budget. By default, each calculation has one thread.",
+                        type=int,
+                        default=None)
+    parser.add_argument("--memory_budget",
+                        help="Budget of memory in GB shared by all xtb calculations. Calculations run concurrently "
+                             "only while their estimated memory fits into the budget. By default, the memory is not limited.",
+                        type=float,
+                        default=None)
+    parser.add_argument("--cost_model_file",
+                        help="JSON file with the cost model of xtb calculations fitted to the times of previous runs. "
+                             "Calculations are run longest first by the model and the model is updated by the times of this run. "
+                             "By default, the model is fitted only to the times of this run.",
+                        type=str,
+                        default=None)
+    parser.add_argument("--fragment_core_radius",
+                        help="Charges of all atoms closer than this radius (in angstroms) to the central atom of a substructure "
+                             "are calculated by one xtb calculation of an enlarged substructure. "
+                             "With the default value 0, each atom is calculated in its own substructure. "
+                             "Experimental, the reduction of xtb calculations is logged and the deviation of charges "
+                             "from the per-atom charges is measured by benchmark/run_benchmark.py --fragment_core_radius.",
+                        type=float,
+                        default=0)
+    parser.add_argument("--resume",
+                        help="Resume interrupted calculation in --data_dir. Completed phases are skipped "
+                             "and charges of already calculated substructures are taken from the journal.",
+                        action="store_true")
+    parser.add_argument("--dry_run",
+                        help="Only prepare the structure and estimate the calculation without running xtb: "
+                             "numbers of xtb jobs, histogram of substructure sizes, predicted CPU-hours and peak scratch. "
+                             "The estimate is stored in results directory in file estimate.json.",
+                        action="store_true")
+    parser.add_argument("--trace",
+                        help="Record steps of the workflow and xtb jobs (substructure size, attempt, construction and xtb time, status) "
+                             "into file trace.json in results directory, which can be loaded in chrome://tracing or Perfetto, "
+                             "and write summary table into file trace_summary.txt.",
+                        action="store_true")
+    parser.add_argument("--profile",
+                        help="Profile steps of the phases run in the main process (fix_structure, add_hydrogens_by_hydride, optimise, "
+                             "calculate_charges, write_charges_to_files, ...) by cProfile. Statistics of each step are stored "
+                             "in directory profile in results directory and functions with the highest own time are written "
+                             "into file profile_report.txt.",
+                        action="store_true")
+    parser.add_argument("--xtb_engine",
+                        help="Engine running xtb calculations. Engine xtb runs the xtb program for each substructure, "
+                             "engine xtb-python runs xtb in the worker processes by its Python bindings "
+                             "(Mulliken instead of CM5 charges, hydrogens are optimised with constrained atoms fixed).",
+                        type=str,
+                        choices=list(XTB_ENGINES),
+                        default="xtb")
+    parser.add_argument("--recovery_policy",
+                        help="Recovery of substructures whose xtb calculation did not converge. Policy enlarge calculates "
+                             "the substructures with radii enlarged by 1, 2 and 3 angstroms one after another, policy speculative "
+                             "calculates all three enlarged substructures concurrently and policy cheaper first repeats "
+                             "the calculation of the same substructure with smeared SCC.",
+                        type=str,
+                        choices=list(RECOVERY_POLICIES),
+                        default="enlarge")
+    parser.add_argument("--xtb_time_limit",
+                        help="Maximal wall-clock time of one xtb calculation in seconds. Calculation exceeding it is killed "
+                             "and its atoms are reported as failed. By default, xtb calculations are not limited.",
+                        type=float,
+                        default=None)
+    parser.add_argument("--xtb_memory_limit",
+                        help="Maximal memory of one xtb calculation in GB. Calculation exceeding it is killed "
+                             "and its atoms are reported as failed. By default, xtb calculations are not limited.",
+                        type=float,
+                        default=None)
+    parser.add_argument("--xtb_cache_dir",
+                        help="Directory with persistent cache of xtb results. Substructures already calculated "
+                             "in previous runs are not calculated again. By default, no cache is used.",
+                        type=str,
+                        default=None)
+    parser.add_argument("--xtb_cache_size",
+                        help="Maximal size of xtb cache in GB. Least recently used results are removed from the cache.",
+                        type=float,
+                        default=1)
+    parser.add_argument("--scratch_dir",
+                        help="Fast directory (e.g. /dev/shm or tmpfs) for working directories of xtb calculations. "
+                             "Only input and output files of xtb are copied into --data_dir (none with --delete_auxiliary_files). "
+                             "By default, xtb calculations run in --data_dir.",
+                        type=str,
+                        default=None)
+    parser.add_argument("--scratch_size",
+                        help="Maximal size of scratch in GB. If it is exceeded, next xtb calculations run in --data_dir.",
+                        type=float,
+                        default=1)
+    parser.add_argument("--components_cache_dir",
+                        help="Directory with persistent cache of CCD components protonated by Dimorphite-DL. "
+                             "Components already protonated in previous runs are not protonated again. By default, no cache is used.",
+                        type=str,
+                        default=None)
+
+
+def trace_span(tracer: Tracer,
+               name: str,
+               category: str):
+    """
+    :return: context recording the span by tracer or doing nothing if tracing is disabled
+    """
+    return tracer.span(name, category) if tracer else nullcontext()
+
+
+def profile_span(profiler: Profiler,
+                 name: str,
+                 category: str):
+    """
+    :return: context profiling the code by profiler or doing nothing if profiling is disabled
+    """
+    return profiler.profile(name, category) if profiler else nullcontext()
+
+
+def create_job_pool(args: argparse.Namespace):
+    """
+    :return: JobPool with the number of workers and budgets of cores and memory given by the arguments
+    """
+    return JobPool(workers=args.workers,
+                   cores=args.cores,
+                   memory=int(args.memory_budget * 1024 ** 3) if args.memory_budget else None)
+
+
+def create_xtb_engine(args: argparse.Namespace):
+    """
+    :return: engine selected by the argument --xtb_engine with time and memory limits of xtb calculations
+    """
+    return XTB_ENGINES[args.xtb_engine](time_limit=args.xtb_time_limit,
+                                        memory_limit=int(args.xtb_memory_limit * 1024 ** 3) if args.xtb_memory_limit else None)
+
+
+def check_calculation_arguments(args: argparse.Namespace):
+    if args.workers < 1:
+        exit(f"\nERROR! Number of workers must be positive!\n")
+    if args.cores is not None and args.cores < 1:
+        exit(f"\nERROR! Number of cores must be positive!\n")
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        exit(f"\nERROR! Memory budget must be positive!\n")
+    if args.fragment_core_radius < 0:
+        exit(f"\nERROR! Fragment core radius must not be negative!\n")
+    if args.xtb_cache_size <= 0:
+        exit(f"\nERROR! Size of xtb cache must be positive!\n")
+    if args.xtb_time_limit is not None and args.xtb_time_limit <= 0:
+        exit(f"\nERROR! Time limit of xtb must be positive!\n")
+    if args.xtb_memory_limit is not None and args.xtb_memory_limit <= 0:
+        exit(f"\nERROR! Memory limit of xtb must be positive!\n")
+    try:
+        create_xtb_engine(args)
+    except ImportError:
+        exit(f"\nERROR! Python bindings of xtb required by engine {args.xtb_engine} are not installed!\n")
+    except ValueError as error:
+        exit(f"\nERROR! {error}\n")
+    if args.scratch_size <= 0:
+        exit(f"\nERROR! Size of scratch must be positive!\n")
+    if args.CCD_templates_file:
+        if not path.isfile(args.CCD_templates_file):
+            exit(f"\nERROR! File {args.CCD_templates_file} does not exist!\n")
+        if not args.CCD_templates_file.lower().endswith(".cif"):
+            exit(f"\nERROR! CCD templates file must be in mmCIF format (suffix .cif)!\n")
 
 
 def load_arguments():
@@ -22,19 +224,13 @@ def load_arguments():
                         help="Directory for saving results.",
                         type=str,
                         required=True)
-    parser.add_argument("--CCD_file",
-                        help="SDF file with Chemical Component Dictionary.",
-                        type=str,
-                        required=True)
-    parser.add_argument("--delete_auxiliary_files",
-                        help="Auxiliary calculation files can be large. With this argument, "
-                             "the auxiliary files will be continuously deleted during the calculation.",
-                        action="store_true")
+    add_calculation_arguments(parser)
 
     args = parser.parse_args()
     if not path.isfile(args.PDB_file):
         exit(f"\nERROR! File {args.PDB_file} does not exist!\n")
-    if path.exists(args.data_dir) and listdir(args.data_dir):
+    check_calculation_arguments(args)
+    if path.exists(args.data_dir) and listdir(args.data_dir) and not args.resume:
         exit(f"\nError! Directory with name {args.data_dir} exists and is not empty. "
              f"Remove existed directory or change --data_dir argument!\n")
     print("ok")
@@ -44,10 +240,13 @@ class Logger:
     """This class handles output and warnings for residues and stores them in a defined files."""
     def __init__(self,
                  output_file: str,
-                 warning_file: str):
+                 warning_file: str,
+                 checkpoint_file: str):
         self.output_file = output_file
         self.warning_file = warning_file
+        self.checkpoint_file = checkpoint_file
         self.warnings = defaultdict(list)
+        self.failure = None
 
     def print(self,
               text: str,
@@ -65,8 +264,18 @@ class Logger:
                     warning: str):
         self.warnings[(chain, int(resnum), resname)].append(warning)
 
+    def add_failure(self,
+                    warning: str):
+        """Failure of the whole calculation is stored in the warning file as a warning without residue."""
+        self.failure = warning
+
     def write_warnings(self):
         json_warnings = []
+        if self.failure:
+            json_warnings.append({"chain_id": None,
+                                  "residue_id": None,
+                                  "residue_name": None,
+                                  "warning": self.failure})
         for (chain_id, residue_id, residue_name), warnings in sorted(self.warnings.items()):
             json_warnings.append({"chain_id": chain_id,
                                   "residue_id": residue_id,
@@ -75,62 +284,245 @@ class Logger:
         with open(self.warning_file, 'w') as warning_file:
             warning_file.write(json.dumps(json_warnings, indent=4))
 
-if __name__ == "__main__":
-    args = load_arguments()
+    def write_checkpoint(self,
+                         phase: str,
+                         arguments: dict):
+        """
+        Marks the phase as completed and stores the warnings collected so far.
+
+        :param arguments: arguments changing the results of the calculation, they are checked when the calculation is resumed
+        """
+        checkpoint = {"phase": phase,
+                      "arguments": arguments,
+                      "warnings": [[chain_id, residue_id, residue_name, warnings]
+                                   for (chain_id, residue_id, residue_name), warnings in self.warnings.items()]}
+        with open(self.checkpoint_file, "a") as checkpoint_file:
+            checkpoint_file.write(json.dumps(checkpoint) + "\n")
+
+    def read_checkpoints(self,
+                         arguments: dict):
+        """
+        Restores the warnings stored by the last completed phase and returns the names of completed phases.
+        The calculation is not resumed if the completed phases were calculated with different arguments.
+
+        :param arguments: arguments changing the results of the calculation
+        """
+        completed_phases = []
+        if not path.isfile(self.checkpoint_file):
+            return completed_phases
+        with open(self.checkpoint_file) as checkpoint_file:
+            checkpoint_lines = [line for line in checkpoint_file.readlines() if line.endswith("\n")] # ignore incomplete line
+        for line in checkpoint_lines:
+            checkpoint = json.loads(line)
+            if checkpoint.get("arguments") != arguments:
+                changed_arguments = [argument for argument in arguments if checkpoint.get("arguments", {}).get(argument) != arguments[argument]]
+                self.print(f"\nERROR! Completed phases were calculated with different {', '.join(changed_arguments)}. "
+                           f"Resume the calculation with the same arguments or remove the data directory!\n")
+                exit(1)
+            completed_phases.append(checkpoint["phase"])
+            self.warnings = defaultdict(list, {(chain_id, residue_id, residue_name): warnings
+                                               for chain_id, residue_id, residue_name, warnings in checkpoint["warnings"]})
+        with open(self.checkpoint_file, "w") as checkpoint_file:
+            checkpoint_file.write("".join(checkpoint_lines))
+        return completed_phases
+
+def calculate_charges(PDB_file: str,
+                      data_dir: str,
+                      args: argparse.Namespace,
+                      xtb_cache: XtbCache = None,
+                      job_pool: JobPool = None,
+                      scratch: ScratchManager = None):
+    """
+    Prepares the structure, optimises hydrogens and calculates partial atomic charges.
+    The results are stored in data_dir/results_<PDB code>.
+
+    :param args: calculation arguments (see function add_calculation_arguments)
+    :param xtb_cache: XtbCache shared by more structures
+    :param job_pool: JobPool shared by more structures
+    :param scratch: ScratchManager shared by more structures
+    """
+    xtb_engine = create_xtb_engine(args)
+    job_planner = JobPlanner(args.cost_model_file)
+    tracer = Tracer() if args.trace else None
 
     # prepare directories to store data
-    results_directory = f"{args.data_dir}/results_{path.basename(args.PDB_file)[:-4].lower()}"
-    if not path.exists(args.data_dir):
-        system(f"mkdir {args.data_dir}")
-    system(f"mkdir {args.data_dir}/input_PDB; "
-           f"mkdir {results_directory}; "
-           f"cp {args.PDB_file} {args.data_dir}/input_PDB")
+    results_directory = f"{data_dir}/results_{path.basename(PDB_file)[:-4].lower()}"
+    if not path.exists(data_dir):
+        system(f"mkdir {data_dir}")
+    system(f"mkdir -p {data_dir}/input_PDB; "
+           f"mkdir -p {results_directory}; "
+           f"cp {PDB_file} {data_dir}/input_PDB")
+    profiler = Profiler(f"{results_directory}/profile") if args.profile else None
+
+    with open(PDB_file, "rb") as PDB_file_handle:
+        results_arguments = {"PDB_file": hashlib.sha256(PDB_file_handle.read()).hexdigest()}
+    results_arguments.update({argument: getattr(args, argument) for argument in RESULTS_ARGUMENTS})
 
     residual_warnings_file = f"{results_directory}/residual_warnings.json"
     logger = Logger(output_file=f"{results_directory}/output.txt",
-                    warning_file=residual_warnings_file)
-
-    # prepare structure for main calculation of partial atomic charges
-    structure_preparer_input = args.PDB_file
-    structure_preparer_data_directory = f"{args.data_dir}/structure_preparer"
-    structure_preparer_output = f"{path.basename(args.PDB_file)[:-4]}_prepared.cif"
-    structure_preparer = StructurePreparer(input_PDB_file=structure_preparer_input,
-                                           CCD_file=args.CCD_file,
-                                           logger=logger,
-                                           data_dir=structure_preparer_data_directory,
-                                           output_mmCIF_file=structure_preparer_output,
-                                           delete_auxiliary_files=args.delete_auxiliary_files,
-                                           save_charges_estimation=True)
-    structure_preparer.fix_structure()
-    structure_preparer.remove_hydrogens()
-    structure_preparer.add_hydrogens_by_hydride()
-    structure_preparer.add_hydrogens_by_moleculekit()
-
-    # optimize added hydrogens
-    hydrogen_optimiser_input = f"{structure_preparer_data_directory}/{structure_preparer_output}"
-    hydrogen_optimiser_data_directory = f"{args.data_dir}/hydrogen_optimiser"
-    hydrogen_optimiser_output = f"{path.basename(args.PDB_file)[:-4]}_optimisedH.cif"
-    hydrogen_optimiser = HydrogenOptimiser(input_mmCIF_file=hydrogen_optimiser_input,
-                                           logger=logger,
-                                           output_mmCIF_file=hydrogen_optimiser_output,
-                                           data_dir=hydrogen_optimiser_data_directory,
-                                           delete_auxiliary_files=args.delete_auxiliary_files)
-    hydrogen_optimiser.optimise()
-
-    # calculate partial atomic charges
-    charge_calculator_input = f"{hydrogen_optimiser_data_directory}/{hydrogen_optimiser_output}"
-    charge_calculator_data_directory = f"{args.data_dir}/charge_calculator"
-    charge_calculator_output = f"{path.basename(args.PDB_file)[:-4]}.cif"
-    charges_estimation = f"{structure_preparer_data_directory}/estimated_charges.txt"
-    charge_calculator = ChargeCalculator(input_mmCIF_file=charge_calculator_input,
-                                         charges_estimation=charges_estimation,
-                                         logger=logger,
-                                         output_mmCIF_file=charge_calculator_output,
-                                         data_dir=charge_calculator_data_directory,
-                                         delete_auxiliary_files=args.delete_auxiliary_files)
-    charge_calculator.calculate_charges()
-    charge_calculator.write_charges_to_files()
-
-    system(f"cp {charge_calculator_data_directory}/{charge_calculator_output} {results_directory}")
-
-    logger.write_warnings()
+                    warning_file=residual_warnings_file,
+                    checkpoint_file=f"{data_dir}/checkpoints.txt")
+    try:
+        if args.resume:
+            completed_phases = logger.read_checkpoints(results_arguments)
+            logger.print(f"\nResuming calculation, completed phases: {', '.join(completed_phases) if completed_phases else 'none'}")
+        else:
+            completed_phases = []
+
+        # prepare structure for main calculation of partial atomic charges
+        structure_preparer_input = PDB_file
+        structure_preparer_data_directory = f"{data_dir}/structure_preparer"
+        structure_preparer_output = f"{path.basename(PDB_file)[:-4]}_prepared.cif"
+        if "structure_preparer" not in completed_phases:
+            system(f"rm -rf {structure_preparer_data_directory}") # remove results of the interrupted phase
+            structure_preparer = StructurePreparer(input_PDB_file=structure_preparer_input,
+                                                   CCD_file=args.CCD_file,
+                                                   logger=logger,
+                                                   data_dir=structure_preparer_data_directory,
+                                                   output_mmCIF_file=structure_preparer_output,
+                                                   delete_auxiliary_files=args.delete_auxiliary_files,
+                                                   save_charges_estimation=True,
+                                                   components_cache=ComponentsCache(args.components_cache_dir) if args.components_cache_dir else None,
+                                                   workers=args.workers,
+                                                   job_pool=job_pool,
+                                                   CCD_templates_file=args.CCD_templates_file,
+                                                   download_CCD_templates=args.download_CCD_templates)
+            for step in [structure_preparer.fix_structure,
+                         structure_preparer.remove_hydrogens,
+                         structure_preparer.add_hydrogens_by_hydride,
+                         structure_preparer.add_hydrogens_by_moleculekit]:
+                with trace_span(tracer, step.__name__, "structure_preparer"), profile_span(profiler, step.__name__, "structure_preparer"):
+                    step()
+            logger.write_checkpoint("structure_preparer", results_arguments)
+
+        # estimate the calculation from the substructures of both phases without running xtb
+        if args.dry_run:
+            dry_run_data_directory = f"{data_dir}/dry_run"
+            system(f"rm -rf {dry_run_data_directory}; mkdir -p {dry_run_data_directory}")
+            estimate_job_pool = job_pool if job_pool else JobPool(cores=args.cores)
+            prepared_structure = f"{structure_preparer_data_directory}/{structure_preparer_output}"
+            hydrogen_optimiser = HydrogenOptimiser(input_mmCIF_file=prepared_structure,
+                                                   logger=logger,
+                                                   output_mmCIF_file="optimisedH.cif",
+                                                   data_dir=f"{dry_run_data_directory}/hydrogen_optimiser",
+                                                   delete_auxiliary_files=args.delete_auxiliary_files,
+                                                   xtb_engine=xtb_engine,
+                                                   job_planner=job_planner)
+            charge_calculator = ChargeCalculator(input_mmCIF_file=prepared_structure,
+                                                 charges_estimation=f"{structure_preparer_data_directory}/estimated_charges.txt",
+                                                 logger=logger,
+                                                 output_mmCIF_file="charges.cif",
+                                                 data_dir=f"{dry_run_data_directory}/charge_calculator",
+                                                 delete_auxiliary_files=args.delete_auxiliary_files,
+                                                 fragment_core_radius=args.fragment_core_radius,
+                                                 xtb_engine=xtb_engine,
+                                                 job_planner=job_planner)
+            phases_summaries = {"Hydrogen optimiser": summarise_jobs(jobs=hydrogen_optimiser.estimate_jobs(estimate_job_pool),
+                                                                     method=xtb_engine.optimisation_method,
+                                                                     job_planner=job_planner,
+                                                                     workers=args.workers),
+                                "Charge calculator": summarise_jobs(jobs=charge_calculator.estimate_jobs(estimate_job_pool),
+                                                                    method=xtb_engine.charges_method,
+                                                                    job_planner=job_planner,
+                                                                    workers=args.workers)}
+            report_estimate(logger=logger,
+                            phases_summaries=phases_summaries,
+                            delete_auxiliary_files=args.delete_auxiliary_files,
+                            estimate_file=f"{results_directory}/estimate.json")
+            system(f"rm -rf {dry_run_data_directory}")
+            logger.write_warnings()
+            return
+
+        # optimize added hydrogens
+        hydrogen_optimiser_input = f"{structure_preparer_data_directory}/{structure_preparer_output}"
+        hydrogen_optimiser_data_directory = f"{data_dir}/hydrogen_optimiser"
+        hydrogen_optimiser_output = f"{path.basename(PDB_file)[:-4]}_optimisedH.cif"
+        if "hydrogen_optimiser" not in completed_phases:
+            system(f"rm -rf {hydrogen_optimiser_data_directory}") # remove results of the interrupted phase
+            hydrogen_optimiser = HydrogenOptimiser(input_mmCIF_file=hydrogen_optimiser_input,
+                                                   logger=logger,
+                                                   output_mmCIF_file=hydrogen_optimiser_output,
+                                                   data_dir=hydrogen_optimiser_data_directory,
+                                                   delete_auxiliary_files=args.delete_auxiliary_files,
+                                                   workers=args.workers,
+                                                   xtb_cache=xtb_cache,
+                                                   job_pool=job_pool,
+                                                   xtb_engine=xtb_engine,
+                                                   scratch=scratch,
+                                                   job_planner=job_planner,
+                                                   tracer=tracer)
+            with trace_span(tracer, "optimise", "hydrogen_optimiser"), profile_span(profiler, "optimise", "hydrogen_optimiser"):
+                hydrogen_optimiser.optimise()
+            logger.write_checkpoint("hydrogen_optimiser", results_arguments)
+
+        # calculate partial atomic charges
+        charge_calculator_input = f"{hydrogen_optimiser_data_directory}/{hydrogen_optimiser_output}"
+        charge_calculator_data_directory = f"{data_dir}/charge_calculator"
+        charge_calculator_output = f"{path.basename(PDB_file)[:-4]}.cif"
+        charges_estimation = f"{structure_preparer_data_directory}/estimated_charges.txt"
+        if "charge_calculator" not in completed_phases:
+            charge_calculator = ChargeCalculator(input_mmCIF_file=charge_calculator_input,
+                                                 charges_estimation=charges_estimation,
+                                                 logger=logger,
+                                                 output_mmCIF_file=charge_calculator_output,
+                                                 data_dir=charge_calculator_data_directory,
+                                                 delete_auxiliary_files=args.delete_auxiliary_files,
+                                                 workers=args.workers,
+                                                 fragment_core_radius=args.fragment_core_radius,
+                                                 xtb_cache=xtb_cache,
+                                                 resume=args.resume,
+                                                 job_pool=job_pool,
+                                                 xtb_engine=xtb_engine,
+                                                 scratch=scratch,
+                                                 recovery_policy=RecoveryPolicy(args.recovery_policy),
+                                                 job_planner=job_planner,
+                                                 tracer=tracer)
+            with trace_span(tracer, "calculate_charges", "charge_calculator"), profile_span(profiler, "calculate_charges", "charge_calculator"):
+                charge_calculator.calculate_charges()
+            with trace_span(tracer, "write_charges_to_files", "charge_calculator"), profile_span(profiler, "write_charges_to_files", "charge_calculator"):
+                charge_calculator.write_charges_to_files()
+
+            system(f"cp {charge_calculator_data_directory}/{charge_calculator_output} {results_directory}")
+            logger.write_checkpoint("charge_calculator", results_arguments)
+
+        if tracer:
+            tracer.write(f"{results_directory}/trace.json")
+            trace_summary = tracer.summary()
+            with open(f"{results_directory}/trace_summary.txt", "w") as trace_summary_file:
+                trace_summary_file.write(f"{trace_summary}\n")
+            logger.print(f"\n{trace_summary}")
+        if profiler:
+            with open(f"{results_directory}/profile_report.txt", "w") as profile_report_file:
+                profile_report_file.write(profiler.report())
+            logger.print(f"\nProfiles of steps stored in {results_directory}/profile, hot functions in {results_directory}/profile_report.txt.")
+        logger.write_warnings()
+    except (Exception, SystemExit):
+        # the failure is stored in the results of the structure, so that failed structures of a batch can be found
+        logger.print(f"\nERROR! Calculation failed.\n{traceback.format_exc()}", silence=True)
+        logger.add_failure("Calculation of partial atomic charges failed, see output.txt.")
+        logger.write_warnings()
+        raise
+
+
+if __name__ == "__main__":
+    args = load_arguments()
+    if args.xtb_cache_dir:
+        xtb_cache = XtbCache(directory=args.xtb_cache_dir,
+                             max_size=int(args.xtb_cache_size * 1024 ** 3))
+    else:
+        xtb_cache = None
+    if args.scratch_dir:
+        scratch = ScratchManager(directory=args.scratch_dir,
+                                 max_size=int(args.scratch_size * 1024 ** 3))
+    else:
+        scratch = None
+    job_pool = create_job_pool(args)
+    calculate_charges(PDB_file=args.PDB_file,
+                      data_dir=args.data_dir,
+                      args=args,
+                      xtb_cache=xtb_cache,
+                      job_pool=job_pool,
+                      scratch=scratch)
+    job_pool.shutdown()
+    if scratch:
+        scratch.close()
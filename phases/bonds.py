@@ -0,0 +1,60 @@
+import numpy as np
+from rdkit import Chem
+from scipy.spatial import cKDTree
+
+# proximity bonds between different residues are created only for these elements, as RDKit does
+# (metals, halogens, noble gases and hydrogens are excluded)
+INTERRESIDUAL_BONDING_ELEMENTS = {"B", "C", "N", "O", "Si", "P", "S", "Ge", "As", "Se", "Sb", "Te"}
+
+
+def find_proximity_bonds(elements: list,
+                         coords: np.ndarray,
+                         residue_keys: list,
+                         residue_names: list):
+    """
+    Finds covalent bonds from interatomic distances by rules approximating the proximity bonds of RDKit
+    for PDB files without CONECT records (only the rules below are re-implemented, not the whole ProximityBonds.cpp).
+    https://github.com/rdkit/rdkit/blob/master/Code/GraphMol/FileParsers/ProximityBonds.cpp
+    Bonds are compared with Chem.MolFromPDBBlock on the example structures by benchmark/check_proximity_bonds.py.
+
+    Two atoms are bonded if their distance is at least 0.4 angstroms and smaller than sum of their covalent radii plus 0.45 angstroms.
+    Hydrogens are never bonded to each other. Atoms from different residues are bonded only if both of them
+    are non-metals (see INTERRESIDUAL_BONDING_ELEMENTS) and none of them is from water.
+
+    :param elements: element symbols of atoms (case insensitive)
+    :param coords: coordinates of atoms with shape (n, 3)
+    :param residue_keys: hashable identifiers of residues of atoms, e.g. (chain, residue number, insertion code, residue name)
+    :param residue_names: residue names of atoms
+    :return: array of bonded atom indices with shape (m, 2), pairs are sorted
+    """
+    periodic_table = Chem.GetPeriodicTable()
+    elements = [element.strip().capitalize() for element in elements]
+    covalent_radii = {}
+    for element in set(elements):
+        try:
+            covalent_radii[element] = periodic_table.GetRcovalent(periodic_table.GetAtomicNumber(element))
+        except RuntimeError: # unknown element is loaded by RDKit as a dummy atom
+            covalent_radii[element] = periodic_table.GetRcovalent(0)
+    radii = np.array([covalent_radii[element] for element in elements], dtype=float)
+    coords = np.round(np.asarray(coords, dtype=float), 3) # the same precision as in PDB files
+    if len(coords) < 2:
+        return np.empty((0, 2), dtype=int)
+
+    # candidate pairs are searched up to the largest possible bond length
+    pairs = cKDTree(coords).query_pairs(r=2 * radii.max() + 0.45,
+                                        output_type="ndarray")
+    distances = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis=1)
+    mask = (distances >= 0.4) & (distances < radii[pairs[:, 0]] + radii[pairs[:, 1]] + 0.45)
+
+    is_hydrogen = np.array([element == "H" for element in elements])
+    mask &= ~(is_hydrogen[pairs[:, 0]] & is_hydrogen[pairs[:, 1]])
+
+    residue_indices = {}
+    residue_indices_array = np.array([residue_indices.setdefault(residue_key, len(residue_indices)) for residue_key in residue_keys])
+    interresidual = residue_indices_array[pairs[:, 0]] != residue_indices_array[pairs[:, 1]]
+    interresidual_bonding = np.array([element in INTERRESIDUAL_BONDING_ELEMENTS for element in elements])
+    interresidual_bonding &= np.array([residue_name != "HOH" for residue_name in residue_names])
+    mask &= ~interresidual | (interresidual_bonding[pairs[:, 0]] & interresidual_bonding[pairs[:, 1]])
+
+    bonds = np.sort(pairs[mask], axis=1)
+    return bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
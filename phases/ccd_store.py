@@ -0,0 +1,97 @@
+from os import getpid, replace, stat
+
+
+class CCDStore:
+    """
+    Chemical Component Dictionary in SDF or mmCIF format (file with suffix .cif) with an offset index of its records by component ID.
+    Only the requested records are read from the file, so the file (several hundred MB) is never loaded whole.
+
+    The index is stored next to the CCD file (CCD_file.index) and it is rebuilt when the CCD file is changed.
+    If the index cannot be written (e.g. read-only mount), it is built in memory by streaming the CCD file.
+    """
+    def __init__(self,
+                 CCD_file: str):
+        """
+        :param CCD_file: SDF or mmCIF file with Chemical Component Dictionary
+        """
+        self.CCD_file = CCD_file
+        self.index_file = f"{CCD_file}.index"
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = self.build_index()
+
+    def _signature(self):
+        """
+        :return: size and modification time of the CCD file, the index is valid only for the same signature
+        """
+        CCD_file_stat = stat(self.CCD_file)
+        return f"{CCD_file_stat.st_size} {CCD_file_stat.st_mtime_ns}"
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as index_file:
+                if index_file.readline() != f"{self._signature()}\n":
+                    return None
+                index = {}
+                for line in index_file:
+                    component_id, offset, length = line.rsplit(" ", 2)
+                    index[component_id] = (int(offset), int(length))
+                return index
+        except (OSError, ValueError):
+            return None
+
+    def build_index(self):
+        """
+        Streams the CCD file and stores the offset and length of each record. If the ID is repeated, the last record is indexed.
+        SDF records are terminated by line $$$$ and the component ID is on the first line of each record.
+        mmCIF records are data blocks starting by line data_<component ID>.
+
+        :return: dictionary {component ID: (offset, length)}
+        """
+        index = {}
+        offset = 0
+        record_offset = 0
+        component_id = None
+        mmCIF = self.CCD_file.lower().endswith(".cif")
+        with open(self.CCD_file, "rb") as CCD_file:
+            for line in CCD_file:
+                if mmCIF:
+                    if line.startswith(b"data_"):
+                        if component_id is not None:
+                            index[component_id] = (record_offset, offset - record_offset)
+                        component_id = line.rstrip(b"\r\n")[5:].decode()
+                        record_offset = offset
+                else:
+                    if component_id is None:
+                        component_id = line.rstrip(b"\r\n").decode()
+                    if line.rstrip(b"\r\n") == b"$$$$":
+                        index[component_id] = (record_offset, offset - record_offset)
+                        record_offset = offset + len(line)
+                        component_id = None
+                offset += len(line)
+        if component_id is not None: # last record (SDF record without terminator)
+            index[component_id] = (record_offset, offset - record_offset)
+
+        # index is written atomically, so concurrent processes never read incomplete index
+        temporary_index_file = f"{self.index_file}.{getpid()}.tmp"
+        try:
+            with open(temporary_index_file, "w") as index_file:
+                index_file.write(f"{self._signature()}\n")
+                index_file.write("".join(f"{component_id} {offset} {length}\n" for component_id, (offset, length) in index.items()))
+            replace(temporary_index_file, self.index_file)
+        except OSError:
+            pass
+        return index
+
+    def get(self,
+            component_id: str):
+        """
+        :return: record of the component (SDF record without the terminating line $$$$ or mmCIF data block)
+                 or None if the component is not in CCD
+        """
+        if component_id not in self.index:
+            return None
+        offset, length = self.index[component_id]
+        with open(self.CCD_file, "rb") as CCD_file:
+            CCD_file.seek(offset)
+            return CCD_file.read(length).decode().replace("\r\n", "\n")
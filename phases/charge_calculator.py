@@ -1,19 +1,43 @@
-from math import dist
-from os import system
+import hashlib
+import heapq
+from os import getpid, path, system
+from time import perf_counter, time
 
 import gemmi
+import numpy as np
 import tqdm
 from Bio import PDB
-from rdkit import Chem
-
-
-class AtomSelector(PDB.Select):
+from scipy.spatial import cKDTree
+
+from phases.job_planner import JobPlanner, element_weight
+from phases.job_pool import JobPool
+from phases.recovery_policy import INITIAL_ATTEMPT, RecoveryPolicy
+from phases.scratch import working_directory
+from phases.spatial_index import SpatialIndex
+from phases.substructure_builder import SubstructureBuilder
+from phases.tracer import Tracer, xtb_job_status
+from phases.xtb_engine import SubprocessXtbEngine, XtbLimitExceeded
+
+def calculate_substructure_charges(job: dict):
     """
-    Support class for Biopython.
-    After initialization, a set with all full ids of the atoms to be written into the substructure must be stored in self.full_ids.
+    Calculates charges of one substructure by the xtb engine of the job. The function is run by JobPool in worker processes,
+    so the job contains everything needed for the calculation (see SubprocessXtbEngine.calculate_charges).
+
+    :return: tuple (list of charges of substructure atoms or None if the calculation did not converge,
+             report of the job with exceeded limit "time" or "memory" if the xtb calculation was killed by the supervisor
+             or None (exceeded_limit), start of the calculation (start), its time in seconds (seconds)
+             and ID of the process which ran the job (process_id))
     """
-    def accept_atom(self, atom):
-        return int(atom.full_id in self.full_ids)
+    start, start_time = perf_counter(), time()
+    with working_directory(job) as working_job:
+        try:
+            cm5_charges, exceeded_limit = job["engine"].calculate_charges(working_job), None
+        except XtbLimitExceeded as limit_exceeded:
+            cm5_charges, exceeded_limit = None, limit_exceeded.limit
+    return cm5_charges, {"exceeded_limit": exceeded_limit,
+                         "start": start_time,
+                         "seconds": perf_counter() - start,
+                         "process_id": getpid()}
 
 
 class ChargeCalculator:
@@ -31,13 +55,36 @@ class ChargeCalculator:
                  logger,
                  output_mmCIF_file: str,
                  data_dir: str,
-                 delete_auxiliary_files: bool):
+                 delete_auxiliary_files: bool,
+                 workers: int = 1,
+                 fragment_core_radius: float = 0,
+                 xtb_cache=None,
+                 resume: bool = False,
+                 job_pool: JobPool = None,
+                 xtb_engine=None,
+                 scratch=None,
+                 recovery_policy: RecoveryPolicy = None,
+                 job_planner: JobPlanner = None,
+                 tracer: Tracer = None):
         """
         :param input_mmCIF_file: mmCIF file containing the structure for which the partial atomic charges are to be calculated
         :param charges_estimation: txt file with estimation of partial atomic charges for more accurate results
         :param output_mmCIF_file: mmCIF file in which calculated partial atomic charges will be stored
         :param data_dir: directory where the results will be stored
         :param delete_auxiliary_files: auxiliary files created by the calculation taking up a significant amount of space will be deleted
+        :param workers: number of processes calculating substructures concurrently, it is ignored if job_pool is given
+        :param fragment_core_radius: charges of all atoms closer than fragment_core_radius to the central atom
+                                     are taken from one substructure, whose radii are enlarged by fragment_core_radius,
+                                     zero means that each atom has its own substructure
+        :param xtb_cache: XtbCache with results of previous xtb calculations, None disables caching
+        :param resume: charges of substructures stored in the journal by the previous interrupted run are not calculated again
+        :param job_pool: JobPool shared with other phases or structures, by default the charge calculator has its own pool
+        :param xtb_engine: engine calculating charges of substructures (see phases/xtb_engine.py), by default the xtb program
+        :param scratch: ScratchManager with fast working directories for xtb jobs, by default the jobs run in data_dir
+        :param recovery_policy: RecoveryPolicy planning the attempts of substructures which did not converge,
+                                by default the radii of failed substructures are enlarged one after another
+        :param job_planner: JobPlanner ordering the jobs longest first, by default with the cost model of this run only
+        :param tracer: Tracer recording xtb jobs, None disables tracing
         """
 
         self.logger = logger
@@ -48,23 +95,41 @@ class ChargeCalculator:
         self.output_mmCIF_file = output_mmCIF_file
         self.charges_estimation = charges_estimation
         self.delete_auxiliary_files = delete_auxiliary_files
+        self.workers = workers
+        self.job_pool = job_pool
+        self.xtb_engine = xtb_engine if xtb_engine else SubprocessXtbEngine()
+        self.scratch = scratch
+        self.recovery_policy = recovery_policy if recovery_policy else RecoveryPolicy()
+        self.job_planner = job_planner if job_planner else JobPlanner()
+        self.tracer = tracer
+        self.fragment_core_radius = fragment_core_radius
+        self.xtb_cache = xtb_cache
+        self.resume = resume
         self.data_dir = data_dir
-        system(f"mkdir {self.data_dir}")
+        self.journal_file = f"{self.data_dir}/charges_journal.txt"
+        system(f"mkdir -p {self.data_dir}")
         system(f"cp {input_mmCIF_file} {self.data_dir}/{self.output_mmCIF_file}")
         self.logger.print("ok")
 
 
-    def calculate_charges(self):
+    def load_structure(self):
+        """
+        Loads the structure with estimation of charges and plans the substructures.
+
+        :return: structure, its total charge, indices of atoms whose charges are calculated
+                 and planned fragments (see method plan_fragments)
+        """
 
         # load structure by Biopython
         self.logger.print("Loading structure... ", end="")
         structure = PDB.MMCIFParser(QUIET=True).get_structure(structure_id="structure",
                                                               filename=f"{self.data_dir}/{self.output_mmCIF_file}")[0]
         structure_atoms = sorted(structure.get_atoms(), key=lambda x: x.serial_number)
-        selector = AtomSelector()
-        io = PDB.PDBIO()
-        io.set_structure(structure)
-        kdtree = PDB.NeighborSearch(structure_atoms)
+        self.structure_atoms = structure_atoms
+        self.spatial_index = SpatialIndex(structure_atoms)
+        self.substructure_builder = SubstructureBuilder(atoms=structure_atoms,
+                                                        spatial_index=self.spatial_index)
+        self.element_weights = np.array([element_weight(atom.element) for atom in structure_atoms])
         self.logger.print("ok")
 
         # load partial atomic charges estimation
@@ -77,177 +142,90 @@ class ChargeCalculator:
             atom.cm5_charge = None
         self.logger.print("ok")
 
-        # calculate the charges for each atom using the cutoff approach.
-        self.logger.print("Calculating of patial atomic charges... ", end="", silence=True)
-        for calculated_atom_i, calculated_atom in enumerate(tqdm.tqdm(structure_atoms,
-                                                                      desc="Charge calculation",
-                                                                      unit="atoms",
-                                                                      smoothing=0,
-                                                                      delay=0.1,
-                                                                      mininterval=0.4,
-                                                                      maxinterval=0.4),
-                                                            start=1):
-
-            # To speed up the calculation, the charges of the hydrogen and oxygen atoms bound to one atom
-            # are calculated together with the nearest other heavy atoms
-            if calculated_atom.element == "H":
-                continue
-            elif calculated_atom.element == "O":
-                if len(kdtree.search(center=calculated_atom.coord,
-                                     radius=1.5,
-                                     level="A")) <= 2:
-                    continue
-
-            substructure_data_dir = f"{self.data_dir}/sub_{calculated_atom_i}"
-            system(f"mkdir {substructure_data_dir}")
-
-            # definition of radii limiting the substructure
-            # all atoms that are closer to the calculated atom than min_radius are included in the substructure
-            # atoms more distant from the calculated atom than max_radius are never included in the substructure
-            min_radius = 6
-            max_radius = 12
+        # To speed up the calculation, the charges of the hydrogen and oxygen atoms bound to one atom
+        # are calculated together with the nearest other heavy atoms
+        oxygen_indices = [atom_i for atom_i, atom in enumerate(structure_atoms) if atom.element == "O"]
+        oxygen_neighbours_counts = self.spatial_index.count_batch(centers=[structure_atoms[atom_i].coord for atom_i in oxygen_indices],
+                                                                  radius=1.5)
+        self.terminal_oxygen_indices = set(atom_i for atom_i, neighbours_count in zip(oxygen_indices, oxygen_neighbours_counts)
+                                           if neighbours_count <= 2)
+        calculated_atom_indices = [atom_i for atom_i, atom in enumerate(structure_atoms)
+                                   if atom.element != "H" and atom_i not in self.terminal_oxygen_indices]
+        fragments = self.plan_fragments(calculated_atom_indices)
+        return structure, total_charge, calculated_atom_indices, fragments
 
+    def calculate_charges(self):
+        structure, total_charge, calculated_atom_indices, fragments = self.load_structure()
+        structure_atoms = self.structure_atoms
+        journaled_substructures_charges, journaled_exceeded_limits = self.read_journal(fragments) if self.resume else ({}, {})
+        calculated_atoms_count = len(calculated_atom_indices)
+        self.logger.print(f"Partial atomic charges of {calculated_atoms_count} atoms will be calculated "
+                          f"from {len(fragments)} substructures.")
+        if journaled_substructures_charges:
+            self.logger.print(f"Charges from {len(journaled_substructures_charges)} substructures restored from journal.")
+        else:
+            self.write_journal_header(fragments)
+
+        # calculate the charges for each fragment using the cutoff approach.
+        # substructures are calculated either one by one or in a pool of worker processes,
+        # the results are written into the structure in the order of fragments
+        self.logger.print("Calculating of patial atomic charges... ", end="", silence=True)
+        if self.xtb_cache:
+            self.xtb_cache.reset_statistics()
+        self.recovery_policy.reset_statistics()
+        self.job_planner.reset_statistics()
+        calculation_start = perf_counter()
+        job_pool = self.job_pool if self.job_pool else JobPool(workers=self.workers)
+        fragments_calculated_atom_indices = dict(fragments)
+        exceeded_limits_counts = {"time": 0, "memory": 0}
+        for central_atom_i, exceeded_limit in journaled_exceeded_limits.items():
+            self.record_exceeded_limit(central_atom_i, exceeded_limit, exceeded_limits_counts)
+        substructures_charges = dict(journaled_substructures_charges)
+        substructures_atoms_counts = [] # sizes of the calculated substructures, they are reported for fragments
+        pending_central_atom_indices = [central_atom_i for central_atom_i, _ in fragments if central_atom_i not in substructures_charges]
+        progress_bar = tqdm.tqdm(total=len(fragments),
+                                 initial=len(substructures_charges),
+                                 desc="Charge calculation",
+                                 unit="substructures",
+                                 smoothing=0,
+                                 delay=0.1,
+                                 mininterval=0.4,
+                                 maxinterval=0.4)
+        with open(self.journal_file, "a") as journal_file:
             # xtb calculation may not converge
-            # in this case we try the calculation four times with min_radius and max_radius increased
-            calculation_converged = False
-            while not calculation_converged:
-
-                # create and save min_radius and max_radius substructures by biopython
-                atoms_in_min_radius = kdtree.search(center=calculated_atom.coord,
-                                                    radius=min_radius,
-                                                    level="A")
-                selector.full_ids = set([atom.full_id for atom in atoms_in_min_radius])
-                io.save(file=f"{substructure_data_dir}/atoms_in_{min_radius}_angstroms.pdb",
-                        select=selector)
-                atoms_in_max_radius = kdtree.search(center=calculated_atom.coord,
-                                                    radius=max_radius,
-                                                    level="A")
-                selector.full_ids = set([atom.full_id for atom in atoms_in_max_radius])
-                io.save(file=f"{substructure_data_dir}/atoms_in_{max_radius}_angstroms.pdb",
-                        select=selector)
-
-                # load substructures by RDKit to determine bonds
-                mol_min_radius = Chem.MolFromPDBFile(molFileName=f"{substructure_data_dir}/atoms_in_{min_radius}_angstroms.pdb",
-                                                     removeHs=False,
-                                                     sanitize=False)
-                mol_min_radius_conformer = mol_min_radius.GetConformer()
-                mol_max_radius = Chem.MolFromPDBFile(molFileName=f"{substructure_data_dir}/atoms_in_{max_radius}_angstroms.pdb",
-                                                     removeHs=False,
-                                                     sanitize=False)
-                mol_max_radius_conformer = mol_max_radius.GetConformer()
-
-                # dictionaries allow quick and precise matching of atoms from mol_min_radius and mol_max_radius
-                mol_min_radius_coord_dict = {}
-                for i, mol_min_radius_atom in enumerate(mol_min_radius.GetAtoms()):
-                    coord = mol_min_radius_conformer.GetAtomPosition(i)
-                    mol_min_radius_coord_dict[(coord.x, coord.y, coord.z)] = mol_min_radius_atom
-                mol_max_radius_coord_dict = {}
-                for i, mol_max_radius_atom in enumerate(mol_max_radius.GetAtoms()):
-                    coord = mol_max_radius_conformer.GetAtomPosition(i)
-                    mol_max_radius_coord_dict[(coord.x, coord.y, coord.z)] = mol_max_radius_atom
-
-                # find atoms from mol_min_radius with broken bonds
-                atoms_with_broken_bonds = []
-                for mol_min_radius_atom in mol_min_radius.GetAtoms():
-                    coord = mol_min_radius_conformer.GetAtomPosition(mol_min_radius_atom.GetIdx())
-                    mol_max_radius_atom = mol_max_radius_coord_dict[(coord.x, coord.y, coord.z)]
-                    if len(mol_min_radius_atom.GetNeighbors()) != len(mol_max_radius_atom.GetNeighbors()):
-                        atoms_with_broken_bonds.append(mol_max_radius_atom)
-
-                # create a substructure that will have only C-C bonds broken
-                carbons_with_broken_bonds_coord = []  # hydrogens will be added only to these carbons
-                substructure_coord_dict = mol_min_radius_coord_dict
-                while atoms_with_broken_bonds:
-                    atom_with_broken_bonds = atoms_with_broken_bonds.pop(0)
-                    bonded_atoms = atom_with_broken_bonds.GetNeighbors()
-                    for bonded_atom in bonded_atoms:
-                        coord = mol_max_radius_conformer.GetAtomPosition(bonded_atom.GetIdx())
-                        if (coord.x, coord.y, coord.z) in substructure_coord_dict:
-                            continue
-                        else:
-                            if atom_with_broken_bonds.GetSymbol() == "C" and bonded_atom.GetSymbol() == "C":
-                                carbons_with_broken_bonds_coord.append(mol_max_radius_conformer.GetAtomPosition(atom_with_broken_bonds.GetIdx()))
-                                continue
-                            else:
-                                atoms_with_broken_bonds.append(bonded_atom)
-                                substructure_coord_dict[(coord.x, coord.y, coord.z)] = bonded_atom
-
-                # create substructure in Biopython library
-                # we prefer to use kdtree because serial_id may be discontinuous in some pdbs files
-                # for example, a structure with PDB code 107d and its serial numbers 218 and 445
-                substructure_atoms = [kdtree.search(center=coord,
-                                                    radius=0.1,
-                                                    level="A")[0] for coord in substructure_coord_dict.keys()]
-                selector.full_ids = set([atom.full_id for atom in substructure_atoms])
-                io.save(file=f"{substructure_data_dir}/substructure.pdb",
-                        select=selector)
-
-                # add hydrogens to broken C-C bonds by openbabel
-                system(f"cd {substructure_data_dir} ; obabel -iPDB -oPDB substructure.pdb -h > readded_hydrogens_substructure.pdb 2>/dev/null")
-                with open(f"{substructure_data_dir}/readded_hydrogens_substructure.pdb") as readded_hydrogens_substructure_file:
-                    atom_lines = [line for line in readded_hydrogens_substructure_file.readlines() if line[:4] in ["ATOM", "HETA"]]
-                    original_atoms_lines = atom_lines[:len(substructure_atoms)]
-                    added_hydrogens_lines = atom_lines[len(substructure_atoms):]
-                with open(f"{substructure_data_dir}/repaired_substructure.pdb", "w") as repaired_substructure_file:
-                    repaired_substructure_file.write("".join(original_atoms_lines))
-                    for added_hydrogen_line in added_hydrogens_lines:
-                        added_hydrogen_coord = (float(added_hydrogen_line[30:38]),
-                                                float(added_hydrogen_line[38:46]),
-                                                float(added_hydrogen_line[46:54]))
-                        if any([dist(added_hydrogen_coord, carbon_coord) < 1.3 for carbon_coord in carbons_with_broken_bonds_coord]):
-                            repaired_substructure_file.write(added_hydrogen_line)
-
-                # calculate charges for substructure
-                substructure_charge = round(sum([atom.charge_estimation for atom in substructure_atoms]))
-                system(f"cd {substructure_data_dir} ; "
-                       f"ulimit -s unlimited ;"
-                       f"export OMP_NUM_THREADS=1,1 ;"
-                       f"export OMP_MAX_ACTIVE_LEVELS=1 ;"
-                       f"export MKL_NUM_THREADS=1 ;"
-                       f"xtb repaired_substructure.pdb --gfn 1 --gbsa water --acc 1000 --chrg {substructure_charge}   > xtb_output.txt 2> xtb_error_output.txt ")
-
-                # read calculated charges from xtb output file
-                xtb_output_file_lines = open(f"{substructure_data_dir}/xtb_output.txt").readlines()
-                try:
-                    cm5_charges_headline = "  Mulliken/CM5 charges         n(s)   n(p)   n(d)\n"
-                    charge_headline_index = xtb_output_file_lines.index(cm5_charges_headline)
-                    calculation_converged = True
-                except ValueError:  # charge calculation failed
-                    min_radius += 1
-                    max_radius += 1
-                if max_radius > 15:
-                    break
-
-            if calculation_converged:
-
-                # define for which atoms we have calculated the charges
-                calculated_atoms = set([calculated_atom])
-                for near_atom in kdtree.search(center=calculated_atom.coord,
-                                               radius=1.5,
-                                               level="A"):
-                    if near_atom.element == "H":
-                        calculated_atoms.add(near_atom)
-                    elif near_atom.element == "O":
-                        if len(kdtree.search(center=near_atom.coord,
-                                             radius=1.5,
-                                             level="A")) <= 2:
-                            calculated_atoms.add(near_atom)
-                calculated_atoms_full_ids = set([calculated_atom.full_id for calculated_atom in calculated_atoms])
-
-                # write the charges into the Biopython structure
-                # we prefer to use kdtree because serial_id may be discontinuous in some pdbs files
-                # for example, a structure with PDB code 107d and its serial numbers 218 and 445
-                calculated_substructure = PDB.PDBParser(QUIET=True).get_structure(id="structure",
-                                                                                  file=f"{substructure_data_dir}/substructure.pdb")[0]
-                for calculated_substructure_atom_i, substructure_atom in enumerate(calculated_substructure.get_atoms()):
-                    if substructure_atom.full_id in calculated_atoms_full_ids:
-                        charge = float(xtb_output_file_lines[charge_headline_index + calculated_substructure_atom_i + 1][19:28])
-                        kdtree.search(center=substructure_atom.coord,
-                                      radius=0.1,
-                                      level="A")[0].cm5_charge = charge
-
-            if self.delete_auxiliary_files:
-                system(f"rm -r {substructure_data_dir}")
+            # in this case we try the calculation of failed substructures by the next stages of recovery policy
+            # (e.g. three more times with min_radius and max_radius increased)
+            # substructures whose calculation exceeded the time or memory limit are not tried again, larger substructures would exceed it too
+            for stage_i, attempts in enumerate(self.recovery_policy.stages):
+                last_stage = stage_i == len(self.recovery_policy.stages) - 1
+                failed_central_atom_indices = []
+                for central_atom_i, substructure_atom_indices, substructure_cm5_charges, exceeded_limit in self.calculate_substructures(job_pool=job_pool,
+                                                                                                                                      central_atom_indices=pending_central_atom_indices,
+                                                                                                                                      attempts=attempts):
+                    if exceeded_limit:
+                        self.record_exceeded_limit(central_atom_i, exceeded_limit, exceeded_limits_counts)
+                    elif substructure_cm5_charges is None and not last_stage:
+                        failed_central_atom_indices.append(central_atom_i)
+                        continue
+                    substructure_charges = []
+                    if substructure_cm5_charges is not None:
+                        substructures_atoms_counts.append(len(substructure_atom_indices))
+                        # read the charges of calculated atoms, the substructure atoms are in the same order as in the xtb output
+                        calculated_atom_indices = set(fragments_calculated_atom_indices[central_atom_i])
+                        substructure_charges = [(atom_i, charge) for atom_i, charge in zip(substructure_atom_indices, substructure_cm5_charges)
+                                                if atom_i in calculated_atom_indices]
+                    substructures_charges[central_atom_i] = substructure_charges
+                    journal_file.write(self.journal_line(central_atom_i, substructure_charges, exceeded_limit))
+                    journal_file.flush()
+                    progress_bar.update()
+                pending_central_atom_indices = failed_central_atom_indices
+        progress_bar.close()
+        calculation_time = perf_counter() - calculation_start
+        if not self.job_pool:
+            job_pool.shutdown()
+        for central_atom_i, _ in fragments:
+            for atom_i, charge in substructures_charges[central_atom_i]:
+                structure_atoms[atom_i].cm5_charge = charge
 
         # create final array of charges
         cm5_charges = [atom.cm5_charge for atom in structure_atoms]
@@ -266,7 +244,318 @@ class ChargeCalculator:
                                         resname=residue.resname,
                                         warning=warning)
         self.logger.print("ok", silence=True)
+        if self.xtb_cache:
+            self.logger.print(f"Charge calculator: {self.xtb_cache.statistics()}.")
+            self.xtb_cache.evict()
+        self.logger.print(f"Charge calculator: {self.job_planner.statistics(calculation_time)}.")
+        self.job_planner.save()
+        recovery_statistics = self.recovery_policy.statistics()
+        if recovery_statistics:
+            self.logger.print(f"Charge calculator: recovery policy {self.recovery_policy.name}, {recovery_statistics}.")
+        if any(exceeded_limits_counts.values()):
+            self.logger.print(f"Charge calculator: {exceeded_limits_counts['time']} xtb calculations exceeded the time limit, "
+                              f"{exceeded_limits_counts['memory']} exceeded the memory limit.")
+        if self.fragment_core_radius and substructures_atoms_counts:
+            self.logger.print(f"Charge calculator: fragments with core radius {self.fragment_core_radius} A, "
+                              f"{len(fragments)} substructures instead of {calculated_atoms_count} per-atom substructures "
+                              f"({calculated_atoms_count / len(fragments):.1f}x fewer), "
+                              f"median substructure {int(np.median(substructures_atoms_counts))} atoms.")
+
+    def estimate_jobs(self,
+                      job_pool: JobPool):
+        """
+        Constructs the substructures of all charge jobs without running xtb (dry run).
+        Substructures which would be recalculated by the recovery policy are not included.
+
+        :param job_pool: JobPool sizing the jobs, no job is run
+        :return: list of dictionaries with number of atoms (atoms_count), size for the cost model (size),
+                 estimated bytes of files written by xtb (scratch_bytes), threads and memory of each job
+        """
+        _, _, _, fragments = self.load_structure()
+        central_atom_indices = [central_atom_i for central_atom_i, _ in fragments]
+        sizes = self.substructure_sizes(centers=[self.structure_atoms[central_atom_i].coord for central_atom_i in central_atom_indices],
+                                        radii=9 + self.fragment_core_radius)
+        jobs = []
+        for central_atom_i, size in zip(central_atom_indices, sizes):
+            _, _, job = self.create_substructure_job(central_atom_i=central_atom_i,
+                                                     job_pool=job_pool)
+            jobs.append({"atoms_count": job["atoms_count"],
+                         "size": size,
+                         "scratch_bytes": job["scratch_bytes"],
+                         "threads": job["threads"],
+                         "memory": job["memory"]})
+        return jobs
+
+    def plan_fragments(self,
+                       calculated_atom_indices: list):
+        """
+        Plans substructures so that each calculated atom is closer than fragment_core_radius to the central atom
+        of some substructure. Central atoms are chosen from calculated atoms by greedy set cover
+        and each calculated atom is assigned to the nearest central atom.
+        Hydrogens and terminal oxygens closer than 1.5 angstroms to the calculated atom are assigned together with it.
 
+        :return: list of tuples (index of central atom, indices of atoms whose charges are taken from the substructure)
+        """
+        structure_atoms = self.structure_atoms
+        calculated_atoms_coords = [structure_atoms[atom_i].coord for atom_i in calculated_atom_indices]
+
+        # greedy set cover, the atom whose sphere with fragment_core_radius covers the most uncovered calculated atoms
+        # is chosen as the next central atom, the numbers of covered atoms are updated lazily
+        calculated_atom_indices_set = set(calculated_atom_indices)
+        covers = [set(near_atom_indices.tolist()) & calculated_atom_indices_set
+                  for near_atom_indices in self.spatial_index.search_batch_indices(centers=calculated_atoms_coords,
+                                                                                   radii=self.fragment_core_radius)]
+        heap = [(-len(cover), position) for position, cover in enumerate(covers)]
+        heapq.heapify(heap)
+        central_atom_indices = []
+        uncovered_atom_indices = set(calculated_atom_indices)
+        while uncovered_atom_indices:
+            negative_cover_size, position = heapq.heappop(heap)
+            cover = covers[position] & uncovered_atom_indices
+            if len(cover) < -negative_cover_size:
+                covers[position] = cover
+                heapq.heappush(heap, (-len(cover), position))
+                continue
+            central_atom_indices.append(calculated_atom_indices[position])
+            uncovered_atom_indices -= cover
+        central_atom_indices.sort()
+
+        # assign each calculated atom to the nearest central atom
+        _, nearest_central_atom_positions = cKDTree([structure_atoms[atom_i].coord for atom_i in central_atom_indices]).query(calculated_atoms_coords)
+        fragments_calculated_atom_indices = [[] for _ in central_atom_indices]
+        for atom_i, near_atom_indices, central_atom_position in zip(calculated_atom_indices,
+                                                                    self.spatial_index.search_batch_indices(centers=calculated_atoms_coords,
+                                                                                                            radii=1.5),
+                                                                    nearest_central_atom_positions):
+            fragment_calculated_atom_indices = fragments_calculated_atom_indices[central_atom_position]
+            fragment_calculated_atom_indices.append(atom_i)
+            fragment_calculated_atom_indices.extend(near_atom_i for near_atom_i in near_atom_indices.tolist()
+                                                    if structure_atoms[near_atom_i].element == "H" or near_atom_i in self.terminal_oxygen_indices)
+        return list(zip(central_atom_indices, fragments_calculated_atom_indices))
+
+    def journal_hash(self,
+                     fragments: list):
+        """
+        :return: hash of everything the journaled charges depend on, the plan of substructures, the input structure,
+                 the estimation of charges, the method of xtb engine with its limits and the recovery policy
+        """
+        journal_hash = hashlib.sha256(repr(fragments).encode())
+        for file in [f"{self.data_dir}/{self.output_mmCIF_file}", self.charges_estimation]:
+            with open(file, "rb") as file_handle:
+                journal_hash.update(file_handle.read())
+        journal_hash.update(repr((self.xtb_engine.charges_method,
+                                  self.xtb_engine.charges_label,
+                                  getattr(self.xtb_engine, "time_limit", None),
+                                  getattr(self.xtb_engine, "memory_limit", None),
+                                  self.recovery_policy.name)).encode())
+        return journal_hash.hexdigest()
+
+    def write_journal_header(self,
+                             fragments: list):
+        """
+        Starts a new journal. The journal is valid only for the same calculation, so its hash (see method journal_hash) is stored in the header.
+        """
+        with open(self.journal_file, "w") as journal_file:
+            journal_file.write(f"plan {self.journal_hash(fragments)}\n")
+
+    @staticmethod
+    def journal_line(central_atom_i: int,
+                     substructure_charges: list,
+                     exceeded_limit: str = None):
+        """
+        :param substructure_charges: list of tuples (index of atom, calculated charge), empty if the calculation failed
+        :param exceeded_limit: "time" or "memory" if the calculation was killed by the supervisor of xtb, otherwise None
+        :return: line of the journal with the results of one substructure
+        """
+        if exceeded_limit:
+            return f"{central_atom_i} limit {exceeded_limit}\n"
+        return f"{central_atom_i}{''.join(f' {atom_i} {charge!r}' for atom_i, charge in substructure_charges)}\n"
+
+    def read_journal(self,
+                     fragments: list):
+        """
+        Reads charges of substructures calculated by the previous interrupted run.
+        Incomplete last line is ignored, the whole journal is ignored if the calculation was changed (see method journal_hash).
+
+        :return: dictionary {index of central atom: list of tuples (index of atom, calculated charge)}
+                 and dictionary {index of central atom: exceeded limit} of substructures killed by the supervisor of xtb,
+                 whose warnings are added again
+        """
+        journaled_substructures_charges = {}
+        journaled_exceeded_limits = {}
+        if not path.isfile(self.journal_file):
+            return journaled_substructures_charges, journaled_exceeded_limits
+        with open(self.journal_file) as journal_file:
+            journal_lines = journal_file.readlines()
+        if not journal_lines:
+            return journaled_substructures_charges, journaled_exceeded_limits
+        if journal_lines[0] != f"plan {self.journal_hash(fragments)}\n":
+            self.logger.print("Journal of charges is not used, it was written by a different calculation.")
+            return journaled_substructures_charges, journaled_exceeded_limits
+        for line in journal_lines[1:]:
+            if not line.endswith("\n"):
+                break
+            central_atom_i, *substructure_charges = line.split()
+            if substructure_charges[:1] == ["limit"]:
+                journaled_exceeded_limits[int(central_atom_i)] = substructure_charges[1]
+                substructure_charges = []
+            journaled_substructures_charges[int(central_atom_i)] = [(int(atom_i), float(charge))
+                                                                    for atom_i, charge in zip(substructure_charges[::2], substructure_charges[1::2])]
+        # journal is rewritten without the incomplete line, new results are appended to it
+        self.write_journal_header(fragments)
+        with open(self.journal_file, "a") as journal_file:
+            for central_atom_i, substructure_charges in journaled_substructures_charges.items():
+                journal_file.write(self.journal_line(central_atom_i, substructure_charges, journaled_exceeded_limits.get(central_atom_i)))
+        return journaled_substructures_charges, journaled_exceeded_limits
+
+    def record_exceeded_limit(self,
+                              central_atom_i: int,
+                              exceeded_limit: str,
+                              exceeded_limits_counts: dict):
+        """
+        Counts the calculation killed by the supervisor of xtb and adds the warning to the residue of the central atom.
+        """
+        exceeded_limits_counts[exceeded_limit] += 1
+        central_atom = self.structure_atoms[central_atom_i]
+        residue = central_atom.get_parent()
+        self.logger.add_warning(chain=residue.get_parent().id,
+                                resnum=residue.id[1],
+                                resname=residue.resname,
+                                warning=f"Calculation of substructure around atom {central_atom.name} exceeded the {exceeded_limit} limit of xtb.")
+
+    def create_substructure_job(self,
+                                central_atom_i: int,
+                                job_pool: JobPool,
+                                attempt: dict = INITIAL_ATTEMPT):
+        """
+        Constructs the substructure around the atom with index central_atom_i in the list of structure atoms sorted by serial numbers.
+
+        :param job_pool: JobPool sizing the job by the substructure
+        :param attempt: attempt of recovery policy with increment of radii (radii_increment) and settings of SCC (scc)
+                        for repeated calculations of substructures which did not converge
+        :return: indices of substructure atoms in the order of xtb input, key of xtb cache, job for function calculate_substructure_charges
+        """
+
+        # definition of radii limiting the substructure
+        # all atoms that are closer to the central atom than min_radius are included in the substructure
+        # atoms more distant from the central atom than max_radius are never included in the substructure
+        # both radii are enlarged by fragment_core_radius, so that all calculated atoms are deep enough in the substructure
+        min_radius = 6 + self.fragment_core_radius + attempt["radii_increment"]
+        max_radius = 12 + self.fragment_core_radius + attempt["radii_increment"]
+
+        # create a substructure that will have only C-C bonds broken and add hydrogens to broken C-C bonds
+        substructure_atom_indices, broken_carbon_bonds = self.substructure_builder.build(central_atom_i=central_atom_i,
+                                                                                           min_radius=min_radius,
+                                                                                           max_radius=max_radius)
+        repaired_substructure_atoms = self.substructure_builder.repaired_substructure_atoms(substructure_atom_indices=substructure_atom_indices,
+                                                                                            broken_carbon_bonds=broken_carbon_bonds)
+        substructure_charge = round(sum([self.structure_atoms[atom_i].charge_estimation for atom_i in substructure_atom_indices]))
+        if self.xtb_cache:
+            cache_key = self.xtb_cache.key(elements=[element for _, _, element, _ in repaired_substructure_atoms],
+                                           coords=[coord for _, _, _, coord in repaired_substructure_atoms],
+                                           charge=substructure_charge,
+                                           method=f"{self.xtb_engine.charges_method} {attempt['scc']}" if attempt["scc"] else self.xtb_engine.charges_method)
+        else:
+            cache_key = None
+        # attempts of one stage run concurrently, so each attempt has its own directory
+        substructure_directory = f"sub_{central_atom_i + 1}" if attempt["name"] == INITIAL_ATTEMPT["name"] else f"sub_{central_atom_i + 1}_{attempt['name']}"
+        job = {"data_dir": f"{self.data_dir}/{substructure_directory}",
+               "pdb": self.substructure_builder.pdb_block(repaired_substructure_atoms),
+               "charge": substructure_charge,
+               "atoms_count": len(repaired_substructure_atoms),
+               "scc": attempt["scc"],
+               **job_pool.allocate(atoms_count=len(repaired_substructure_atoms),
+                                   memory_per_atom_pair=self.xtb_engine.charges_memory_per_atom_pair),
+               "delete_auxiliary_files": self.delete_auxiliary_files,
+               "engine": self.xtb_engine}
+        job["scratch_bytes"] = len(job["pdb"]) + self.xtb_engine.charges_scratch_bytes_per_atom * job["atoms_count"]
+        job.update(self.scratch.job_settings(job["scratch_bytes"]) if self.scratch else {"scratch_dir": None})
+        return substructure_atom_indices, cache_key, job
+
+    def calculate_substructures(self,
+                                job_pool: JobPool,
+                                central_atom_indices: list,
+                                attempts: list):
+        """
+        Calculates charges of substructures constructed around the atoms with indices central_atom_indices.
+        Substructures are constructed lazily in this process and the charges are taken from the xtb cache
+        or calculated by job pool. Jobs are submitted longest first by the job planner.
+        All attempts of each substructure run concurrently and the result of the first successful attempt
+        (in the order of attempts) is taken.
+
+        :param attempts: attempts of one stage of recovery policy
+        :return: generator of tuples (index of central atom, indices of substructure atoms,
+                 CM5 charges of substructure atoms or None if no xtb calculation converged,
+                 exceeded limit "time" or "memory" if no xtb calculation converged and some was killed, otherwise None)
+                 in the order of completion of substructures
+        """
+        method = self.xtb_engine.charges_method
+        attempts_keys = [(central_atom_i, attempt_position) for central_atom_i in central_atom_indices for attempt_position in range(len(attempts))]
+        centers = [self.structure_atoms[central_atom_i].coord for central_atom_i, _ in attempts_keys]
+        # size of the substructure is estimated from the atoms of the sphere between min_radius and max_radius
+        radii = [9 + self.fragment_core_radius + attempts[attempt_position]["radii_increment"] for _, attempt_position in attempts_keys]
+        sizes = dict(zip(attempts_keys, self.substructure_sizes(centers, radii)))
+        attempts_keys = self.job_planner.plan(method=method,
+                                              keys=attempts_keys,
+                                              sizes=[sizes[attempt_key] for attempt_key in attempts_keys],
+                                              workers=job_pool.workers)
+        substructures = {}
+
+        def jobs():
+            for central_atom_i, attempt_position in attempts_keys:
+                construction_start = time()
+                substructure_atom_indices, cache_key, job = self.create_substructure_job(central_atom_i=central_atom_i,
+                                                                                         job_pool=job_pool,
+                                                                                         attempt=attempts[attempt_position])
+                cached_cm5_charges = self.xtb_cache.get(cache_key) if self.xtb_cache else None
+                substructures[central_atom_i, attempt_position] = (substructure_atom_indices, cache_key, cached_cm5_charges,
+                                                                   job, construction_start, time() - construction_start)
+                yield job if cached_cm5_charges is None else None
+
+        attempts_results = {}
+        for (central_atom_i, attempt_position), result in zip(attempts_keys, job_pool.map(calculate_substructure_charges, jobs())):
+            substructure_atom_indices, cache_key, cached_cm5_charges, job, construction_start, construction_time = substructures.pop((central_atom_i, attempt_position))
+            if self.scratch:
+                self.scratch.release(job)
+            cm5_charges, job_report = result if result is not None else (None, None)
+            if job_report:
+                self.job_planner.record(method, sizes[central_atom_i, attempt_position], job_report["seconds"])
+            if cached_cm5_charges is not None:
+                cm5_charges = cached_cm5_charges
+            elif cm5_charges is not None and self.xtb_cache:
+                self.xtb_cache.put(cache_key, cm5_charges)
+            if self.tracer:
+                self.tracer.add_xtb_job(name=f"atom {central_atom_i + 1}",
+                                        category="charge_calculator",
+                                        atoms_count=job["atoms_count"],
+                                        attempt=attempts[attempt_position]["name"],
+                                        construction_start=construction_start,
+                                        construction_time=construction_time,
+                                        job_report=job_report,
+                                        status=xtb_job_status(cm5_charges, job_report),
+                                        scratch_bytes=job["scratch_bytes"])
+            self.recovery_policy.record(attempts[attempt_position], cm5_charges is not None)
+            attempt_results = attempts_results.setdefault(central_atom_i, [None] * len(attempts))
+            attempt_results[attempt_position] = (substructure_atom_indices, cm5_charges, job_report["exceeded_limit"] if job_report else None)
+            if None in attempt_results:
+                continue
+            del attempts_results[central_atom_i]
+            successful_results = [attempt_result for attempt_result in attempt_results if attempt_result[1] is not None]
+            if successful_results:
+                substructure_atom_indices, cm5_charges, _ = successful_results[0]
+                yield central_atom_i, substructure_atom_indices, cm5_charges, None
+            else:
+                exceeded_limits = [exceeded_limit for _, _, exceeded_limit in attempt_results if exceeded_limit]
+                yield central_atom_i, attempt_results[-1][0], None, exceeded_limits[0] if exceeded_limits else None
+
+    def substructure_sizes(self,
+                           centers: list,
+                           radii: list):
+        """
+        :return: sums of element weights (see phases/job_planner.py) of atoms closer to the centers than radii
+        """
+        return [float(self.element_weights[atom_indices].sum()) for atom_indices in self.spatial_index.search_batch_indices(centers=centers,
+                                                                                                                              radii=radii)]
 
     def write_charges_to_files(self):
         self.logger.print("Writing charges to files... ", end="")
@@ -285,7 +574,7 @@ class ChargeCalculator:
                                         sb_ncbr_partial_atomic_charges_meta_attributes)
         metadata_loop.add_row(['1',
                                "'QM'",
-                               "'GFN1-xTB/CM5 (with cutoff)'"])
+                               f"'{self.xtb_engine.charges_label}'"])
         sb_ncbr_partial_atomic_charges_prefix = "_sb_ncbr_partial_atomic_charges."
         sb_ncbr_partial_atomic_charges_attributes = ["type_id",
                                                      "atom_id",
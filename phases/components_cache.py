@@ -0,0 +1,79 @@
+import hashlib
+import pickle
+from importlib.metadata import version, PackageNotFoundError
+from os import getpid, makedirs, replace
+
+import rdkit
+from rdkit import Chem
+
+
+def _tool_versions():
+    """
+    :return: versions of the libraries that influence the protonation of components
+    """
+    try:
+        dimorphite_version = version("dimorphite_dl")
+    except PackageNotFoundError:
+        dimorphite_version = "unknown"
+    return f"rdkit {rdkit.__version__} dimorphite_dl {dimorphite_version}"
+
+
+class ComponentsCache:
+    """
+    Persistent cache of components from Chemical Component Dictionary protonated by Dimorphite-DL.
+
+    Each component is stored in its own file named by the hash of the component ID, its CCD record, pH
+    and versions of RDKit and Dimorphite-DL, so a changed CCD file or updated library never returns stale molecules.
+    Molecules are stored with all atom properties (e.g. ChargedByDimorphite) together with the warning of their processing.
+    """
+    def __init__(self,
+                 directory: str):
+        """
+        :param directory: directory where the components are stored, it is created if it does not exist
+        """
+        self.directory = directory
+        makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(component_id: str,
+            CCD_record: str,
+            pH: float):
+        """
+        :param component_id: ID of the component in CCD
+        :param CCD_record: record of the component in SDF format
+        :param pH: pH used for the protonation by Dimorphite-DL
+        :return: hexadecimal hash of the inputs of the protonation
+        """
+        CCD_record_hash = hashlib.sha256(CCD_record.encode()).hexdigest()
+        content = "\n".join([component_id, CCD_record_hash, f"{pH}", _tool_versions()])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _file(self,
+              key: str):
+        return f"{self.directory}/{key}.pkl"
+
+    def get(self,
+            key: str):
+        """
+        :return: stored tuple (molecule or None, warning or None) or None if the component is not in the cache
+        """
+        try:
+            with open(self._file(key), "rb") as component_file:
+                binary_mol, warning = pickle.load(component_file)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return Chem.Mol(binary_mol) if binary_mol is not None else None, warning
+
+    def put(self,
+            key: str,
+            mol,
+            warning: str):
+        """
+        Stores the molecule and its warning. The file is written atomically, so processes sharing the cache never read incomplete files.
+        """
+        binary_mol = mol.ToBinary(Chem.PropertyPickleOptions.AllProps) if mol is not None else None
+        file = self._file(key)
+        temporary_file = f"{file}.{getpid()}.tmp"
+        with open(temporary_file, "wb") as component_file:
+            pickle.dump((binary_mol, warning), component_file)
+        replace(temporary_file, file)
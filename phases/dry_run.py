@@ -0,0 +1,66 @@
+import json
+
+import numpy as np
+
+from phases.job_planner import JobPlanner
+
+# width of bins of the histogram of substructure sizes in atoms
+HISTOGRAM_BIN_WIDTH = 100
+
+
+def summarise_jobs(jobs: list,
+                   method: str,
+                   job_planner: JobPlanner,
+                   workers: int):
+    """
+    :param jobs: jobs of one phase estimated by its method estimate_jobs
+    :param method: xtb method of the jobs, the key of the cost model
+    :return: dictionary with the number of jobs, histogram of numbers of substructure atoms,
+             predicted CPU-hours and wall hours, and peak bytes of files written by concurrent jobs
+    """
+    job_planner.reset_statistics()
+    job_planner.plan(method=method,
+                     keys=list(range(len(jobs))),
+                     sizes=[job["size"] for job in jobs],
+                     workers=workers)
+    atoms_counts = np.array([job["atoms_count"] for job in jobs], dtype=int)
+    bins_count = int(atoms_counts.max()) // HISTOGRAM_BIN_WIDTH + 1 if len(jobs) else 0
+    histogram = np.bincount(atoms_counts // HISTOGRAM_BIN_WIDTH, minlength=bins_count) if len(jobs) else []
+    scratch_bytes = sorted((job["scratch_bytes"] for job in jobs), reverse=True)
+    return {"jobs": len(jobs),
+            "atoms_histogram": {f"{bin_i * HISTOGRAM_BIN_WIDTH}-{(bin_i + 1) * HISTOGRAM_BIN_WIDTH - 1}": int(count)
+                                for bin_i, count in enumerate(histogram) if count},
+            "cpu_hours": job_planner.predicted_time / 3600,
+            "wall_hours": job_planner.predicted_makespan / 3600,
+            "peak_scratch_bytes": sum(scratch_bytes[:workers]),
+            "total_scratch_bytes": sum(scratch_bytes),
+            "max_memory_bytes": max((job["memory"] for job in jobs), default=0)}
+
+
+def report_estimate(logger,
+                    phases_summaries: dict,
+                    delete_auxiliary_files: bool,
+                    estimate_file: str):
+    """
+    Prints the estimate of the calculation and stores it in json file.
+
+    :param phases_summaries: dictionary {name of phase: summary of its jobs (see function summarise_jobs)}
+    :param delete_auxiliary_files: files of finished jobs are deleted, so they do not accumulate in data_dir
+    """
+    logger.print("\nESTIMATE OF CALCULATION")
+    for phase_name, summary in phases_summaries.items():
+        logger.print(f"{phase_name}: {summary['jobs']} xtb jobs, predicted {summary['cpu_hours']:.2f} CPU-hours "
+                     f"({summary['wall_hours']:.2f} hours of wall time), largest job needs {summary['max_memory_bytes'] / 1024 ** 2:.0f} MB of memory.")
+        if summary["jobs"]:
+            logger.print(f"Numbers of atoms of substructures: "
+                         f"{', '.join(f'{atoms_range}: {count}' for atoms_range, count in summary['atoms_histogram'].items())}")
+    peak_scratch_bytes = max((summary["peak_scratch_bytes"] for summary in phases_summaries.values()), default=0)
+    logger.print(f"Total: predicted {sum(summary['cpu_hours'] for summary in phases_summaries.values()):.2f} CPU-hours "
+                 f"({sum(summary['wall_hours'] for summary in phases_summaries.values()):.2f} hours of wall time), "
+                 f"peak scratch {peak_scratch_bytes / 1024 ** 2:.1f} MB.")
+    if not delete_auxiliary_files:
+        logger.print(f"Auxiliary files of xtb jobs will take {sum(summary['total_scratch_bytes'] for summary in phases_summaries.values()) / 1024 ** 2:.1f} MB "
+                     f"in data directory (none with --delete_auxiliary_files).")
+    logger.print("Retries of substructures which do not converge and results in xtb cache are not included.")
+    with open(estimate_file, "w") as estimate_file_handle:
+        json.dump(phases_summaries, estimate_file_handle, indent=4)
@@ -1,17 +1,39 @@
-from Bio.PDB import Select, PDBIO, MMCIFIO, MMCIFParser, Superimposer, NeighborSearch, PDBParser
-from os import system, path
+from Bio.PDB import MMCIFIO, MMCIFParser
+from Bio.SVDSuperimposer import SVDSuperimposer
+from os import getpid, system
 from math import dist
-from rdkit import Chem
+from time import perf_counter, time
+import numpy as np
 import tqdm
 
+from phases.job_planner import JobPlanner, element_weight
+from phases.job_pool import JobPool
+from phases.scratch import working_directory
+from phases.spatial_index import SpatialIndex
+from phases.substructure_builder import SubstructureBuilder
+from phases.tracer import Tracer, xtb_job_status
+from phases.xtb_engine import SubprocessXtbEngine, XtbLimitExceeded
 
-class AtomSelector(Select):
+def optimise_substructure(job: dict):
     """
-    Support class for Biopython.
-    After initialization, a set with all full ids of the atoms to be written into the substructure must be stored in self.full_ids.
+    Optimises hydrogens of one substructure by the xtb engine of the job. The function is run by JobPool in worker processes,
+    so the job contains everything needed for the optimisation (see SubprocessXtbEngine.optimise).
+
+    :return: tuple (list of optimised coordinates of substructure atoms or None if the optimisation failed,
+             report of the job with exceeded limit "time" or "memory" if the xtb calculation was killed by the supervisor
+             or None (exceeded_limit), start of the optimisation (start), its time in seconds (seconds)
+             and ID of the process which ran the job (process_id))
     """
-    def accept_atom(self, atom):
-        return int(atom.full_id in self.full_ids)
+    start, start_time = perf_counter(), time()
+    with working_directory(job) as working_job:
+        try:
+            optimised_coords, exceeded_limit = job["engine"].optimise(working_job), None
+        except XtbLimitExceeded as limit_exceeded:
+            optimised_coords, exceeded_limit = None, limit_exceeded.limit
+    return optimised_coords, {"exceeded_limit": exceeded_limit,
+                              "start": start_time,
+                              "seconds": perf_counter() - start,
+                              "process_id": getpid()}
 
 
 class HydrogenOptimiser:
@@ -25,13 +47,27 @@ class HydrogenOptimiser:
                  logger,
                  output_mmCIF_file: str,
                  data_dir: str,
-                 delete_auxiliary_files: bool):
+                 delete_auxiliary_files: bool,
+                 workers: int = 1,
+                 xtb_cache=None,
+                 job_pool: JobPool = None,
+                 xtb_engine=None,
+                 scratch=None,
+                 job_planner: JobPlanner = None,
+                 tracer: Tracer = None):
         """
         :param input_mmCIF_file: PDB file containing the structure which should be prepared
         :param logger: loger of workflow to unify outputs
         :param data_dir: directory where the results will be stored
         :param output_mmCIF_file: mmCIF file in which prepared structure will be stored
         :param delete_auxiliary_files: auxiliary files created during the preraparation will be deleted
+        :param workers: number of processes optimising substructures concurrently, it is ignored if job_pool is given
+        :param xtb_cache: XtbCache with results of previous xtb calculations, None disables caching
+        :param job_pool: JobPool shared with other phases or structures, by default the hydrogen optimiser has its own pool
+        :param xtb_engine: engine optimising substructures (see phases/xtb_engine.py), by default the xtb program
+        :param scratch: ScratchManager with fast working directories for xtb jobs, by default the jobs run in data_dir
+        :param job_planner: JobPlanner ordering the jobs longest first, by default with the cost model of this run only
+        :param tracer: Tracer recording xtb jobs, None disables tracing
         """
         self.logger = logger
         self.logger.print("\nHYDROGEN OPTIMISER")
@@ -41,32 +77,116 @@ class HydrogenOptimiser:
         self.data_dir = data_dir
         system(f"mkdir {self.data_dir}")
         self.delete_auxiliary_files = delete_auxiliary_files
+        self.workers = workers
+        self.job_pool = job_pool
+        self.xtb_engine = xtb_engine if xtb_engine else SubprocessXtbEngine()
+        self.scratch = scratch
+        self.job_planner = job_planner if job_planner else JobPlanner()
+        self.tracer = tracer
+        self.xtb_cache = xtb_cache
         self.logger.print("ok")
 
-    def optimise(self):
+    def load_structure(self):
+        """
+        Loads the structure and prepares the construction of substructures.
+
+        :return: indices of central atoms of substructures
+        """
 
         # load structure by Biopython
         self.logger.print("Loading structure... ", end="")
         structure = MMCIFParser(QUIET=True).get_structure(structure_id="structure",
                                                           filename=self.input_mmCIF_file)
-        io = PDBIO()
-        io.set_structure(structure)
-        self.io = io
-        self.structure = io.structure[0]
-        self.selector = AtomSelector()
+        self.structure = structure[0]
         self.logger.print("ok")
 
-        self.logger.print("Optimisation of hydrogens... ", end="", silence=True)
-        for atom in tqdm.tqdm(list(self.structure.get_atoms()),
-                              desc="Hydrogen optimisation",
-                              unit="atoms",
-                              smoothing=0,
-                              delay=0.1,
-                              mininterval=0.4,
-                              maxinterval=0.4):
-            if atom.element == "H":
+        self.structure_atoms = list(self.structure.get_atoms())
+        self.spatial_index = SpatialIndex(self.structure_atoms)
+        self.substructure_builder = SubstructureBuilder(atoms=self.structure_atoms,
+                                                        spatial_index=self.spatial_index)
+        return [atom_i for atom_i, atom in enumerate(self.structure_atoms) if atom.element != "H"]
+
+    def estimate_jobs(self,
+                      job_pool: JobPool):
+        """
+        Constructs the substructures of all optimisation jobs without running xtb (dry run).
+
+        :param job_pool: JobPool sizing the jobs, no job is run
+        :return: list of dictionaries with number of atoms (atoms_count), size for the cost model (size),
+                 estimated bytes of files written by xtb (scratch_bytes), threads and memory of each job
+        """
+        central_atom_indices = self.load_structure()
+        sizes = self.substructure_sizes(central_atom_indices)
+        jobs = []
+        for central_atom_i in central_atom_indices:
+            substructure, job = self.create_substructure_job(central_atom_i, job_pool)
+            if substructure is None:
                 continue
-            self.optimise_atom(atom)
+            jobs.append({"atoms_count": job["atoms_count"],
+                         "size": sizes[central_atom_i],
+                         "scratch_bytes": job["scratch_bytes"],
+                         "threads": job["threads"],
+                         "memory": job["memory"]})
+        return jobs
+
+    def optimise(self):
+        central_atom_indices = self.load_structure()
+
+        self.logger.print("Optimisation of hydrogens... ", end="", silence=True)
+        if self.xtb_cache:
+            self.xtb_cache.reset_statistics()
+        self.exceeded_limits_counts = {"time": 0, "memory": 0}
+        self.job_planner.reset_statistics()
+        optimisation_start = perf_counter()
+        progress_bar = tqdm.tqdm(total=len(central_atom_indices),
+                                 desc="Hydrogen optimisation",
+                                 unit="atoms",
+                                 smoothing=0,
+                                 delay=0.1,
+                                 mininterval=0.4,
+                                 maxinterval=0.4)
+        job_pool = self.job_pool if self.job_pool else JobPool(workers=self.workers)
+        self.sizes = self.substructure_sizes(central_atom_indices)
+        planned_central_atom_indices = self.job_planner.plan(method=self.xtb_engine.optimisation_method,
+                                                             keys=central_atom_indices,
+                                                             sizes=[self.sizes[central_atom_i] for central_atom_i in central_atom_indices],
+                                                             workers=job_pool.workers)
+        if job_pool.workers > 1:
+            # all substructures are optimised with the original positions of hydrogens (longest first by the job planner)
+            # hydrogen can be optimised in more substructures, we keep the position from the substructure
+            # whose central atom is the nearest to the hydrogen (ties are resolved by the order of atoms)
+            optimised_hydrogens = {}
+            for central_atom_i, substructure_hydrogens in self.optimise_substructures(job_pool=job_pool,
+                                                                                      central_atom_indices=planned_central_atom_indices):
+                central_atom = self.structure_atoms[central_atom_i]
+                for hydrogen_i, coord in substructure_hydrogens:
+                    hydrogen = self.structure_atoms[hydrogen_i]
+                    if coord is None:
+                        hydrogen.optimised = False
+                        continue
+                    distance = dist(hydrogen.coord, central_atom.coord)
+                    if hydrogen_i not in optimised_hydrogens or (distance, central_atom_i) < optimised_hydrogens[hydrogen_i][:2]:
+                        optimised_hydrogens[hydrogen_i] = (distance, central_atom_i, coord)
+                progress_bar.update()
+            for hydrogen_i, (_, _, coord) in optimised_hydrogens.items():
+                self.structure_atoms[hydrogen_i].coord = coord
+        else:
+            # every substructure is optimised with the positions of hydrogens from the previous optimisations,
+            # so the substructures are optimised in the order of atoms and not by the job planner
+            for central_atom_i in central_atom_indices:
+                moved_hydrogen_indices = []
+                for hydrogen_i, coord in self.optimise_atom(central_atom_i, job_pool):
+                    if coord is None:
+                        self.structure_atoms[hydrogen_i].optimised = False
+                    else:
+                        self.structure_atoms[hydrogen_i].coord = coord
+                        moved_hydrogen_indices.append(hydrogen_i)
+                self.spatial_index.update(moved_hydrogen_indices)
+                progress_bar.update()
+        optimisation_time = perf_counter() - optimisation_start
+        if not self.job_pool:
+            job_pool.shutdown()
+        progress_bar.close()
 
         # write logs
         for residue in self.structure.get_residues():
@@ -84,6 +204,14 @@ class HydrogenOptimiser:
                                         resname=residue.resname,
                                         warning=warning)
         self.logger.print("ok", silence=True)
+        if self.xtb_cache:
+            self.logger.print(f"Hydrogen optimiser: {self.xtb_cache.statistics()}.")
+            self.xtb_cache.evict()
+        self.logger.print(f"Hydrogen optimiser: {self.job_planner.statistics(optimisation_time)}.")
+        self.job_planner.save()
+        if any(self.exceeded_limits_counts.values()):
+            self.logger.print(f"Hydrogen optimiser: {self.exceeded_limits_counts['time']} xtb optimisations exceeded the time limit, "
+                              f"{self.exceeded_limits_counts['memory']} exceeded the memory limit.")
 
         self.logger.print("Writing structure with optimised hydrogens to file... ", end="")
         self.io = MMCIFIO()
@@ -93,123 +221,40 @@ class HydrogenOptimiser:
             system(f"for au_file in {self.data_dir}/sub_* ; do rm -fr $au_file ; done &")
         self.logger.print("ok")
 
-    def optimise_atom(self,
-                      central_atom):
-
-        # creation of substructure
-        self.kdtree = NeighborSearch(list(self.structure.get_atoms()))
-        substructure_data_dir = f"{self.data_dir}/sub_{central_atom.serial_number}"
-        system(f"mkdir {substructure_data_dir}")
-        bonded_hydrogens = [atom for atom in self.kdtree.search(center=central_atom.coord,
-                                                                radius=3,
-                                                                level="A") if atom.element == "H"]
-        if not bonded_hydrogens:
-            return
-        bonded_hydrogens_full_ids = (set(atom.full_id for atom in bonded_hydrogens))
-
-        # create and save min_radius and max_radius substructures by biopython
-        atoms_in_6A = self.kdtree.search(center=central_atom.coord,
-                                         radius=6,
-                                         level="A")
-        atoms_in_12A = self.kdtree.search(center=central_atom.coord,
-                                          radius=12,
-                                          level="A")
-        self.selector.full_ids = set([atom.full_id for atom in atoms_in_6A])
-        self.io.save(file=f"{substructure_data_dir}/atoms_in_6A.pdb",
-                     select=self.selector,
-                     preserve_atom_numbering=True)
-        self.selector.full_ids = set([atom.full_id for atom in atoms_in_12A])
-        self.io.save(file=f"{substructure_data_dir}/atoms_in_12A.pdb",
-                     select=self.selector,
-                     preserve_atom_numbering=True)
-
-        # load substructures by RDKit to determine bonds
-        mol_min_radius = Chem.MolFromPDBFile(molFileName=f"{substructure_data_dir}/atoms_in_6A.pdb",
-                                             removeHs=False,
-                                             sanitize=False)
-        mol_min_radius_conformer = mol_min_radius.GetConformer()
-        mol_max_radius = Chem.MolFromPDBFile(molFileName=f"{substructure_data_dir}/atoms_in_12A.pdb",
-                                             removeHs=False,
-                                             sanitize=False)
-        mol_max_radius_conformer = mol_max_radius.GetConformer()
-
-        # dictionaries allow quick and precise matching of atoms from mol_min_radius and mol_max_radius
-        mol_min_radius_coord_dict = {}
-        for i, mol_min_radius_atom in enumerate(mol_min_radius.GetAtoms()):
-            coord = mol_min_radius_conformer.GetAtomPosition(i)
-            mol_min_radius_coord_dict[(coord.x, coord.y, coord.z)] = mol_min_radius_atom
-        mol_max_radius_coord_dict = {}
-        for i, mol_max_radius_atom in enumerate(mol_max_radius.GetAtoms()):
-            coord = mol_max_radius_conformer.GetAtomPosition(i)
-            mol_max_radius_coord_dict[(coord.x, coord.y, coord.z)] = mol_max_radius_atom
-
-        # find atoms from mol_min_radius with broken bonds
-        atoms_with_broken_bonds = []
-        for mol_min_radius_atom in mol_min_radius.GetAtoms():
-            coord = mol_min_radius_conformer.GetAtomPosition(mol_min_radius_atom.GetIdx())
-            mol_max_radius_atom = mol_max_radius_coord_dict[(coord.x, coord.y, coord.z)]
-            if len(mol_min_radius_atom.GetNeighbors()) != len(mol_max_radius_atom.GetNeighbors()):
-                atoms_with_broken_bonds.append(mol_max_radius_atom)
-
-        # create a substructure that will have only C-C bonds broken
-        carbons_with_broken_bonds_coord = []  # hydrogens will be added only to these carbons
-        substructure_coord_dict = mol_min_radius_coord_dict
-        while atoms_with_broken_bonds:
-            atom_with_broken_bonds = atoms_with_broken_bonds.pop(0)
-            bonded_atoms = atom_with_broken_bonds.GetNeighbors()
-            for bonded_atom in bonded_atoms:
-                coord = mol_max_radius_conformer.GetAtomPosition(bonded_atom.GetIdx())
-                if (coord.x, coord.y, coord.z) in substructure_coord_dict:
-                    continue
-                else:
-                    if atom_with_broken_bonds.GetSymbol() == "C" and bonded_atom.GetSymbol() == "C":
-                        carbons_with_broken_bonds_coord.append(
-                            mol_max_radius_conformer.GetAtomPosition(atom_with_broken_bonds.GetIdx()))
-                        continue
-                    else:
-                        atoms_with_broken_bonds.append(bonded_atom)
-                        substructure_coord_dict[(coord.x, coord.y, coord.z)] = bonded_atom
-
-        # create substructure in Biopython library
-        # we prefer to use kdtree because serial_id may be discontinuous in some pdbs files
-        # for example, a structure with PDB code 107d and its serial numbers 218 and 445
-        substructure_atoms = [self.kdtree.search(center=coord,
-                                                 radius=0.1,
-                                                 level="A")[0] for coord in substructure_coord_dict.keys()]
-        self.selector.full_ids = set([atom.full_id for atom in substructure_atoms])
-        self.io.save(file=f"{substructure_data_dir}/substructure.pdb",
-                     select=self.selector,
-                     preserve_atom_numbering=True)
-        substructure = PDBParser(QUIET=True).get_structure(id="structure",
-                                                           file=f"{substructure_data_dir}/substructure.pdb")[0]
-
-        # define constrained atoms
-        constrained_atom_indices = []
-        for atom_index, atom in enumerate(substructure.get_atoms(), start=1):
-            if atom.full_id in bonded_hydrogens_full_ids:
-                continue
-            constrained_atom_indices.append(str(atom_index))
-
-        # add hydrogens to broken C-C bonds by openbabel
-        system(f"cd {substructure_data_dir} ; obabel -iPDB -oPDB substructure.pdb -h > readded_hydrogens_substructure.pdb 2>/dev/null")
-        with open(f"{substructure_data_dir}/readded_hydrogens_substructure.pdb") as readded_hydrogens_substructure_file:
-            atom_lines = [line for line in readded_hydrogens_substructure_file.readlines() if line[:4] in ["ATOM", "HETA"]]
-            original_atoms_lines = atom_lines[:len(substructure_atoms)]
-            added_hydrogens_lines = atom_lines[len(substructure_atoms):]
-        with open(f"{substructure_data_dir}/repaired_substructure.pdb", "w") as repaired_substructure_file:
-            added_hydrogen_indices = []
-            added_hydrogen_indices_counter = len(substructure_atoms) + 1
-            repaired_substructure_file.write("".join(original_atoms_lines))
-            for added_hydrogen_line in added_hydrogens_lines:
-                added_hydrogen_coord = (float(added_hydrogen_line[30:38]),
-                                        float(added_hydrogen_line[38:46]),
-                                        float(added_hydrogen_line[46:54]))
-                if any([dist(added_hydrogen_coord, carbon_coord) < 1.3 for carbon_coord in carbons_with_broken_bonds_coord]):
-                    repaired_substructure_file.write(added_hydrogen_line)
-                    added_hydrogen_indices.append(str(added_hydrogen_indices_counter)) # added hydrogens should be also constrained
-                    added_hydrogen_indices_counter += 1
-
-        # optimise substructure by xtb
+    def create_substructure_job(self,
+                                central_atom_i: int,
+                                job_pool: JobPool):
+        """
+        Constructs the substructure around the atom with index central_atom_i.
+
+        :param job_pool: JobPool sizing the job by the substructure
+        :return: substructure (dictionary with indices of substructure atoms in the order of xtb input,
+                 positions of optimised hydrogens and constrained atoms in the substructure and key of xtb cache)
+                 and job for function optimise_substructure, both are None if there is no hydrogen bonded to the central atom
+        """
+        central_atom = self.structure_atoms[central_atom_i]
+        bonded_hydrogen_indices = [atom_i for atom_i in self.spatial_index.search_indices(center=central_atom.coord,
+                                                                                           radius=3).tolist()
+                                   if self.structure_atoms[atom_i].element == "H"]
+        if not bonded_hydrogen_indices:
+            return None, None
+
+        # create a substructure that will have only C-C bonds broken and add hydrogens to broken C-C bonds
+        substructure_atom_indices, broken_carbon_bonds = self.substructure_builder.build(central_atom_i=central_atom_i,
+                                                                                           min_radius=6,
+                                                                                           max_radius=12)
+        repaired_substructure_atoms = self.substructure_builder.repaired_substructure_atoms(substructure_atom_indices=substructure_atom_indices,
+                                                                                            broken_carbon_bonds=broken_carbon_bonds)
+
+        # define constrained atoms, added hydrogens are written after the substructure atoms and should be also constrained
+        bonded_hydrogen_indices = set(bonded_hydrogen_indices)
+        hydrogen_positions = [atom_position for atom_position, atom_i in enumerate(substructure_atom_indices)
+                              if atom_i in bonded_hydrogen_indices]
+        constrained_atom_positions = [atom_position for atom_position, atom_i in enumerate(substructure_atom_indices)
+                                      if atom_i not in bonded_hydrogen_indices]
+        constrained_atom_indices = [str(atom_position + 1) for atom_position in constrained_atom_positions]
+        added_hydrogen_indices = [str(atom_index) for atom_index in range(len(substructure_atom_indices) + 1,
+                                                                          len(repaired_substructure_atoms) + 1)]
         xtb_settings_template = """$constrain
         atoms: xxx
         force constant=10
@@ -219,37 +264,174 @@ class HydrogenOptimiser:
         $end
         """
         substructure_settings = xtb_settings_template.replace("xxx", ", ".join(constrained_atom_indices + added_hydrogen_indices))
-        with open(f"{substructure_data_dir}/xtb_settings.inp", "w") as xtb_settings_file:
-            xtb_settings_file.write(substructure_settings)
-        run_xtb = (f"cd {substructure_data_dir} ;"
-                   f"ulimit -s unlimited ;"
-                   f"export OMP_NUM_THREADS=1,1 ;"
-                   f"export OMP_MAX_ACTIVE_LEVELS=1 ;"
-                   f"export MKL_NUM_THREADS=1 ;"
-                   f"xtb repaired_substructure.pdb --gfnff --input xtb_settings.inp --opt --gbsa water --verbose > xtb_output.txt 2>&1")
-        # second try by L-ANCOPT
-        if not path.isfile(f"{substructure_data_dir}/xtbopt.pdb"):
-            substructure_settings = open(f"{substructure_data_dir}/xtb_settings.inp", "r").read().replace("rf","lbfgs")
-            with open(f"{substructure_data_dir}/xtb_settings.inp", "w") as xtb_settings_file:
-                xtb_settings_file.write(substructure_settings)
-            system(run_xtb)
-
-        if path.isfile(f"{substructure_data_dir}/xtbopt.pdb"):
-            optimised_substructure = PDBParser(QUIET=True).get_structure(id="structure",
-                                                                         file=f"{substructure_data_dir}/xtbopt.pdb")[0]
-            original_constrained_atoms = []
-            optimised_constrained_atoms = []
-            for atom in substructure.get_atoms():
-                if atom.full_id in bonded_hydrogens_full_ids:
-                    continue
-                original_constrained_atoms.append(atom)
-                optimised_constrained_atoms.append(optimised_substructure[atom.get_parent().get_parent().id][atom.get_parent().id][atom.id])
-            sup = Superimposer()
-            sup.set_atoms(original_constrained_atoms, optimised_constrained_atoms)
-            sup.apply(optimised_substructure.get_atoms())
-            for atom in optimised_substructure.get_atoms():
-                if atom.full_id in bonded_hydrogens_full_ids:
-                    self.structure[atom.get_parent().get_parent().id][atom.get_parent().id][atom.name].coord = atom.coord
+
+        if self.xtb_cache:
+            cache_key = self.xtb_cache.key(elements=[element for _, _, element, _ in repaired_substructure_atoms],
+                                           coords=[coord for _, _, _, coord in repaired_substructure_atoms],
+                                           charge=0,
+                                           method=f"{self.xtb_engine.optimisation_method}\n{substructure_settings}")
         else:
-            for hydrogen in bonded_hydrogens:
-                hydrogen.optimised = False
+            cache_key = None
+        substructure = {"atom_indices": substructure_atom_indices,
+                        "hydrogen_positions": hydrogen_positions,
+                        "constrained_atom_positions": constrained_atom_positions,
+                        "cache_key": cache_key}
+        job = {"data_dir": f"{self.data_dir}/sub_{central_atom.serial_number}",
+               "pdb": self.substructure_builder.pdb_block(repaired_substructure_atoms),
+               "settings": substructure_settings,
+               "atoms_count": len(repaired_substructure_atoms),
+               "constrained_atom_positions": constrained_atom_positions + list(range(len(substructure_atom_indices),
+                                                                                     len(repaired_substructure_atoms))),
+               "delete_auxiliary_files": self.delete_auxiliary_files,
+               "engine": self.xtb_engine,
+               **job_pool.allocate(atoms_count=len(repaired_substructure_atoms),
+                                   memory_per_atom_pair=self.xtb_engine.optimisation_memory_per_atom_pair)}
+        job["scratch_bytes"] = len(job["pdb"]) + len(job["settings"]) + self.xtb_engine.optimisation_scratch_bytes_per_atom * job["atoms_count"]
+        job.update(self.scratch.job_settings(job["scratch_bytes"]) if self.scratch else {"scratch_dir": None})
+        return substructure, job
+
+    def superimpose_hydrogens(self,
+                              substructure: dict,
+                              optimised_coords: list):
+        """
+        Optimised substructure is superimposed on the structure by the constrained atoms.
+
+        :return: list of tuples (index of hydrogen, optimised coordinates),
+                 coordinates are None if the optimisation failed
+        """
+        hydrogen_indices = [substructure["atom_indices"][atom_position] for atom_position in substructure["hydrogen_positions"]]
+        if optimised_coords is None:
+            return [(hydrogen_i, None) for hydrogen_i in hydrogen_indices]
+        optimised_coords = np.array(optimised_coords)
+        constrained_atom_positions = substructure["constrained_atom_positions"]
+        sup = SVDSuperimposer()
+        sup.set(reference_coords=self.spatial_index.coords[substructure["atom_indices"]][constrained_atom_positions],
+                coords=optimised_coords[constrained_atom_positions])
+        sup.run()
+        rotation, translation = sup.get_rotran()
+        optimised_hydrogens_coords = np.dot(optimised_coords[substructure["hydrogen_positions"]], rotation) + translation
+        return [(hydrogen_i, coord.astype("f")) for hydrogen_i, coord in zip(hydrogen_indices, optimised_hydrogens_coords)]
+
+    def substructure_sizes(self,
+                           central_atom_indices: list):
+        """
+        Estimates sizes of substructures by the sums of element weights (see phases/job_planner.py) of atoms
+        of the sphere between min_radius and max_radius. Atoms without bonded hydrogens have no substructure and zero size.
+
+        :return: dictionary {index of central atom: size of its substructure}
+        """
+        element_weights = np.array([element_weight(atom.element) for atom in self.structure_atoms])
+        is_hydrogen = np.array([atom.element == "H" for atom in self.structure_atoms])
+        centers = [self.structure_atoms[central_atom_i].coord for central_atom_i in central_atom_indices]
+        return {central_atom_i: float(element_weights[atom_indices].sum()) if is_hydrogen[near_atom_indices].any() else 0.0
+                for central_atom_i, atom_indices, near_atom_indices in zip(central_atom_indices,
+                                                                           self.spatial_index.search_batch_indices(centers=centers, radii=9),
+                                                                           self.spatial_index.search_batch_indices(centers=centers, radii=3))}
+
+    def record_exceeded_limit(self,
+                              central_atom_i: int,
+                              exceeded_limit: str):
+        """
+        Counts the optimisation killed by the supervisor of xtb and adds the warning to the residue of the central atom.
+        Hydrogens of the substructure are marked as not optimised by the caller.
+        """
+        self.exceeded_limits_counts[exceeded_limit] += 1
+        central_atom = self.structure_atoms[central_atom_i]
+        residue = central_atom.get_parent()
+        self.logger.add_warning(chain=residue.get_parent().id,
+                                resnum=residue.id[1],
+                                resname=residue.resname,
+                                warning=f"Optimisation of substructure around atom {central_atom.name} exceeded the {exceeded_limit} limit of xtb.")
+
+    def trace_job(self,
+                  central_atom_i: int,
+                  job: dict,
+                  construction_start: float,
+                  construction_time: float,
+                  optimised_coords: list,
+                  job_report: dict):
+        """
+        Records the job to the tracer, job_report is None if the optimised coordinates were taken from the cache.
+        """
+        self.tracer.add_xtb_job(name=f"atom {self.structure_atoms[central_atom_i].serial_number}",
+                                category="hydrogen_optimiser",
+                                atoms_count=job["atoms_count"],
+                                attempt="initial",
+                                construction_start=construction_start,
+                                construction_time=construction_time,
+                                job_report=job_report,
+                                status=xtb_job_status(optimised_coords, job_report),
+                                scratch_bytes=job["scratch_bytes"])
+
+    def optimise_atom(self,
+                      central_atom_i: int,
+                      job_pool: JobPool):
+        """
+        Optimises hydrogens in the substructure constructed around the atom with index central_atom_i in this process.
+        The structure itself is not modified.
+
+        :param job_pool: JobPool sizing the job by the substructure, the job itself is not run by the pool
+        :return: list of tuples (index of hydrogen, optimised coordinates),
+                 coordinates are None if the optimisation failed
+        """
+        construction_start = time()
+        substructure, job = self.create_substructure_job(central_atom_i, job_pool)
+        if substructure is None:
+            return []
+        optimised_coords = self.xtb_cache.get(substructure["cache_key"]) if self.xtb_cache else None
+        construction_time = time() - construction_start
+        job_report = None
+        if optimised_coords is None:
+            optimised_coords, job_report = optimise_substructure(job)
+        if self.scratch:
+            self.scratch.release(job)
+        if job_report:
+            self.job_planner.record(self.xtb_engine.optimisation_method, self.sizes[central_atom_i], job_report["seconds"])
+            if job_report["exceeded_limit"]:
+                self.record_exceeded_limit(central_atom_i, job_report["exceeded_limit"])
+            if optimised_coords is not None and self.xtb_cache:
+                self.xtb_cache.put(substructure["cache_key"], optimised_coords)
+        if self.tracer:
+            self.trace_job(central_atom_i, job, construction_start, construction_time, optimised_coords, job_report)
+        return self.superimpose_hydrogens(substructure, optimised_coords)
+
+    def optimise_substructures(self,
+                               job_pool: JobPool,
+                               central_atom_indices: list):
+        """
+        Optimises hydrogens in the substructures constructed around the atoms with indices central_atom_indices.
+        Substructures are constructed lazily in this process and optimised coordinates are taken from the xtb cache
+        or calculated by job pool. The structure itself is not modified.
+
+        :return: generator of tuples (index of central atom, list of tuples (index of hydrogen, optimised coordinates))
+                 in the order of central_atom_indices
+        """
+        substructures = {}
+
+        def jobs():
+            for central_atom_i in central_atom_indices:
+                construction_start = time()
+                substructure, job = self.create_substructure_job(central_atom_i, job_pool)
+                cached_coords = self.xtb_cache.get(substructure["cache_key"]) if self.xtb_cache and substructure else None
+                substructures[central_atom_i] = (substructure, job, cached_coords, construction_start, time() - construction_start)
+                yield job if cached_coords is None else None
+
+        for central_atom_i, result in zip(central_atom_indices, job_pool.map(optimise_substructure, jobs())):
+            substructure, job, cached_coords, construction_start, construction_time = substructures.pop(central_atom_i)
+            if self.scratch and job:
+                self.scratch.release(job)
+            optimised_coords, job_report = result if result is not None else (None, None)
+            if self.tracer and substructure:
+                self.trace_job(central_atom_i, job, construction_start, construction_time, optimised_coords if job_report else cached_coords, job_report)
+            if job_report:
+                self.job_planner.record(self.xtb_engine.optimisation_method, self.sizes[central_atom_i], job_report["seconds"])
+                if job_report["exceeded_limit"]:
+                    self.record_exceeded_limit(central_atom_i, job_report["exceeded_limit"])
+            if substructure is None:
+                yield central_atom_i, []
+                continue
+            if cached_coords is not None:
+                optimised_coords = cached_coords
+            elif optimised_coords is not None and self.xtb_cache:
+                self.xtb_cache.put(substructure["cache_key"], optimised_coords)
+            yield central_atom_i, self.superimpose_hydrogens(substructure, optimised_coords)
@@ -0,0 +1,136 @@
+import heapq
+import json
+from math import exp, log
+from os import getpid, replace
+
+import numpy as np
+
+# weights of elements approximating the number of basis functions of GFN1-xTB (s for hydrogen, s and p for the second period,
+# s, p and d for heavier elements), the cost of xtb job is estimated from the sum of weights of substructure atoms
+SECOND_PERIOD_ELEMENTS = {"LI", "BE", "B", "C", "N", "O", "F", "NE"}
+
+# cost model used until enough xtb times are recorded, seconds = scale * size ** exponent
+PRIOR_SCALE = 1e-7
+PRIOR_EXPONENT = 2.5
+MIN_SAMPLES = 10
+
+
+def element_weight(element: str):
+    element = element.upper()
+    if element in ("H", "HE"):
+        return 1
+    if element in SECOND_PERIOD_ELEMENTS:
+        return 4
+    return 9
+
+
+class JobPlanner:
+    """
+    Orders xtb jobs longest first by the cost model, so the most expensive substructures (e.g. buried ligands or metal sites)
+    do not run last and the makespan of the phase is minimised.
+
+    The cost of the job is estimated from the size of its substructure (sum of element weights of atoms, see function element_weight)
+    by the power law fitted to the xtb times of previous jobs of the same method. Fitted statistics are stored in cost_model_file,
+    so each run improves the model of the next runs. Predicted and actual times are counted until the statistics are reset.
+    """
+    def __init__(self,
+                 cost_model_file: str = None):
+        """
+        :param cost_model_file: json file with statistics of xtb times, it is created if it does not exist,
+                                None means that the times are recorded only in memory
+        """
+        self.cost_model_file = cost_model_file
+        self.cost_model = {}
+        if cost_model_file:
+            try:
+                with open(cost_model_file) as cost_model_file_handle:
+                    self.cost_model = json.load(cost_model_file_handle)
+            except (OSError, ValueError):
+                pass
+        self.reset_statistics()
+
+    def coefficients(self,
+                     method: str):
+        """
+        Fits log(seconds) = log(scale) + exponent * log(size) by least squares.
+
+        :return: scale and exponent of the power law of the method
+        """
+        samples, sum_x, sum_y, sum_xx, sum_xy = self.cost_model.get(method, [0, 0, 0, 0, 0])
+        if samples < MIN_SAMPLES:
+            return PRIOR_SCALE, PRIOR_EXPONENT
+        variance = sum_xx / samples - (sum_x / samples) ** 2
+        exponent = (sum_xy / samples - sum_x * sum_y / samples ** 2) / variance if variance > 1e-6 else PRIOR_EXPONENT
+        return exp((sum_y - exponent * sum_x) / samples), exponent
+
+    def predict(self,
+                method: str,
+                sizes: np.ndarray):
+        """
+        :return: predicted xtb times of jobs in seconds
+        """
+        scale, exponent = self.coefficients(method)
+        return scale * np.asarray(sizes, dtype=float) ** exponent
+
+    def plan(self,
+             method: str,
+             keys: list,
+             sizes: list,
+             workers: int):
+        """
+        Orders the jobs longest first and adds their predicted time and the makespan of longest-first schedule
+        on workers to the statistics.
+
+        :param keys: keys of jobs (e.g. indices of central atoms)
+        :param sizes: sizes of substructures of jobs
+        :return: keys in the order of decreasing predicted time, jobs with equal time keep their order
+        """
+        if not keys:
+            return []
+        predicted_times = self.predict(method, sizes)
+        order = np.argsort(-predicted_times, kind="stable")
+        finish_times = [0.0] * workers
+        for position in order:
+            heapq.heappush(finish_times, heapq.heappop(finish_times) + predicted_times[position])
+        self.predicted_time += float(predicted_times.sum())
+        self.predicted_makespan += max(finish_times)
+        return [keys[position] for position in order]
+
+    def record(self,
+               method: str,
+               size: float,
+               seconds: float):
+        """
+        Adds the xtb time of the job to the statistics and to the cost model.
+        """
+        self.actual_time += seconds
+        if size <= 0 or seconds <= 0:
+            return
+        x, y = log(size), log(seconds)
+        statistics = self.cost_model.setdefault(method, [0, 0, 0, 0, 0])
+        for i, value in enumerate((1, x, y, x * x, x * y)):
+            statistics[i] += value
+
+    def save(self):
+        """
+        Stores the cost model. The file is written atomically, so concurrent processes never read incomplete model.
+        """
+        if not self.cost_model_file:
+            return
+        temporary_file = f"{self.cost_model_file}.{getpid()}.tmp"
+        with open(temporary_file, "w") as cost_model_file:
+            json.dump(self.cost_model, cost_model_file)
+        replace(temporary_file, self.cost_model_file)
+
+    def reset_statistics(self):
+        self.predicted_time = 0
+        self.predicted_makespan = 0
+        self.actual_time = 0
+
+    def statistics(self,
+                   wall_time: float):
+        """
+        :param wall_time: actual wall time of all planned jobs in seconds
+        """
+        return (f"predicted xtb time {self.predicted_time:.1f} s (makespan {self.predicted_makespan:.1f} s), "
+                f"actual xtb time {self.actual_time:.1f} s (makespan {wall_time:.1f} s)")
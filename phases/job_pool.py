@@ -0,0 +1,120 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+# memory of xtb process which does not depend on the size of the substructure in bytes
+XTB_BASE_MEMORY = 100 * 1024 ** 2
+
+
+class JobPool:
+    """
+    Pool of worker processes running independent jobs (e.g. xtb calculations of substructures) of all phases.
+    Jobs must be picklable and the functions running them must be defined at the module level,
+    so one pool can be shared by more phases and more structures and the worker processes are started only once.
+
+    With one worker, the jobs are run directly in the main process.
+
+    If the budget of cores is given, xtb jobs are sized by their substructures (see method allocate),
+    large substructures get more OpenMP threads and small ones are packed one per core.
+    Jobs are admitted only if the threads and estimated memory of all running jobs (keys threads and memory of the job)
+    fit into the budgets of cores and memory, so large substructures cannot exhaust the memory of the node.
+    """
+    def __init__(self,
+                 workers: int = 1,
+                 queued_jobs_per_worker: int = 4,
+                 cores: int = None,
+                 memory: int = None,
+                 atoms_per_thread: int = 250):
+        """
+        :param workers: number of worker processes
+        :param queued_jobs_per_worker: jobs are submitted lazily, at most workers * queued_jobs_per_worker jobs are waiting for results
+        :param cores: budget of cores shared by threads of all running jobs, None means one thread per job without admission control
+        :param memory: budget of memory in bytes shared by all running jobs, None means no admission control by memory
+        :param atoms_per_thread: number of substructure atoms per one thread of xtb job
+        """
+        self.workers = workers
+        self.max_queued_jobs = workers * queued_jobs_per_worker
+        self.cores = cores
+        self.memory = memory
+        self.atoms_per_thread = atoms_per_thread
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=get_context("fork"))
+        else:
+            self.executor = None
+
+    def allocate(self,
+                 atoms_count: int,
+                 memory_per_atom_pair: float):
+        """
+        Sizes xtb job by the number of atoms of its substructure.
+
+        :param atoms_count: number of atoms of the substructure
+        :param memory_per_atom_pair: memory of xtb method per pair of atoms in bytes, the memory grows with the square of atoms count
+        :return: dictionary with number of OpenMP threads (threads) and estimated memory in bytes (memory) of the job
+        """
+        threads = 1 if self.cores is None else min(self.cores, max(1, atoms_count // self.atoms_per_thread))
+        return {"threads": threads,
+                "memory": XTB_BASE_MEMORY + int(memory_per_atom_pair * atoms_count ** 2)}
+
+    def _fits(self,
+              running_jobs: dict,
+              job: dict):
+        """
+        :return: True if the job fits into the budgets together with the running jobs
+        """
+        if self.cores is not None and sum(threads for threads, _ in running_jobs.values()) + job.get("threads", 1) > self.cores:
+            return False
+        if self.memory is not None and sum(memory for _, memory in running_jobs.values()) + job.get("memory", 0) > self.memory:
+            return False
+        return True
+
+    def _admit(self,
+               running_jobs: dict,
+               job: dict):
+        """
+        Waits until the job fits into the budgets. The job is always admitted if no other job is running.
+
+        :param running_jobs: dictionary {future: (threads, memory)} of submitted jobs, finished jobs are removed from it
+        """
+        if self.cores is None and self.memory is None:
+            return
+        while running_jobs:
+            for future in [future for future in running_jobs if future.done()]:
+                del running_jobs[future]
+            if self._fits(running_jobs, job):
+                return
+            wait(running_jobs, return_when=FIRST_COMPLETED)
+
+    def map(self,
+            function,
+            jobs):
+        """
+        Runs function for each job. Jobs are consumed lazily and results are yielded in the order of jobs.
+        Jobs which are None are not run and their results are None.
+        """
+        if not self.executor:
+            for job in jobs:
+                yield None if job is None else function(job)
+            return
+        queued_futures = deque()
+        running_jobs = {}
+        for job in jobs:
+            if job is None:
+                queued_futures.append(None)
+            else:
+                self._admit(running_jobs, job)
+                future = self.executor.submit(function, job)
+                if self.cores is not None or self.memory is not None:
+                    running_jobs[future] = (job.get("threads", 1), job.get("memory", 0))
+                queued_futures.append(future)
+            if len(queued_futures) >= self.max_queued_jobs:
+                future = queued_futures.popleft()
+                yield None if future is None else future.result()
+        while queued_futures:
+            future = queued_futures.popleft()
+            yield None if future is None else future.result()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
@@ -0,0 +1,72 @@
+import cProfile
+import pstats
+from contextlib import contextmanager
+from os import makedirs
+
+# number of functions with the highest own time listed for each profiled step in the report
+TOP_FUNCTIONS = 30
+
+
+def function_name(function: tuple):
+    """
+    :param function: key of pstats statistics (file, line, name)
+    :return: readable name of the function, built-in functions have no file
+    """
+    file, line, name = function
+    if file == "~":
+        return name
+    for prefix in ("site-packages/", "lib/python"):
+        if prefix in file:
+            file = file[file.index(prefix) + len(prefix):]
+            break
+    return f"{file}:{line}({name})"
+
+
+class Profiler:
+    """
+    Profiles steps of the workflow run in the main process by cProfile. Statistics of each step are dumped
+    into its own .prof file (category.name.prof), which can be inspected by pstats or snakeviz, and the functions
+    with the highest own time of all profiled steps are written into the report.
+
+    Only the main process is profiled, calculations run by workers of JobPool (xtb jobs, protonation of residues)
+    appear as the time of waiting for their results.
+    """
+    def __init__(self,
+                 directory: str):
+        """
+        :param directory: directory for .prof files
+        """
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+        self.steps_statistics = []
+
+    @contextmanager
+    def profile(self,
+                name: str,
+                category: str):
+        """
+        Profiles the code run in the context.
+        """
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile_file = f"{self.directory}/{category}.{name}.prof"
+            profile.dump_stats(profile_file)
+            self.steps_statistics.append((category, name, profile_file, pstats.Stats(profile)))
+
+    def report(self):
+        """
+        :return: table of functions with the highest own time for each profiled step
+        """
+        lines = []
+        for category, name, profile_file, statistics in self.steps_statistics:
+            lines.append(f"{category} {name}: {statistics.total_calls} calls in {statistics.total_tt:.2f} s ({profile_file})")
+            lines.append(f"{'own [s]':>10}{'cumulative [s]':>16}{'calls':>12}  function")
+            functions = sorted(statistics.stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP_FUNCTIONS]
+            for function, (_, calls, own_time, cumulative_time, _) in functions:
+                lines.append(f"{own_time:>10.3f}{cumulative_time:>16.3f}{calls:>12}  {function_name(function)}")
+            lines.append("")
+        return "\n".join(lines)
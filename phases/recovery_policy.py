@@ -0,0 +1,67 @@
+# settings of SCC for the substructures which did not converge, higher electronic temperature (Fermi smearing)
+# damps the oscillations of charges during SCC and more iterations are allowed
+# (accuracy of the charge calculation is already the lowest one of xtb, --acc 1000)
+SMEARED_SCC = {"electronic_temperature": 1000,
+               "iterations": 1000}
+
+# attempts of the calculation of one substructure, the first attempt of each substructure is the initial one
+INITIAL_ATTEMPT = {"name": "initial", "radii_increment": 0, "scc": None}
+ENLARGED_ATTEMPTS = [{"name": f"radii_{radii_increment}", "radii_increment": radii_increment, "scc": None}
+                     for radii_increment in (1, 2, 3)]
+SMEARED_ATTEMPT = {"name": "smeared_scc", "radii_increment": 0, "scc": SMEARED_SCC}
+
+# policies selectable by the argument --recovery_policy, each policy is a list of stages
+# all attempts of one stage are run concurrently, next stage is run only for substructures for which no attempt succeeded
+RECOVERY_POLICIES = {"enlarge": [[INITIAL_ATTEMPT]] + [[attempt] for attempt in ENLARGED_ATTEMPTS],
+                     "speculative": [[INITIAL_ATTEMPT], ENLARGED_ATTEMPTS],
+                     "cheaper": [[INITIAL_ATTEMPT], [SMEARED_ATTEMPT]] + [[attempt] for attempt in ENLARGED_ATTEMPTS]}
+
+DESCRIPTIONS = {"initial": "initial calculation",
+                "radii_1": "radii enlarged by 1 A",
+                "radii_2": "radii enlarged by 2 A",
+                "radii_3": "radii enlarged by 3 A",
+                "smeared_scc": f"SCC with electronic temperature {SMEARED_SCC['electronic_temperature']} K"}
+
+
+class RecoveryPolicy:
+    """
+    Plans the attempts of the calculation of substructures whose xtb calculation did not converge.
+
+    Policy enlarge tries the failed substructures with radii enlarged by 1, 2 and 3 angstroms one after another.
+    Policy speculative runs all three enlarged substructures concurrently, so the failed substructures cost one more
+    round instead of three. The result of the smallest successful substructure is taken, so the charges equal
+    to the charges of policy enlarge. Policy cheaper first repeats the calculation of the same substructure
+    with smeared SCC, which is cheaper than any enlarged substructure, and then continues as policy enlarge.
+
+    Success rates of attempts are counted until the statistics are reset.
+    """
+    def __init__(self,
+                 name: str = "enlarge"):
+        """
+        :param name: name of the policy, see RECOVERY_POLICIES
+        """
+        self.name = name
+        self.stages = RECOVERY_POLICIES[name]
+        self.reset_statistics()
+
+    def record(self,
+               attempt: dict,
+               success: bool):
+        self.attempts_counts[attempt["name"]] = self.attempts_counts.get(attempt["name"], 0) + 1
+        self.successes_counts[attempt["name"]] = self.successes_counts.get(attempt["name"], 0) + success
+
+    def reset_statistics(self):
+        self.attempts_counts = {}
+        self.successes_counts = {}
+
+    def statistics(self):
+        """
+        :return: success rates of attempts of the recovery or None if no substructure had to be recovered
+        """
+        recovery_attempts_names = [attempt["name"] for attempts in self.stages[1:] for attempt in attempts
+                                   if attempt["name"] in self.attempts_counts]
+        if not recovery_attempts_names:
+            return None
+        return ", ".join(f"{DESCRIPTIONS[attempt_name]} succeeded for {self.successes_counts[attempt_name]} "
+                         f"of {self.attempts_counts[attempt_name]} substructures"
+                         for attempt_name in recovery_attempts_names)
@@ -0,0 +1,113 @@
+import shutil
+from contextlib import contextmanager
+from itertools import count
+from os import getpid, makedirs, path
+from queue import Queue
+from threading import Thread
+
+# directories are removed by a background thread of each process, see function remove_directory_async
+_removal_queue = None
+_removal_process_id = None
+
+
+def _remove_directories(removal_queue: Queue):
+    while True:
+        directory = removal_queue.get()
+        shutil.rmtree(directory, ignore_errors=True)
+        removal_queue.task_done()
+
+
+def remove_directory_async(directory: str):
+    """
+    Removes the directory by a background thread, so the job does not wait for the filesystem.
+    The thread is started lazily in each process (worker processes are forked without the threads of their parent).
+    """
+    global _removal_queue, _removal_process_id
+    if _removal_process_id != getpid():
+        _removal_queue = Queue()
+        _removal_process_id = getpid()
+        Thread(target=_remove_directories,
+               args=(_removal_queue,),
+               daemon=True).start()
+    _removal_queue.put(directory)
+
+
+@contextmanager
+def working_directory(job: dict):
+    """
+    Provides the job whose files are written into its scratch directory (job["scratch_dir"]) instead of job["data_dir"].
+    After the calculation, the artefacts listed in job["scratch_artefacts"] are copied into job["data_dir"]
+    (only if the auxiliary files are not deleted) and the scratch directory is removed asynchronously.
+    Jobs without scratch directory are run directly in job["data_dir"].
+
+    :param job: job of xtb engine with keys data_dir, scratch_dir, scratch_artefacts and delete_auxiliary_files
+    """
+    if not job["scratch_dir"]:
+        yield job
+        return
+    try:
+        yield dict(job,
+                   data_dir=job["scratch_dir"],
+                   delete_auxiliary_files=False)
+    finally:
+        if not job["delete_auxiliary_files"]:
+            makedirs(job["data_dir"], exist_ok=True)
+            for artefact in job["scratch_artefacts"]:
+                if path.isfile(f"{job['scratch_dir']}/{artefact}"):
+                    shutil.copy(f"{job['scratch_dir']}/{artefact}", f"{job['data_dir']}/{artefact}")
+        remove_directory_async(job["scratch_dir"])
+
+
+class ScratchManager:
+    """
+    Working directories of xtb jobs on a fast filesystem (e.g. tmpfs or /dev/shm), so the files of jobs
+    (inputs, outputs and scratch files of xtb) do not burden the filesystem of data_dir.
+    Only the requested artefacts are copied into data_dir, see function working_directory.
+
+    The directories of one run are created in its own subdirectory, which is removed by method close.
+    Estimated bytes of each job are reserved when the job is created and released when its result is received.
+    If the reservation of the job would exceed max_size, the job runs in data_dir.
+    """
+    def __init__(self,
+                 directory: str,
+                 max_size: int = 1024 ** 3,
+                 artefacts: tuple = ("repaired_substructure.pdb", "xtb_settings.inp", "xtb_output.txt",
+                                     "xtb_error_output.txt", "xtbopt.pdb")):
+        """
+        :param directory: fast directory for working directories of jobs
+        :param max_size: maximal size of all working directories in bytes
+        :param artefacts: names of files copied from working directories into data_dir
+        """
+        self.root = f"{directory}/pdbcharges_{getpid()}"
+        self.max_size = max_size
+        self.artefacts = tuple(artefacts)
+        self.directory_numbers = count(1)
+        self.reserved_bytes = 0
+        makedirs(self.root, exist_ok=True)
+
+    def job_settings(self,
+                     scratch_bytes: int):
+        """
+        Reserves the estimated bytes of the job in the scratch. The reservation is kept until the job is released,
+        so the jobs waiting in the queue of JobPool and the running jobs together never exceed max_size.
+
+        :param scratch_bytes: estimated bytes of files written by the job
+        :return: keys of the job with new working directory (or None if the scratch is full) and names of artefacts
+        """
+        if self.reserved_bytes + scratch_bytes > self.max_size:
+            return {"scratch_dir": None,
+                    "scratch_artefacts": self.artefacts}
+        self.reserved_bytes += scratch_bytes
+        return {"scratch_dir": f"{self.root}/{next(self.directory_numbers)}",
+                "scratch_artefacts": self.artefacts}
+
+    def release(self,
+                job: dict):
+        """
+        Releases the reservation of the finished (or not run) job.
+        """
+        if job["scratch_dir"]:
+            self.reserved_bytes -= job["scratch_bytes"]
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
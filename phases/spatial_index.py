@@ -0,0 +1,98 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class SpatialIndex:
+    """
+    Spatial index of structure atoms shared by all phases of the workflow.
+    It is built once per structure by k-d tree from SciPy library and supports both single and batched radius queries.
+
+    Coordinates of moved atoms (e.g. optimised hydrogens) are refreshed by method update.
+    The k-d tree is not rebuilt after every move, instead the queries are extended by the largest displacement
+    of atoms since the last build and the results are filtered by the current coordinates.
+    The k-d tree is rebuilt only when the largest displacement exceeds rebuild_tolerance.
+    """
+    def __init__(self,
+                 atoms: list,
+                 rebuild_tolerance: float = 0.5):
+        """
+        :param atoms: Biopython atoms, results of queries are indices into this list or atoms from it
+        :param rebuild_tolerance: largest displacement of atoms (in angstroms) without rebuilding of the k-d tree
+        """
+        self.atoms = list(atoms)
+        self.coords = np.array([atom.coord for atom in self.atoms], dtype=float)
+        self.rebuild_tolerance = rebuild_tolerance
+        self._build()
+
+    def _build(self):
+        self.kdtree = cKDTree(self.coords)
+        self.kdtree_coords = self.coords.copy()
+        self.max_displacement = 0
+
+    def update(self,
+               atom_indices: list):
+        """
+        Refreshes coordinates of atoms with given indices from their Biopython atoms.
+        """
+        if not len(atom_indices):
+            return
+        atom_indices = np.asarray(atom_indices)
+        self.coords[atom_indices] = [self.atoms[atom_i].coord for atom_i in atom_indices]
+        displacements = np.linalg.norm(self.coords[atom_indices] - self.kdtree_coords[atom_indices], axis=1)
+        self.max_displacement = max(self.max_displacement, displacements.max())
+        if self.max_displacement > self.rebuild_tolerance:
+            self._build()
+
+    def _filter(self,
+                candidate_indices: list,
+                center: np.ndarray,
+                radius: float):
+        candidate_indices = np.asarray(candidate_indices, dtype=int)
+        if self.max_displacement:
+            distances = np.linalg.norm(self.coords[candidate_indices] - center, axis=1)
+            candidate_indices = candidate_indices[distances <= radius]
+        return np.sort(candidate_indices)
+
+    def search_indices(self,
+                       center: np.ndarray,
+                       radius: float):
+        """
+        :return: sorted indices of atoms which are closer to the center than radius
+        """
+        candidate_indices = self.kdtree.query_ball_point(center, radius + self.max_displacement)
+        return self._filter(candidate_indices, np.asarray(center, dtype=float), radius)
+
+    def search(self,
+               center: np.ndarray,
+               radius: float):
+        """
+        :return: atoms which are closer to the center than radius
+        """
+        return [self.atoms[atom_i] for atom_i in self.search_indices(center, radius)]
+
+    def search_batch_indices(self,
+                             centers: np.ndarray,
+                             radii):
+        """
+        Batched version of method search_indices.
+
+        :param centers: array of centers with shape (n, 3)
+        :param radii: one radius for all centers or array of radii with shape (n,)
+        :return: list of arrays with sorted indices of atoms for each center
+        """
+        centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(centers),))
+        candidate_indices_list = self.kdtree.query_ball_point(centers, radii + self.max_displacement)
+        return [self._filter(candidate_indices, center, radius)
+                for candidate_indices, center, radius in zip(candidate_indices_list, centers, radii)]
+
+    def count_batch(self,
+                    centers: np.ndarray,
+                    radius: float):
+        """
+        :return: numbers of atoms closer to the centers than radius
+        """
+        if self.max_displacement:
+            return np.array([len(atom_indices) for atom_indices in self.search_batch_indices(centers, radius)], dtype=int)
+        centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+        return np.asarray(self.kdtree.query_ball_point(centers, radius, return_length=True), dtype=int)
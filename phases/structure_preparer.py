@@ -1,6 +1,7 @@
 import logging
-import sys
-from math import dist
+from contextlib import redirect_stderr, redirect_stdout
+from functools import cache
+from io import StringIO
 from os import system
 
 import hydride
@@ -12,12 +13,105 @@ from dimorphite_dl import DimorphiteDL
 from moleculekit import molecule as moleculekit_PDB
 from moleculekit.tools.preparation import systemPrepare as moleculekit_system_prepare, logger
 from collections import defaultdict
-from openmm.app import PDBFile as openmm_PDB, ForceField
-from openmm import NonbondedForce
+from openmm.app import PDBFile as openmm_PDB, ForceField, Topology, element as openmm_element
+from openmm.app.internal.pdbx.reader.PdbxReader import PdbxReader, PdbxError, SyntaxError as PdbxSyntaxError
+from openmm import NonbondedForce, Vec3
+from openmm.unit import nanometers
 from pdbfixer import PDBFixer
 from rdkit import Chem
 from rdkit.Chem import rdFMCS
 
+from phases.bonds import find_proximity_bonds
+from phases.ccd_store import CCDStore
+from phases.job_pool import JobPool
+from phases.spatial_index import SpatialIndex
+
+# molecules loaded from CCD are kept for all structures processed by this process (e.g. in batch mode)
+# keys are tuples (CCD file, pH, molecule name), values are tuples (molecule, warning) or None for names missing in CCD
+_CCD_molecules_cache = {}
+# mappings of residues to CCD molecules are shared by all copies of the same residue
+# keys are tuples (CCD file, pH, residue name, sorted atom names and elements), values are dictionaries {atom name: index of CCD atom}
+_residue_mappings_cache = {}
+
+
+@cache
+def _get_CCD_store(CCD_file: str):
+    """Index of CCD file is loaded only once per process."""
+    return CCDStore(CCD_file)
+
+
+@cache
+def _get_amber_forcefield():
+    """ForceField is constructed only once per process, because parsing of its XML files is slow."""
+    return ForceField('amber14-all.xml', 'amber14/tip3pfb.xml')
+
+
+def _create_PDBFixer_template(CCD_mmCIF_record: str):
+    """
+    Creates PDBFixer template of a residue from its mmCIF record in Chemical Component Dictionary,
+    in the same way as PDBFixer.downloadTemplate creates it from the record downloaded from PDB.
+    The record is parsed by PdbxReader from openmm.app.internal, which is not a public API of openmm,
+    the parsing is checked with the pinned openmm 8.2.0 by benchmark/check_CCD_templates.py when the Docker image is built.
+
+    :return: tuple (topology with the residue, ideal positions of atoms, leaving atoms flags) for PDBFixer.registerTemplate
+    """
+    data = []
+    PdbxReader(StringIO(CCD_mmCIF_record)).read(data)
+    block = data[0]
+    atom_data = block.getObj("chem_comp_atom")
+    atom_name_column = atom_data.getAttributeIndex("atom_id")
+    symbol_column = atom_data.getAttributeIndex("type_symbol")
+    leaving_column = atom_data.getAttributeIndex("pdbx_leaving_atom_flag")
+    coord_columns = [atom_data.getAttributeIndex(f"pdbx_model_Cartn_{axis}_ideal") for axis in "xyz"]
+
+    topology = Topology()
+    chem_comp_data = block.getObj("chem_comp")
+    residue = topology.addResidue(chem_comp_data.getRowList()[0][chem_comp_data.getAttributeIndex("id")], topology.addChain())
+    topology_atoms = {}
+    positions = []
+    terminal = []
+    for row in atom_data.getRowList():
+        try:
+            atom_element = openmm_element.get_by_symbol(row[symbol_column])
+        except KeyError:
+            atom_element = None
+        topology_atoms[row[atom_name_column]] = topology.addAtom(row[atom_name_column], atom_element, residue)
+        positions.append(Vec3(*[float(row[column]) / 10 if row[column] != "?" else 0 for column in coord_columns])) # angstroms to nanometers
+        terminal.append(row[leaving_column] == "Y")
+    bond_data = block.getObj("chem_comp_bond")
+    if bond_data is not None:
+        atom_1_column = bond_data.getAttributeIndex("atom_id_1")
+        atom_2_column = bond_data.getAttributeIndex("atom_id_2")
+        for row in bond_data.getRowList():
+            topology.addBond(topology_atoms[row[atom_1_column]], topology_atoms[row[atom_2_column]])
+    return topology, positions * nanometers, terminal
+
+
+def find_residue_mapping(job: dict):
+    """
+    Maps atoms of residue to atoms of CCD molecule by maximum common substructure.
+    The function is run by JobPool, so it must be defined at the module level.
+
+    :param job: dictionary with keys residue_pdb (PDB block with residue) and CCD_mol (RDKit molecule from CCD)
+    :return: dictionary {index of residue atom: index of CCD atom}
+    """
+    rdkit_mol = Chem.MolFromPDBBlock(molBlock=job["residue_pdb"],
+                                     removeHs=False,
+                                     sanitize=False)
+    rdkit_mol = Chem.RemoveAllHs(mol=rdkit_mol,
+                                 sanitize=False)
+    CCD_mol = job["CCD_mol"]
+    params = rdFMCS.MCSParameters()
+    params.AtomTyper = rdFMCS.AtomCompare.CompareElements
+    params.BondTyper = rdFMCS.BondCompare.CompareAny
+    params.AtomCompareParameters.MatchFormalCharge = False
+    params.Timeout = 60
+    MCS_results = rdFMCS.FindMCS([rdkit_mol, CCD_mol], params)
+    return {x[0]: x[1] for x in
+            sorted(zip(rdkit_mol.GetSubstructMatch(MCS_results.queryMol),
+                       CCD_mol.GetSubstructMatch(MCS_results.queryMol)))}
+
+
 
 class AtomSelector(biopython_PDB.Select):
     """
@@ -49,7 +143,12 @@ class StructurePreparer:
                  data_dir: str,
                  output_mmCIF_file: str,
                  delete_auxiliary_files: bool,
-                 save_charges_estimation: bool = False):
+                 save_charges_estimation: bool = False,
+                 components_cache=None,
+                 workers: int = 1,
+                 job_pool: JobPool = None,
+                 CCD_templates_file: str = None,
+                 download_CCD_templates: bool = False):
         """
         :param input_PDB_file: PDB file containing the structure which should be prepared
         :param CCD_file: SDF file with Chemical Component Dictionary
@@ -58,6 +157,13 @@ class StructurePreparer:
         :param output_mmCIF_file: mmCIF file in which prepared structure will be stored
         :param delete_auxiliary_files: auxiliary files created during the preraparation will be deleted
         :param save_charges_estimation: save estimation of partial atomic charges from pdb2pqr, Dimorphite-DL and CCD
+        :param components_cache: ComponentsCache with CCD molecules protonated by Dimorphite-DL shared by more runs
+        :param workers: number of processes processing residues concurrently, it is ignored if job_pool is given
+        :param job_pool: JobPool shared with other phases or structures, by default the structure preparer has its own pool
+        :param CCD_templates_file: mmCIF file with Chemical Component Dictionary, PDBFixer templates of heteroresidues
+                                   are created from it instead of downloading them
+        :param download_CCD_templates: PDBFixer templates of heteroresidues missing in CCD_templates_file are downloaded from PDB,
+                                       by default they are not downloaded, so the calculation does not need network access
         """
         self.logger = logger
         self.logger.print("\nSTRUCTURE PREPARER")
@@ -70,6 +176,11 @@ class StructurePreparer:
         self.delete_auxiliary_files = delete_auxiliary_files
         self.save_charges_estimation = save_charges_estimation
         self.pH = 7.2
+        self.components_cache = components_cache
+        self.workers = workers
+        self.job_pool = job_pool
+        self.CCD_templates_file = CCD_templates_file
+        self.download_CCD_templates = download_CCD_templates
         self.logger.print("ok")
 
 
@@ -78,67 +189,186 @@ class StructurePreparer:
         """
         The function retrieves molecules and their formal charges from the CCD dictionary
         and adds additional formal charges to them using the Dimorphite-DL library.
+        Molecules are loaded from CCD file only once per process.
         """
 
-        dimorphite = DimorphiteDL(min_ph=self.pH,
-                                  max_ph=self.pH,
-                                  max_variants=1,
-                                  label_states=False,
-                                  pka_precision=0.001)
+        molecule_names = set(molecule_names)
+        missing_molecule_names = [mol_name for mol_name in molecule_names if (self.CCD_file, self.pH, mol_name) not in _CCD_molecules_cache]
+        if missing_molecule_names:
+            loaded_molecules = self._load_molecules_from_CCD(set(missing_molecule_names))
+            for mol_name in missing_molecule_names:
+                _CCD_molecules_cache[(self.CCD_file, self.pH, mol_name)] = loaded_molecules.get(mol_name)
+        return {mol_name: _CCD_molecules_cache[(self.CCD_file, self.pH, mol_name)] for mol_name in molecule_names
+                if _CCD_molecules_cache[(self.CCD_file, self.pH, mol_name)] is not None}
+
+    def _load_molecules_from_CCD(self,
+                                 molecule_names: set):
+        """
+        Loads molecules from CCD file and protonates them by Dimorphite-DL, see method _get_molecules_from_CCD.
+        Protonated molecules are taken from the persistent cache of components if it is defined,
+        Dimorphite-DL is initialised only if some molecule is missing in the cache.
+        """
+        dimorphite = None
         molecules = {}
-        for CCD_mol_sdf in open(self.CCD_file, "r").read().split("$$$$\n"):
-            mol_name = CCD_mol_sdf.partition("\n")[0]
-            if mol_name in molecule_names: # we process only molecules defined in molecule names
-                supplier = Chem.SDMolSupplier()
-                supplier.SetData(CCD_mol_sdf)
-                CCD_mol = next(supplier)
-                if CCD_mol is None or mol_name in ["UNX", "UNL"]:
-                    molecules[mol_name] = (None,
-                                           "The molecule cannot be loaded by RDKit and therefore the residue is left neutral.")
-                else:
-                    CCD_mol = Chem.RemoveAllHs(CCD_mol)
-                    CCD_mol_smiles = Chem.MolToSmiles(CCD_mol)
-
-                    # add charges to structure by Dimorphite-DL
-                    dimorphite_smiles = dimorphite.protonate(CCD_mol_smiles)[0]
-                    dimorphite_mol = Chem.MolFromSmiles(dimorphite_smiles)
-                    dimorphite_mol = Chem.RemoveAllHs(dimorphite_mol)
-
-                    # Map original mol and mol processed by Dimorphite-DL
-                    params = rdFMCS.MCSParameters()
-                    params.AtomTyper = rdFMCS.AtomCompare.CompareElements
-                    params.BondTyper = rdFMCS.BondCompare.CompareOrder
-                    params.BondCompareParameters.RingMatchesRingOnly = True
-                    params.BondCompareParameters.CompleteRingsOnly = True
-                    params.AtomCompareParameters.MatchFormalCharge = False
-                    params.Timeout = 60
-                    MCS_results = rdFMCS.FindMCS([CCD_mol, dimorphite_mol], params)
-                    atom_indices_map = [x[1] for x in sorted(zip(dimorphite_mol.GetSubstructMatch(MCS_results.queryMol),
-                                                                 CCD_mol.GetSubstructMatch(MCS_results.queryMol)))]
-
-                    if len(dimorphite_mol.GetAtoms()) != len(atom_indices_map):
-                        molecules[mol_name] = (CCD_mol,
-                                               "Mapping of formal charges from Dimorphite-DL to CCD failed and therefore formal charges are taken from CCD only.")
-                    else:
-                        dimorphite_formal_charges = [atom.GetFormalCharge() for _, atom in sorted(zip(atom_indices_map,
-                                                                                                      dimorphite_mol.GetAtoms()))]
-                        for CCD_atom, dimorphite_formal_charge in zip(CCD_mol.GetAtoms(),
-                                                                      dimorphite_formal_charges):
-                            CCD_atom.SetProp("ChargedByDimorphite", "0")
-                            if CCD_atom.GetFormalCharge() == 0 and dimorphite_formal_charge != 0:
-                                bonded_atoms = list(CCD_atom.GetNeighbors())
-                                bonded_atoms_over_two_bonds = []
-                                for bonded_atom in bonded_atoms:
-                                    bonded_atoms_over_two_bonds.extend(bonded_atom.GetNeighbors())
-                                # We consider Dimorphite-DL charge only if no atoms across two bonds are charged from CCD charge
-                                # CCD_atom is already in bonded_atoms_over_two_bonds
-                                if all([atom.GetFormalCharge() == 0 for atom in bonded_atoms + bonded_atoms_over_two_bonds]):
-                                    CCD_atom.SetProp("ChargedByDimorphite", "1")
-                                    CCD_atom.SetFormalCharge(dimorphite_formal_charge)
-                        molecules[mol_name] = (CCD_mol,
-                                               None)
+        CCD_store = _get_CCD_store(self.CCD_file)
+        for mol_name in sorted(molecule_names):
+            CCD_mol_sdf = CCD_store.get(mol_name) # only records of molecules defined in molecule names are read
+            if CCD_mol_sdf is None:
+                continue
+            if self.components_cache:
+                cache_key = self.components_cache.key(component_id=mol_name,
+                                                      CCD_record=CCD_mol_sdf,
+                                                      pH=self.pH)
+                cached_molecule = self.components_cache.get(cache_key)
+                if cached_molecule is not None:
+                    molecules[mol_name] = cached_molecule
+                    continue
+            if dimorphite is None:
+                dimorphite = DimorphiteDL(min_ph=self.pH,
+                                          max_ph=self.pH,
+                                          max_variants=1,
+                                          label_states=False,
+                                          pka_precision=0.001)
+            molecules[mol_name] = self._protonate_CCD_molecule(mol_name=mol_name,
+                                                               CCD_mol_sdf=CCD_mol_sdf,
+                                                               dimorphite=dimorphite)
+            if self.components_cache:
+                self.components_cache.put(cache_key, *molecules[mol_name])
         return molecules
 
+    def _protonate_CCD_molecule(self,
+                                mol_name: str,
+                                CCD_mol_sdf: str,
+                                dimorphite: DimorphiteDL):
+        """
+        :return: tuple (CCD molecule with formal charges from CCD and Dimorphite-DL or None, warning or None)
+        """
+        supplier = Chem.SDMolSupplier()
+        supplier.SetData(CCD_mol_sdf)
+        CCD_mol = next(supplier)
+        if CCD_mol is None or mol_name in ["UNX", "UNL"]:
+            return (None,
+                    "The molecule cannot be loaded by RDKit and therefore the residue is left neutral.")
+        else:
+            CCD_mol = Chem.RemoveAllHs(CCD_mol)
+            CCD_mol_smiles = Chem.MolToSmiles(CCD_mol)
+
+            # add charges to structure by Dimorphite-DL
+            dimorphite_smiles = dimorphite.protonate(CCD_mol_smiles)[0]
+            dimorphite_mol = Chem.MolFromSmiles(dimorphite_smiles)
+            dimorphite_mol = Chem.RemoveAllHs(dimorphite_mol)
+
+            # Map original mol and mol processed by Dimorphite-DL
+            params = rdFMCS.MCSParameters()
+            params.AtomTyper = rdFMCS.AtomCompare.CompareElements
+            params.BondTyper = rdFMCS.BondCompare.CompareOrder
+            params.BondCompareParameters.RingMatchesRingOnly = True
+            params.BondCompareParameters.CompleteRingsOnly = True
+            params.AtomCompareParameters.MatchFormalCharge = False
+            params.Timeout = 60
+            MCS_results = rdFMCS.FindMCS([CCD_mol, dimorphite_mol], params)
+            atom_indices_map = [x[1] for x in sorted(zip(dimorphite_mol.GetSubstructMatch(MCS_results.queryMol),
+                                                         CCD_mol.GetSubstructMatch(MCS_results.queryMol)))]
+
+            if len(dimorphite_mol.GetAtoms()) != len(atom_indices_map):
+                return (CCD_mol,
+                        "Mapping of formal charges from Dimorphite-DL to CCD failed and therefore formal charges are taken from CCD only.")
+            else:
+                dimorphite_formal_charges = [atom.GetFormalCharge() for _, atom in sorted(zip(atom_indices_map,
+                                                                                              dimorphite_mol.GetAtoms()))]
+                for CCD_atom, dimorphite_formal_charge in zip(CCD_mol.GetAtoms(),
+                                                              dimorphite_formal_charges):
+                    CCD_atom.SetProp("ChargedByDimorphite", "0")
+                    if CCD_atom.GetFormalCharge() == 0 and dimorphite_formal_charge != 0:
+                        bonded_atoms = list(CCD_atom.GetNeighbors())
+                        bonded_atoms_over_two_bonds = []
+                        for bonded_atom in bonded_atoms:
+                            bonded_atoms_over_two_bonds.extend(bonded_atom.GetNeighbors())
+                        # We consider Dimorphite-DL charge only if no atoms across two bonds are charged from CCD charge
+                        # CCD_atom is already in bonded_atoms_over_two_bonds
+                        if all([atom.GetFormalCharge() == 0 for atom in bonded_atoms + bonded_atoms_over_two_bonds]):
+                            CCD_atom.SetProp("ChargedByDimorphite", "1")
+                            CCD_atom.SetFormalCharge(dimorphite_formal_charge)
+                return (CCD_mol,
+                        None)
+
+    def _map_residues_to_CCD(self,
+                             residues: list,
+                             CCD_molecules: dict,
+                             selector: AtomSelector,
+                             io: biopython_PDB.PDBIO,
+                             job_pool: JobPool):
+        """
+        Maps atoms of residues to atoms of their CCD molecules. Maximum common substructures are searched by the pool of workers.
+        Copies of the same residue with the same atoms share the mapping, it is only verified for each copy.
+        The search runs in rounds. In the first round, the mapping is searched only for the first copy of each residue
+        without known mapping. In the next round, the mapping is searched for all copies which failed the verification
+        of the shared mapping at once, so the results do not depend on the number of workers.
+
+        :param CCD_molecules: dictionary {residue name: (CCD molecule or None, warning)}, see method _get_molecules_from_CCD
+        :return: list with dictionary {atom name: index of CCD atom} or None (residue without CCD molecule) for each residue
+        """
+        residues_mappings = [None] * len(residues)
+        while True:
+            searched_residues = []
+            searched_mapping_keys = set()
+            for residue_i, residue in enumerate(residues):
+                CCD_mol = CCD_molecules.get(residue.resname, (None, None))[0]
+                if residues_mappings[residue_i] is not None or CCD_mol is None:
+                    continue
+                mapping_key = (self.CCD_file, self.pH, residue.resname,
+                               tuple(sorted((atom.get_name(), atom.element) for atom in residue.get_atoms())))
+                atom_names_map = _residue_mappings_cache.get(mapping_key)
+                if atom_names_map is not None:
+                    if self._verify_residue_mapping(residue, CCD_mol, atom_names_map):
+                        residues_mappings[residue_i] = atom_names_map
+                    else:
+                        searched_residues.append((residue_i, mapping_key))
+                elif mapping_key not in searched_mapping_keys:
+                    searched_mapping_keys.add(mapping_key)
+                    searched_residues.append((residue_i, mapping_key))
+            if not searched_residues:
+                return residues_mappings
+
+            jobs = []
+            for residue_i, _ in searched_residues:
+                residue = residues[residue_i]
+                selector.full_ids = set([atom.full_id for atom in residue.get_atoms()])
+                # the residue is passed to the job in memory, copies from different chains may share the name and number
+                residue_pdb = StringIO()
+                io.save(file=residue_pdb,
+                        select=selector)
+                jobs.append({"residue_pdb": residue_pdb.getvalue(),
+                             "CCD_mol": CCD_molecules[residue.resname][0]})
+            for (residue_i, mapping_key), atom_indices_map in zip(searched_residues,
+                                                                 job_pool.map(find_residue_mapping, jobs)):
+                residue_atom_names = [atom.get_name() for atom in residues[residue_i].get_atoms()]
+                residues_mappings[residue_i] = {residue_atom_names[atom_i]: CCD_atom_i for atom_i, CCD_atom_i in atom_indices_map.items()}
+                _residue_mappings_cache[mapping_key] = residues_mappings[residue_i]
+
+    @staticmethod
+    def _verify_residue_mapping(residue,
+                                CCD_mol,
+                                atom_names_map: dict):
+        """
+        Fast check that the mapping found for another copy of the residue is valid also for this copy,
+        i.e. all mapped atoms have the element of their CCD atoms and all CCD bonds between mapped atoms
+        are not longer than sum of covalent radii with tolerance 0.45 Å.
+        """
+        for atom_name, CCD_atom_i in atom_names_map.items():
+            if atom_name not in residue or residue[atom_name].element.upper() != CCD_mol.GetAtomWithIdx(CCD_atom_i).GetSymbol().upper():
+                return False
+        CCD_atom_names = {CCD_atom_i: atom_name for atom_name, CCD_atom_i in atom_names_map.items()}
+        periodic_table = Chem.GetPeriodicTable()
+        for bond in CCD_mol.GetBonds():
+            a1_i, a2_i = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+            if a1_i in CCD_atom_names and a2_i in CCD_atom_names:
+                max_bond_length = (periodic_table.GetRcovalent(bond.GetBeginAtom().GetAtomicNum()) +
+                                   periodic_table.GetRcovalent(bond.GetEndAtom().GetAtomicNum()) + 0.45)
+                if residue[CCD_atom_names[a1_i]] - residue[CCD_atom_names[a2_i]] > max_bond_length:
+                    return False
+        return True
+
     def fix_structure(self):
         """
         PDB file is fixed by tool PDBFixer.
@@ -153,17 +383,36 @@ class StructurePreparer:
         # load structure by PDBFixer
         fixer = PDBFixer(filename=self.input_PDB_file)
 
-        # download templates for heteroresidues
+        # register templates for heteroresidues from the local CCD in mmCIF format,
+        # templates missing in it are downloaded only if it is allowed by download_CCD_templates
         for residue in fixer.topology.residues():
             if residue.name not in fixer.templates.keys():
-                try:
-                    fixer.downloadTemplate(residue.name)
-                except:
+                CCD_mmCIF_record = _get_CCD_store(self.CCD_templates_file).get(residue.name) if self.CCD_templates_file else None
+                if CCD_mmCIF_record is not None:
+                    try:
+                        fixer.registerTemplate(*_create_PDBFixer_template(CCD_mmCIF_record))
+                    except (AttributeError, IndexError, KeyError, ValueError, PdbxError, PdbxSyntaxError): # record of the residue in CCD is incomplete or malformed
+                        warning = f"PDBFixer template for this residue could not be created from its incomplete or malformed record in CCD."
+                        self.logger.add_warning(chain=residue.chain.id,
+                                                resnum=residue.id,
+                                                resname=residue.name,
+                                                warning=warning)
+                    continue
+                if self.download_CCD_templates:
+                    try:
+                        if fixer.downloadTemplate(residue.name): # False if the template is not available
+                            continue
+                    except:
+                        pass
                     warning = f"PDBFixer could not download the template for this residue."
-                    self.logger.add_warning(chain=residue.chain.id,
-                                            resnum=residue.id,
-                                            resname=residue.name,
-                                            warning=warning)
+                elif self.CCD_templates_file:
+                    warning = f"PDBFixer template for this residue could not be created, residue is missing in CCD."
+                else:
+                    warning = f"PDBFixer template for this residue is not available, because no CCD templates file was given."
+                self.logger.add_warning(chain=residue.chain.id,
+                                        resnum=residue.id,
+                                        resname=residue.name,
+                                        warning=warning)
 
         # add heavy atoms
         fixer.missingResidues = {}
@@ -238,7 +487,7 @@ class StructurePreparer:
         selector = AtomSelector()
         io = biopython_PDB.PDBIO()
         io.set_structure(structure)
-        kdtree = biopython_PDB.NeighborSearch(structure_atoms)
+        spatial_index = SpatialIndex(structure_atoms)
         for atom in structure_atoms:
             atom.charge_estimation = 0
             atom.charged_by_dimorphite = False
@@ -250,9 +499,7 @@ class StructurePreparer:
                                          extra_fields=["charge"],
                                          include_bonds=True)
         biotite_bonds_set = set([frozenset((a1, a2)) for a1, a2 in
-                                 protein.bonds.as_array()[:, :2]])  # we exclude the third column with the bond type
-        rdkit_biotite_bonds_converter = {Chem.BondType.SINGLE: BondType.SINGLE,
-                                         Chem.BondType.DOUBLE: BondType.DOUBLE}
+                                 protein.bonds.as_array()[:, :2].tolist()])  # we exclude the third column with the bond type
 
         residues_processed_by_hydride = [res for res in structure.get_residues() if res.resname not in residues_processed_by_pdb2pqr]
 
@@ -260,14 +507,40 @@ class StructurePreparer:
             # load formal charges for ligand from CCD. Add other formal charges by Dimorphite-DL
             residues_processed_by_hydride_formal_charges = self._get_molecules_from_CCD(set(res.resname for res in residues_processed_by_hydride))
 
-            for residue in residues_processed_by_hydride:
-
-                # skip unknown residues
-                if residue.resname in ["UNX", "UNL"]:
-                    continue
+            residues_processed_by_hydride = [residue for residue in residues_processed_by_hydride
+                                             if residue.resname not in ["UNX", "UNL"]] # skip unknown residues
+
+            # mapping of residues to CCD molecules is run by the pool of workers,
+            # the results are applied one by one in the order of residues
+            job_pool = self.job_pool if self.job_pool else JobPool(workers=self.workers)
+            residues_mappings = self._map_residues_to_CCD(residues=residues_processed_by_hydride,
+                                                          CCD_molecules=residues_processed_by_hydride_formal_charges,
+                                                          selector=selector,
+                                                          io=io,
+                                                          job_pool=job_pool)
+            if not self.job_pool:
+                job_pool.shutdown()
+
+            # interresidual covalent bonds are found by one pass over the whole structure
+            # by the same rules as RDKit uses for PDB files, proximity bonds of RDKit are always single
+            residues_interresidual_bonds = defaultdict(list)
+            for ba1_index, ba2_index in find_proximity_bonds(elements=protein.element,
+                                                             coords=protein.coord,
+                                                             residue_keys=list(zip(protein.chain_id, protein.res_id,
+                                                                                   protein.ins_code, protein.res_name)),
+                                                             residue_names=protein.res_name).tolist():
+                ba1_res = structure_atoms[ba1_index].get_parent()
+                ba2_res = structure_atoms[ba2_index].get_parent()
+                if ba1_res.full_id != ba2_res.full_id:
+                    residues_interresidual_bonds[ba1_res.full_id].append((ba1_index, ba2_index))
+                    residues_interresidual_bonds[ba2_res.full_id].append((ba1_index, ba2_index))
+
+            for residue, atom_names_map in zip(residues_processed_by_hydride,
+                                               residues_mappings):
 
                 # get residue from CCD (protonated also by Dimorphite-DL)
                 residue.hydride_mask = True
+                CCD_mol = None
                 try:
                     CCD_mol, warning = residues_processed_by_hydride_formal_charges[residue.resname]
                     if warning:
@@ -285,27 +558,7 @@ class StructurePreparer:
                 if CCD_mol:
 
                     # map charges from CCD and Dimorphite-DL to residuum from structure
-                    res_atoms = sorted(residue.get_atoms(),
-                                       key=lambda x: x.serial_number)
-                    selector.full_ids = set([atom.full_id for atom in res_atoms])
-                    io.save(file=f"{self.data_dir}/{residue.resname}_{residue.id[1]}.pdb",
-                            select=selector)
-                    rdkit_mol = Chem.MolFromPDBFile(molFileName=f"{self.data_dir}/{residue.resname}_{residue.id[1]}.pdb",
-                                                    removeHs=False,
-                                                    sanitize=False)
-                    rdkit_mol = Chem.RemoveAllHs(mol=rdkit_mol,
-                                                 sanitize=False)
-                    params = rdFMCS.MCSParameters()
-                    params.AtomTyper = rdFMCS.AtomCompare.CompareElements
-                    params.BondTyper = rdFMCS.BondCompare.CompareAny
-                    params.AtomCompareParameters.MatchFormalCharge = False
-                    params.Timeout = 60
-                    MCS_results = rdFMCS.FindMCS([rdkit_mol, CCD_mol], params)
-                    atom_indices_map = {x[0]: x[1] for x in
-                                        sorted(zip(rdkit_mol.GetSubstructMatch(MCS_results.queryMol),
-                                                   CCD_mol.GetSubstructMatch(MCS_results.queryMol)))}
-
-                    if len(atom_indices_map) <= len(residue) - 1: # one oxygen can miss because of peptide bond
+                    if len(atom_names_map) <= len(residue) - 1: # one oxygen can miss because of peptide bond
                         warning = "Mapping of formal charges from Dimorphite-DL and CCD to residue failed and therefore the residue is left neutral."
                         self.logger.add_warning(chain=residue.get_parent().id,
                                                 resnum=residue.id[1],
@@ -313,12 +566,12 @@ class StructurePreparer:
                                                 warning=warning)
                     else:
                         CCD_mol_atoms = CCD_mol.GetAtoms()
-                        for atom_i, atom in enumerate(residue.get_atoms()):
+                        for atom in residue.get_atoms():
                             try:
-                                CCD_atom = CCD_mol_atoms[atom_indices_map[atom_i]]
+                                CCD_atom = CCD_mol_atoms[atom_names_map[atom.get_name()]]
                                 atom.charge_estimation = CCD_atom.GetFormalCharge()
                                 atom.charged_by_dimorphite = bool(int(CCD_atom.GetProp("ChargedByDimorphite")))
-                            except KeyError: # Mapping for atom failed. It is already logged by previous "if len(atom_indices_map) <= len(res) - 1 statement"
+                            except KeyError: # Mapping for atom failed. It is already logged by previous "if len(atom_names_map) <= len(res) - 1 statement"
                                 continue
 
                         # because of mapping without bond orders there can be negative charge at double-bond oxygen
@@ -349,53 +602,30 @@ class StructurePreparer:
                                                                 resname=residue.resname,
                                                                 warning=warning)
 
-                # find interrezidual covalent bonds and modify charge estimation for specific cases
-                residue_center = residue.center_of_mass(geometric=True)
-                residue_radius = max([dist(residue_center, atom.coord) for atom in residue.get_atoms()])
-                substructure_atoms = kdtree.search(center=residue_center,
-                                                   radius=residue_radius + 5,
-                                                   level="A")
-                substructure_atoms.sort(key=lambda x: x.serial_number)
-                selector.full_ids = set([atom.full_id for atom in substructure_atoms])
-                residuum_file = f"{self.data_dir}/{residue.get_parent().id}_{'_'.join([str(id_part) for id_part in residue.id if id_part != ' '])}_substructure.pdb"
-                io.save(file=residuum_file,
-                        select=selector,
-                        preserve_atom_numbering=True)
-                rdkit_mol = Chem.MolFromPDBFile(molFileName=residuum_file,
-                                                removeHs=False,
-                                                sanitize=False)
-                for bond in rdkit_mol.GetBonds():
-                    ba1_serial_number = bond.GetBeginAtom().GetPDBResidueInfo().GetSerialNumber()
-                    ba2_serial_number = bond.GetEndAtom().GetPDBResidueInfo().GetSerialNumber()
-                    ba1_index = ba1_serial_number - 1
-                    ba2_index = ba2_serial_number - 1
+                # modify charge estimation for specific cases of interresidual covalent bonds
+                for ba1_index, ba2_index in residues_interresidual_bonds[residue.full_id]:
                     ba1 = structure_atoms[ba1_index]
                     ba2 = structure_atoms[ba2_index]
-                    ba1_res = ba1.get_parent()
-                    ba2_res = ba2.get_parent()
-                    if ba1_res != ba2_res and residue in (ba1_res, ba2_res):  # inter-residual bond
-                        # set zero charge for interresidual peptide bonds
-                        # this is true for both CCD and Dimorphite-DL formal charges
-                        if set([ba1.element, ba2.element]) == {"N", "C"}:
-                            carbon = [atom for atom in [ba1, ba2] if atom.element == "C"][0]
-                            bonded_oxygens_to_carbon = [atom for atom in kdtree.search(center=carbon.coord,
-                                                                                       radius=1.3,
-                                                                                       level="A") if atom.element == "O"]
-                            if len(bonded_oxygens_to_carbon) == 1:
-                                ba1.charge_estimation = 0
-                                ba2.charge_estimation = 0
-                                bonded_oxygens_to_carbon[0].charge_estimation = 0
-                        # setting formal charge from Dimorphite-DL to zero for all interresidual bonds
-                        if ba1.charged_by_dimorphite:
+                    # set zero charge for interresidual peptide bonds
+                    # this is true for both CCD and Dimorphite-DL formal charges
+                    if set([ba1.element, ba2.element]) == {"N", "C"}:
+                        carbon = [atom for atom in [ba1, ba2] if atom.element == "C"][0]
+                        bonded_oxygens_to_carbon = [atom for atom in spatial_index.search(center=carbon.coord,
+                                                                                          radius=1.3) if atom.element == "O"]
+                        if len(bonded_oxygens_to_carbon) == 1:
                             ba1.charge_estimation = 0
-                        if ba2.charged_by_dimorphite:
                             ba2.charge_estimation = 0
-                        # if the bond was detected by RDKit and not Biotite, create it
-                        if frozenset((ba1_index, ba1_index)) not in biotite_bonds_set:
-                            biotite_bond_type = rdkit_biotite_bonds_converter.get(bond.GetBondType(), BondType.ANY)
-                            protein.bonds.add_bond(ba1_index, ba2_index, biotite_bond_type)
-                        ba1_res.hydride_mask = True
-                        ba2_res.hydride_mask = True
+                            bonded_oxygens_to_carbon[0].charge_estimation = 0
+                    # setting formal charge from Dimorphite-DL to zero for all interresidual bonds
+                    if ba1.charged_by_dimorphite:
+                        ba1.charge_estimation = 0
+                    if ba2.charged_by_dimorphite:
+                        ba2.charge_estimation = 0
+                    # if the bond was detected by proximity and not by Biotite, create it
+                    if frozenset((ba1_index, ba2_index)) not in biotite_bonds_set:
+                        protein.bonds.add_bond(ba1_index, ba2_index, BondType.SINGLE)
+                    ba1.get_parent().hydride_mask = True
+                    ba2.get_parent().hydride_mask = True
 
         # final definition which atoms should be processed by hydride
         # hydrogens should by added to DNA and RNA by moleculekit because of charge consistency
@@ -421,25 +651,19 @@ class StructurePreparer:
                                      'PD', 'PR', 'PT', 'PT4', 'RB', 'RE', 'RH', 'RH3', 'RHF', 'RU', 'SB', 'SE', 'SM',
                                      'SR', 'TA0', 'TB', 'TE', 'TH', 'TL', 'U1', 'V', 'W', 'XE', 'Y1', 'YB', 'YB2', 'YT3',
                                      'ZCM', 'ZN', 'ZN2', 'ZR', 'ZTM'}
-        interresidual_bonds = []
         bonds = protein.bonds.as_array()
-        for a1_index, ch1, r1, a2_index, ch2, r2 in zip(bonds[:, 0],
-                                                        protein.chain_id[bonds[:, 0]],
-                                                        protein.res_id[bonds[:, 0]],
-                                                        bonds[:, 1],
-                                                        protein.chain_id[bonds[:, 1]],
-                                                        protein.res_id[bonds[:,1]]):
-            if (ch1, r1) != (ch2, r2):
-                interresidual_bonds.append((a1_index, a2_index))
-        for a1_index, a2_index in interresidual_bonds:
-            if protein.res_name[a1_index] in metal_single_atom_ligands or protein.res_name[a2_index] in metal_single_atom_ligands:
-                protein.bonds.remove_bond(a1_index, a2_index)
+        interresidual_mask = ((protein.chain_id[bonds[:, 0]] != protein.chain_id[bonds[:, 1]]) |
+                              (protein.res_id[bonds[:, 0]] != protein.res_id[bonds[:, 1]]))
+        interresidual_bonds = bonds[interresidual_mask, :2]
+        metal_bonds_mask = interresidual_mask & (np.isin(protein.res_name[bonds[:, 0]], list(metal_single_atom_ligands)) |
+                                                 np.isin(protein.res_name[bonds[:, 1]], list(metal_single_atom_ligands)))
+        protein.bonds = BondList(protein.bonds.get_atom_count(), bonds[~metal_bonds_mask])
 
         # estimation of charges for standard aminoacids processed by hydride
         # the function hydride.estimate_amino_acid_charges has errors, and therefore
         # we control to avoid assigning charges to atoms involved in an interresidual bond
         hydride_estimated_charges = hydride.estimate_amino_acid_charges(protein, ph=self.pH)
-        interresidual_bonds_atom_indices = set(atom_i for bond in interresidual_bonds for atom_i in bond)
+        interresidual_bonds_atom_indices = set(interresidual_bonds.flatten().tolist())
         for i, (atom, hydride_estimated_charge) in enumerate(zip(structure_atoms, hydride_estimated_charges)):
             if atom.hydride_mask and atom.charge_estimation == 0 and i not in interresidual_bonds_atom_indices:
                 atom.charge_estimation = hydride_estimated_charge
@@ -447,10 +671,8 @@ class StructurePreparer:
         # adding of hydrogens
         protein.charge = [atom.charge_estimation for atom in structure_atoms]
         protein.set_annotation("hydride_mask", [atom.hydride_mask for atom in structure_atoms])
-        original_stderr = sys.stderr # redirect hydride output to file
-        sys.stderr = open(f"{self.data_dir}/hydride.txt", 'w')
-        protein_with_hydrogens, _ = hydride.add_hydrogen(protein, mask=protein.hydride_mask)
-        sys.stderr = original_stderr
+        with open(f"{self.data_dir}/hydride.txt", 'w') as hydride_report, redirect_stderr(hydride_report): # redirect hydride output to file
+            protein_with_hydrogens, _ = hydride.add_hydrogen(protein, mask=protein.hydride_mask)
         self.hydride_charges = protein_with_hydrogens.charge
         self.hydride_mask = protein_with_hydrogens.hydride_mask
         biotite.save_structure(file_path=f"{self.data_dir}/hydride.pdb",
@@ -483,25 +705,29 @@ class StructurePreparer:
         """
 
         self.logger.print("Adding hydrogens by moleculekit... ", end="")
+        # moleculekit logger is module-level and shared by all structures processed by this process (e.g. in batch mode),
+        # so the handler and the redirection of output to files of this structure are removed after the preparation
+        original_propagate = logger.propagate
+        file_handler = logging.FileHandler(f"{self.data_dir}/moleculekit_report.txt")
         try:
-            original_stdout = sys.stdout  # redirect moleculekit output to files
-            sys.stdout = open(f"{self.data_dir}/moleculekit_chains_report.txt", 'w')
-            logger.propagate = False
-            file_handler = logging.FileHandler(f"{self.data_dir}/moleculekit_report.txt")
-            logger.addHandler(file_handler)
-            molecule = moleculekit_PDB.Molecule(f"{self.data_dir}/hydride.pdb")
-            prepared_molecule, details = moleculekit_system_prepare(molecule,
-                                                                    pH=self.pH,
-                                                                    hold_nonpeptidic_bonds=False,
-                                                                    ignore_ns_errors=True,
-                                                                    _molkit_ff=False,
-                                                                    return_details=True)
-            prepared_molecule.write(f"{self.data_dir}/moleculekit.pdb")
-            sys.stdout = original_stdout
+            with open(f"{self.data_dir}/moleculekit_chains_report.txt", 'w') as chains_report, redirect_stdout(chains_report):
+                logger.propagate = False
+                logger.addHandler(file_handler)
+                molecule = moleculekit_PDB.Molecule(f"{self.data_dir}/hydride.pdb")
+                prepared_molecule, details = moleculekit_system_prepare(molecule,
+                                                                        pH=self.pH,
+                                                                        hold_nonpeptidic_bonds=False,
+                                                                        ignore_ns_errors=True,
+                                                                        _molkit_ff=False,
+                                                                        return_details=True)
+                prepared_molecule.write(f"{self.data_dir}/moleculekit.pdb")
         except:
-            sys.stdout = original_stdout
             self.logger.print("\nERROR! The molecule is not processable by the moleculekit library.", end="\n")
             exit()
+        finally:
+            logger.removeHandler(file_handler)
+            file_handler.close()
+            logger.propagate = original_propagate
         self.logger.print("ok")
 
         self.logger.print("Writing prepared structure to file... ", end="")
@@ -552,7 +778,7 @@ class StructurePreparer:
                             select=NucleicSelector(),
                             preserve_atom_numbering=True)
                     pdb = openmm_PDB(f"{self.data_dir}/only_DNA_and_RNA.pdb")
-                    forcefield = ForceField('amber14-all.xml', 'amber14/tip3pfb.xml')
+                    forcefield = _get_amber_forcefield()
                     ff_system = forcefield.createSystem(pdb.topology)
                     nonbonded = [f for f in ff_system.getForces() if isinstance(f, NonbondedForce)][0]
                     charges = [nonbonded.getParticleParameters(i)[0]._value for i in range(ff_system.getNumParticles())]
@@ -0,0 +1,121 @@
+import numpy as np
+
+from phases.bonds import find_proximity_bonds
+
+# length of C-H bond used to cap broken C-C bonds
+CAPPING_HYDROGEN_BOND_LENGTH = 1.09
+
+
+class SubstructureBuilder:
+    """
+    This class cuts substructures from the structure in memory.
+    The bond graph is derived once for the whole structure, so no intermediate files have to be written
+    and parsed for each substructure.
+
+    Substructure contains all atoms closer to the central atom than min_radius. Then the broken bonds are followed
+    (but never further than max_radius from the central atom) until only C-C bonds are broken.
+    Broken C-C bonds are capped by hydrogens placed on the bond vectors.
+    """
+    def __init__(self,
+                 atoms: list,
+                 spatial_index):
+        """
+        :param atoms: Biopython atoms of the structure
+        :param spatial_index: SpatialIndex built for the same list of atoms
+        """
+        self.atoms = atoms
+        self.spatial_index = spatial_index
+        self.is_carbon = np.array([atom.element == "C" for atom in atoms])
+
+        # substructure atoms are returned in the same order as Biopython writes them into files
+        model = atoms[0].get_parent().get_parent().get_parent()
+        hierarchy_order = {atom.full_id: order for order, atom in enumerate(model.get_atoms())}
+        self.hierarchy_order = np.array([hierarchy_order[atom.full_id] for atom in atoms])
+
+        # bond graph of the whole structure
+        residues = [atom.get_parent() for atom in atoms]
+        bonds = find_proximity_bonds(elements=[atom.element for atom in atoms],
+                                     coords=[atom.coord for atom in atoms],
+                                     residue_keys=[(residue.get_parent().id, residue.id[1], residue.id[2], residue.resname) for residue in residues],
+                                     residue_names=[residue.resname for residue in residues])
+        self.bonded_atoms = [[] for _ in atoms]
+        for a1, a2 in bonds.tolist():
+            self.bonded_atoms[a1].append(a2)
+            self.bonded_atoms[a2].append(a1)
+
+    def build(self,
+              central_atom_i: int,
+              min_radius: float,
+              max_radius: float):
+        """
+        :return: indices of substructure atoms ordered as in the structure,
+                 list of broken C-C bonds (index of substructure carbon, index of removed carbon)
+        """
+        center = self.atoms[central_atom_i].coord
+        atoms_in_max_radius = set(self.spatial_index.search_indices(center=center,
+                                                                    radius=max_radius).tolist())
+        substructure = set(self.spatial_index.search_indices(center=center,
+                                                             radius=min_radius).tolist())
+
+        # follow all broken bonds except C-C bonds
+        atoms_with_broken_bonds = sorted(substructure)
+        while atoms_with_broken_bonds:
+            atom_i = atoms_with_broken_bonds.pop()
+            for bonded_atom_i in self.bonded_atoms[atom_i]:
+                if bonded_atom_i in substructure or bonded_atom_i not in atoms_in_max_radius:
+                    continue
+                if self.is_carbon[atom_i] and self.is_carbon[bonded_atom_i]:
+                    continue
+                substructure.add(bonded_atom_i)
+                atoms_with_broken_bonds.append(bonded_atom_i)
+
+        substructure_atom_indices = sorted(substructure, key=lambda atom_i: self.hierarchy_order[atom_i])
+        broken_carbon_bonds = [(atom_i, bonded_atom_i) for atom_i in substructure_atom_indices if self.is_carbon[atom_i]
+                               for bonded_atom_i in self.bonded_atoms[atom_i]
+                               if self.is_carbon[bonded_atom_i] and bonded_atom_i in atoms_in_max_radius and bonded_atom_i not in substructure]
+        return substructure_atom_indices, broken_carbon_bonds
+
+    def capping_hydrogens_coords(self,
+                                 broken_carbon_bonds: list):
+        """
+        Link hydrogens are placed on the broken C-C bonds, CAPPING_HYDROGEN_BOND_LENGTH from the substructure carbons.
+
+        :return: coordinates of capping hydrogens with shape (len(broken_carbon_bonds), 3)
+        """
+        if not broken_carbon_bonds:
+            return np.empty((0, 3))
+        carbon_indices, removed_carbon_indices = np.array(broken_carbon_bonds).T
+        carbons_coords = self.spatial_index.coords[carbon_indices]
+        bond_vectors = self.spatial_index.coords[removed_carbon_indices] - carbons_coords
+        bond_vectors /= np.linalg.norm(bond_vectors, axis=1)[:, np.newaxis]
+        return carbons_coords + CAPPING_HYDROGEN_BOND_LENGTH * bond_vectors
+
+    def repaired_substructure_atoms(self,
+                                    substructure_atom_indices: list,
+                                    broken_carbon_bonds: list):
+        """
+        :return: list of tuples (Biopython atom of the residue, atom name, element, coordinates) in the order of xtb input,
+                 hydrogens capping the broken C-C bonds are at the end as members of the residues of their carbons
+        """
+        atoms = [(self.atoms[atom_i], self.atoms[atom_i].get_id(), self.atoms[atom_i].element, self.spatial_index.coords[atom_i])
+                 for atom_i in substructure_atom_indices]
+        atoms.extend((self.atoms[carbon_i], "H", "H", coord)
+                     for (carbon_i, _), coord in zip(broken_carbon_bonds, self.capping_hydrogens_coords(broken_carbon_bonds)))
+        return atoms
+
+    def pdb_block(self,
+                  repaired_substructure_atoms: list):
+        """
+        :return: substructure with capping hydrogens (see method repaired_substructure_atoms)
+                 in PDB format, in the same format as Biopython writes it
+        """
+        lines = []
+        for serial_number, (atom, name, element, (x, y, z)) in enumerate(repaired_substructure_atoms, start=1):
+            residue = atom.get_parent()
+            hetfield, resseq, icode = residue.id
+            if len(name) < 4 and name[:1].isalpha() and len(element) < 2:
+                name = " " + name
+            lines.append(f"{'ATOM  ' if hetfield == ' ' else 'HETATM'}{serial_number:5d} {name:<4s} {residue.resname:>3s} "
+                         f"{residue.get_parent().id[:1]:1s}{resseq:4d}{icode:1s}   {x:8.3f}{y:8.3f}{z:8.3f}"
+                         f"{1:6.2f}{0:6.2f}          {element.upper():>2s}  \n")
+        return "".join(lines) + "END\n"
@@ -0,0 +1,130 @@
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from os import getpid
+from time import time
+
+
+def xtb_job_status(result,
+                   job_report: dict):
+    """
+    :param result: result of xtb job (e.g. charges or optimised coordinates)
+    :param job_report: report returned by the job function, None if the result was taken from the cache
+    :return: status of the job for the tracer
+    """
+    if job_report is None:
+        return "cached"
+    if job_report["exceeded_limit"]:
+        return f"{job_report['exceeded_limit']} limit"
+    return "converged" if result is not None else "failed"
+
+
+class Tracer:
+    """
+    Records spans of steps of the workflow and xtb jobs of the phases as complete events of Chrome trace format,
+    the trace file can be loaded in chrome://tracing or https://ui.perfetto.dev.
+
+    Steps run in the main process are recorded in its thread 0. Each xtb job is recorded by two events,
+    construction of its substructure in the main process (thread 1) and the calculation itself in the thread named
+    by the process which ran the job (worker of JobPool or the main process). Times are taken by time.time,
+    so the events of all processes share one timeline.
+    """
+    def __init__(self):
+        self.process_id = getpid()
+        self.events = []
+        self.xtb_processes_ids = set()
+
+    def _event(self,
+               name: str,
+               category: str,
+               start: float,
+               duration: float,
+               thread_id: int,
+               arguments: dict):
+        self.events.append({"name": name,
+                            "cat": category,
+                            "ph": "X",
+                            "ts": start * 1e6,
+                            "dur": duration * 1e6,
+                            "pid": self.process_id,
+                            "tid": thread_id,
+                            "args": arguments})
+
+    @contextmanager
+    def span(self,
+             name: str,
+             category: str,
+             **arguments):
+        """
+        Records the span of the code run in the context.
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self._event(name, category, start, time() - start, 0, arguments)
+
+    def add_xtb_job(self,
+                    name: str,
+                    category: str,
+                    atoms_count: int,
+                    attempt: str,
+                    construction_start: float,
+                    construction_time: float,
+                    job_report: dict,
+                    status: str,
+                    scratch_bytes: int):
+        """
+        Records the construction of the substructure and the xtb calculation of one job.
+
+        :param name: name of the job, e.g. central atom of the substructure
+        :param category: phase of the job
+        :param attempt: attempt of the job (e.g. initial or enlarged radii)
+        :param job_report: report returned by the job function with start, seconds and process_id of the calculation,
+                           None if the result was taken from the cache
+        :param status: converged, failed, time limit, memory limit or cached
+        :param scratch_bytes: estimated bytes of files written by the job (reserved by ScratchManager), recorded only if xtb was run
+        """
+        arguments = {"atoms_count": atoms_count,
+                     "attempt": attempt,
+                     "status": status}
+        self._event(f"substructure {name}", category, construction_start, construction_time, 1, arguments)
+        if job_report:
+            self.xtb_processes_ids.add(job_report["process_id"])
+            self._event(f"xtb {name}", category, job_report["start"], job_report["seconds"], job_report["process_id"],
+                        dict(arguments, scratch_bytes=scratch_bytes))
+
+    def write(self,
+              trace_file: str):
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.process_id, "tid": thread_id, "args": {"name": thread_name}}
+                    for thread_id, thread_name in [(0, "workflow"), (1, "substructures")] +
+                                                  [(process_id, f"xtb process {process_id}") for process_id in sorted(self.xtb_processes_ids)]]
+        with open(trace_file, "w") as trace_file_handle:
+            json.dump({"traceEvents": metadata + self.events,
+                       "displayTimeUnit": "ms"}, trace_file_handle)
+
+    def summary(self):
+        """
+        :return: table with total times of steps of the workflow and statistics of xtb jobs by phase and status
+        """
+        steps = defaultdict(list)
+        jobs = defaultdict(lambda: [0, 0, 0.0, 0.0, 0])
+        for event in self.events:
+            if event["tid"] == 0:
+                steps[event["cat"], event["name"]].append(event["dur"] / 1e6)
+            elif event["tid"] == 1:
+                job_statistics = jobs[event["cat"], event["args"]["status"]]
+                job_statistics[0] += 1
+                job_statistics[1] += event["args"]["atoms_count"]
+                job_statistics[2] += event["dur"] / 1e6
+                job_statistics[4] += event["args"]["attempt"] != "initial"
+            else:
+                jobs[event["cat"], event["args"]["status"]][3] += event["dur"] / 1e6
+        lines = [f"{'phase':<22}{'step':<32}{'count':>8}{'total [s]':>12}{'max [s]':>12}"]
+        for (category, name), durations in steps.items():
+            lines.append(f"{category:<22}{name:<32}{len(durations):>8}{sum(durations):>12.2f}{max(durations):>12.2f}")
+        lines.append("")
+        lines.append(f"{'phase':<22}{'xtb status':<16}{'jobs':>8}{'retries':>9}{'mean atoms':>12}{'substructures [s]':>19}{'xtb [s]':>12}")
+        for (category, status), (count, atoms_count, construction_time, xtb_time, retries) in sorted(jobs.items()):
+            lines.append(f"{category:<22}{status:<16}{count:>8}{retries:>9}{atoms_count / count:>12.0f}{construction_time:>19.2f}{xtb_time:>12.2f}")
+        return "\n".join(lines)
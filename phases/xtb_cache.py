@@ -0,0 +1,109 @@
+import hashlib
+import json
+from os import getpid, makedirs, path, remove, replace, scandir, utime
+
+
+class XtbCache:
+    """
+    Persistent content-addressed cache of xtb results shared by all phases of the workflow.
+
+    Results are stored as json files named by the hash of the xtb input (elements, coordinates rounded
+    to the precision of PDB files, total charge and method flags). Least recently used results are evicted
+    when the size of the cache exceeds max_size. The cache is used only by the main process,
+    results calculated by worker processes are stored when they are collected.
+    """
+    def __init__(self,
+                 directory: str,
+                 max_size: int = 1024 ** 3):
+        """
+        :param directory: directory where the results are stored, it is created if it does not exist
+        :param max_size: maximal size of the cache in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        makedirs(self.directory, exist_ok=True)
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(elements: list,
+            coords,
+            charge: int,
+            method: str):
+        """
+        :param elements: element symbols of atoms in the order of xtb input
+        :param coords: coordinates of atoms with shape (n, 3)
+        :param charge: total charge of the substructure
+        :param method: xtb flags and settings that influence the result
+        :return: hexadecimal hash of the xtb input
+        """
+        content = "\n".join([f"{charge}", method] + [f"{element.upper()} {x:.3f} {y:.3f} {z:.3f}"
+                                                    for element, (x, y, z) in zip(elements, coords)])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _file(self,
+              key: str):
+        return f"{self.directory}/{key[:2]}/{key}.json"
+
+    def get(self,
+            key: str):
+        """
+        :return: stored result or None if the result is not in the cache
+        """
+        file = self._file(key)
+        try:
+            with open(file) as result_file:
+                result = json.load(result_file)
+            utime(file) # modification time marks the last use of the result
+        except (OSError, ValueError):
+            result = None
+        self.lookups += 1
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def put(self,
+            key: str,
+            result):
+        """
+        Stores json serializable result. The file is written atomically, so processes sharing the cache never read incomplete results.
+        """
+        file = self._file(key)
+        makedirs(path.dirname(file), exist_ok=True)
+        temporary_file = f"{file}.{getpid()}.tmp"
+        with open(temporary_file, "w") as result_file:
+            json.dump(result, result_file)
+        replace(temporary_file, file)
+
+    def reset_statistics(self):
+        self.lookups = 0
+        self.hits = 0
+
+    def statistics(self):
+        """
+        :return: text with hit rate since the last reset of statistics
+        """
+        hit_rate = self.hits / self.lookups if self.lookups else 0
+        return f"{self.hits} of {self.lookups} xtb results taken from cache (hit rate {hit_rate:.1%})"
+
+    def evict(self):
+        """
+        Removes least recently used results until the size of the cache does not exceed max_size.
+        """
+        files = []
+        for subdirectory in scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for file in scandir(subdirectory.path):
+                if file.name.endswith(".json"):
+                    stat = file.stat()
+                    files.append((stat.st_mtime, stat.st_size, file.path))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, file in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                remove(file)
+            except FileNotFoundError:
+                pass
+            size -= file_size
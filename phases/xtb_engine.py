@@ -0,0 +1,348 @@
+import signal
+import subprocess
+from os import killpg, path, scandir, sysconf, system
+from time import monotonic
+
+import numpy as np
+from rdkit import Chem
+from scipy.optimize import minimize
+
+# xtb flags of GFN1 calculation of CM5 charges
+XTB_CHARGES_METHOD = "--gfn 1 --gbsa water --acc 1000"
+
+# xtb flags of GFN-FF optimisation of hydrogens
+XTB_OPTIMISATION_METHOD = "--gfnff --opt --gbsa water"
+
+ANGSTROM_IN_BOHR = 1.8897261246
+
+# interval in seconds in which the supervisor checks the limits of running xtb
+SUPERVISOR_POLL_INTERVAL = 0.5
+
+
+def _read_pdb_block(pdb: str):
+    """
+    :return: element symbols and coordinates (in angstroms) of atoms of the substructure in PDB format
+    """
+    atom_lines = [line for line in pdb.splitlines() if line[:4] in ["ATOM", "HETA"]]
+    elements = [line[76:78].strip().capitalize() for line in atom_lines]
+    coords = np.array([(float(line[30:38]), float(line[38:46]), float(line[46:54])) for line in atom_lines])
+    return elements, coords
+
+
+class XtbLimitExceeded(Exception):
+    """
+    Raised by the engine when the xtb calculation was killed because it exceeded the time or memory limit.
+    """
+    def __init__(self,
+                 limit: str):
+        """
+        :param limit: exceeded limit, "time" or "memory"
+        """
+        super().__init__(f"xtb calculation exceeded the {limit} limit")
+        self.limit = limit
+
+
+def _process_group_memory(process_group_id: int):
+    """
+    :return: resident memory of all processes of the process group in bytes
+    """
+    memory = 0
+    for process_entry in scandir("/proc"):
+        if not process_entry.name.isdigit():
+            continue
+        try:
+            with open(f"{process_entry.path}/stat") as stat_file:
+                # fields after the process name (which can contain spaces), pgrp is the 5th and rss the 24th field
+                stat_fields = stat_file.read().rsplit(")", 1)[1].split()
+        except OSError: # process finished meanwhile
+            continue
+        if int(stat_fields[2]) == process_group_id:
+            memory += int(stat_fields[21]) * sysconf("SC_PAGE_SIZE")
+    return memory
+
+
+def _kill_process_group(process: subprocess.Popen):
+    try:
+        killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError: # process group finished meanwhile
+        pass
+    process.wait()
+
+
+def run_supervised(command: str,
+                   time_limit: float = None,
+                   memory_limit: int = None):
+    """
+    Runs the shell command in its own process group. If the command runs longer than time_limit
+    or its processes occupy more memory than memory_limit, the whole process group is killed.
+    The process group is killed also if the supervisor is interrupted, so no xtb outlives the calculation.
+
+    :param time_limit: maximal wall-clock time of the command in seconds, None means no limit
+    :param memory_limit: maximal resident memory of all processes of the command in bytes, None means no limit
+    :return: exceeded limit ("time" or "memory") or None if the command finished
+    """
+    process = subprocess.Popen(command,
+                               shell=True,
+                               start_new_session=True)
+    start = monotonic()
+    try:
+        while True:
+            if time_limit is None and memory_limit is None:
+                process.wait()
+                return None
+            timeout = SUPERVISOR_POLL_INTERVAL
+            if time_limit is not None:
+                timeout = max(min(timeout, start + time_limit - monotonic()), 0)
+            try:
+                process.wait(timeout=timeout)
+                return None
+            except subprocess.TimeoutExpired:
+                pass
+            if time_limit is not None and monotonic() - start >= time_limit:
+                exceeded_limit = "time"
+            elif memory_limit is not None and _process_group_memory(process.pid) > memory_limit:
+                exceeded_limit = "memory"
+            else:
+                continue
+            _kill_process_group(process)
+            return exceeded_limit
+    except BaseException:
+        _kill_process_group(process)
+        raise
+
+
+class SubprocessXtbEngine:
+    """
+    Runs the xtb program in its own process for each calculation.
+    The input and output files of the calculation are stored in the directory of the job.
+
+    Engines are passed to the worker processes of JobPool within the jobs, so they must be picklable.
+    Each engine has the methods calculate_charges and optimise and the descriptions of both methods,
+    which are part of the keys of xtb cache, so the results of different engines are never mixed,
+    and the name of its charges (charges_label) written into the output mmCIF file.
+
+    xtb runs with the number of OpenMP threads given by the job (threads).
+
+    Each run of xtb is supervised (see function run_supervised), the calculation exceeding the time or memory limit
+    is killed and the engine raises XtbLimitExceeded.
+    """
+    charges_method = XTB_CHARGES_METHOD
+    optimisation_method = XTB_OPTIMISATION_METHOD
+
+    # name of the charges written into the metadata of output mmCIF file
+    charges_label = "GFN1-xTB/CM5 (with cutoff)"
+
+    # estimated memory of both methods per pair of substructure atoms in bytes, see JobPool.allocate
+    # (GFN1-xTB stores several dense matrices of atomic orbitals, GFN-FF only pairwise terms)
+    charges_memory_per_atom_pair = 1000
+    optimisation_memory_per_atom_pair = 200
+
+    # estimated bytes of files written by xtb per substructure atom (outputs, restart and topology files,
+    # the optimisation log contains the coordinates of every step of the optimisation)
+    charges_scratch_bytes_per_atom = 500
+    optimisation_scratch_bytes_per_atom = 8000
+
+    def __init__(self,
+                 time_limit: float = None,
+                 memory_limit: int = None):
+        """
+        :param time_limit: maximal wall-clock time of one xtb run in seconds, None means no limit
+        :param memory_limit: maximal resident memory of one xtb run in bytes, None means no limit
+        """
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+
+    @staticmethod
+    def _scc_flags(scc: dict):
+        """
+        :return: xtb flags of SCC settings (see phases/recovery_policy.py), empty string for the default settings
+        """
+        if not scc:
+            return ""
+        return f" --etemp {scc['electronic_temperature']} --iterations {scc['iterations']}"
+
+    def calculate_charges(self,
+                          job: dict):
+        """
+        Calculates CM5 charges of one substructure by GFN1-xTB.
+
+        :param job: dictionary with directory for the calculation (data_dir), substructure in PDB format (pdb),
+                    total charge of substructure (charge), number of substructure atoms (atoms_count),
+                    settings of SCC replacing the defaults of xtb or None (scc), number of OpenMP threads (threads)
+                    and flag whether the directory should be deleted after the calculation (delete_auxiliary_files)
+        :return: list of CM5 charges of substructure atoms or None if the xtb calculation did not converge
+        :raises XtbLimitExceeded: if xtb was killed by the supervisor
+        """
+        substructure_data_dir = job["data_dir"]
+        system(f"mkdir -p {substructure_data_dir}")
+        with open(f"{substructure_data_dir}/repaired_substructure.pdb", "w") as pdb_file:
+            pdb_file.write(job["pdb"])
+        exceeded_limit = run_supervised(f"cd {substructure_data_dir} ; "
+                                        f"ulimit -s unlimited ;"
+                                        f"export OMP_NUM_THREADS={job['threads']},1 ;"
+                                        f"export OMP_MAX_ACTIVE_LEVELS=1 ;"
+                                        f"export MKL_NUM_THREADS={job['threads']} ;"
+                                        f"xtb repaired_substructure.pdb {XTB_CHARGES_METHOD}{self._scc_flags(job['scc'])} --chrg {job['charge']}   > xtb_output.txt 2> xtb_error_output.txt ",
+                                        time_limit=self.time_limit,
+                                        memory_limit=self.memory_limit)
+        if exceeded_limit:
+            if job["delete_auxiliary_files"]:
+                system(f"rm -r {substructure_data_dir}")
+            raise XtbLimitExceeded(exceeded_limit)
+
+        # read calculated charges from xtb output file
+        xtb_output_file_lines = open(f"{substructure_data_dir}/xtb_output.txt").readlines()
+        try:
+            cm5_charges_headline = "  Mulliken/CM5 charges         n(s)   n(p)   n(d)\n"
+            charge_headline_index = xtb_output_file_lines.index(cm5_charges_headline)
+            cm5_charges = [float(line[19:28]) for line in xtb_output_file_lines[charge_headline_index + 1:
+                                                                                charge_headline_index + job["atoms_count"] + 1]]
+        except ValueError:  # charge calculation failed
+            cm5_charges = None
+        if job["delete_auxiliary_files"]:
+            system(f"rm -r {substructure_data_dir}")
+        return cm5_charges
+
+    def optimise(self,
+                 job: dict):
+        """
+        Optimises hydrogens of one substructure by GFN-FF, constrained atoms are restrained by xtb settings.
+
+        :param job: dictionary with directory for the optimisation (data_dir), substructure in PDB format (pdb),
+                    xtb settings with constrained atoms (settings), positions of constrained atoms in the substructure
+                    (constrained_atom_positions) and number of OpenMP threads (threads)
+        :return: list of optimised coordinates of substructure atoms or None if the optimisation failed
+        :raises XtbLimitExceeded: if xtb was killed by the supervisor
+        """
+        substructure_data_dir = job["data_dir"]
+        system(f"mkdir -p {substructure_data_dir}")
+        with open(f"{substructure_data_dir}/repaired_substructure.pdb", "w") as pdb_file:
+            pdb_file.write(job["pdb"])
+        with open(f"{substructure_data_dir}/xtb_settings.inp", "w") as xtb_settings_file:
+            xtb_settings_file.write(job["settings"])
+        run_xtb = (f"cd {substructure_data_dir} ;"
+                   f"ulimit -s unlimited ;"
+                   f"export OMP_NUM_THREADS={job['threads']},1 ;"
+                   f"export OMP_MAX_ACTIVE_LEVELS=1 ;"
+                   f"export MKL_NUM_THREADS={job['threads']} ;"
+                   f"xtb repaired_substructure.pdb {XTB_OPTIMISATION_METHOD} --input xtb_settings.inp --verbose > xtb_output.txt 2>&1")
+        # second try by L-ANCOPT
+        if not path.isfile(f"{substructure_data_dir}/xtbopt.pdb"):
+            substructure_settings = open(f"{substructure_data_dir}/xtb_settings.inp", "r").read().replace("rf","lbfgs")
+            with open(f"{substructure_data_dir}/xtb_settings.inp", "w") as xtb_settings_file:
+                xtb_settings_file.write(substructure_settings)
+            exceeded_limit = run_supervised(run_xtb,
+                                            time_limit=self.time_limit,
+                                            memory_limit=self.memory_limit)
+            if exceeded_limit:
+                raise XtbLimitExceeded(exceeded_limit)
+        if not path.isfile(f"{substructure_data_dir}/xtbopt.pdb"):
+            return None
+
+        # xtb keeps the order of atoms, so the optimised atoms are matched by their positions in the file
+        with open(f"{substructure_data_dir}/xtbopt.pdb") as optimised_substructure_file:
+            return [(float(line[30:38]), float(line[38:46]), float(line[46:54]))
+                    for line in optimised_substructure_file if line[:4] in ["ATOM", "HETA"]]
+
+
+class XtbPythonEngine:
+    """
+    Runs xtb in the calling process by its Python bindings (https://github.com/grimme-lab/xtb-python),
+    so no process is started and no output file is parsed. No files are written to the directory of the job.
+
+    The bindings do not provide CM5 charges, the charges are Mulliken charges of GFN1-xTB,
+    and they have no optimiser, hydrogens are optimised by L-BFGS-B from SciPy with constrained atoms fixed
+    (xtb program restrains them by harmonic potential). The results therefore differ from SubprocessXtbEngine.
+    The number of threads of the job is ignored, OpenMP of the bindings is initialised once per process.
+    """
+    charges_method = "xtb-python GFN1-xTB GBSA water accuracy 1000 Mulliken charges"
+    optimisation_method = "xtb-python GFN-FF GBSA water L-BFGS-B fixed constrained atoms"
+    charges_label = "GFN1-xTB/Mulliken (with cutoff)"
+    charges_memory_per_atom_pair = 1000
+    optimisation_memory_per_atom_pair = 200
+    charges_scratch_bytes_per_atom = 0
+    optimisation_scratch_bytes_per_atom = 0
+
+    def __init__(self,
+                 time_limit: float = None,
+                 memory_limit: int = None):
+        # the bindings are optional dependency, they are checked when the engine is created
+        import xtb.interface
+        # the calculation runs in the calling process, which cannot be killed by a supervisor
+        if time_limit is not None or memory_limit is not None:
+            raise ValueError("Engine xtb-python does not support time and memory limits.")
+
+    @staticmethod
+    def _calculator(method: str,
+                    elements: list,
+                    coords: np.ndarray,
+                    charge: int):
+        from xtb.interface import Calculator
+        from xtb.libxtb import VERBOSITY_MUTED
+        from xtb.utils import get_method, get_solvent
+        periodic_table = Chem.GetPeriodicTable()
+        calculator = Calculator(get_method(method),
+                                np.array([periodic_table.GetAtomicNumber(element) for element in elements]),
+                                coords * ANGSTROM_IN_BOHR,
+                                charge=charge)
+        calculator.set_solvent(get_solvent("water"))
+        calculator.set_verbosity(VERBOSITY_MUTED)
+        return calculator
+
+    def calculate_charges(self,
+                          job: dict):
+        """
+        Calculates Mulliken charges of one substructure by GFN1-xTB.
+
+        :param job: see SubprocessXtbEngine.calculate_charges
+        :return: list of charges of substructure atoms or None if the calculation did not converge
+        """
+        from xtb.interface import XTBException
+        elements, coords = _read_pdb_block(job["pdb"])
+        calculator = self._calculator("GFN1-xTB", elements, coords, job["charge"])
+        calculator.set_accuracy(1000)
+        if job["scc"]:
+            calculator.set_electronic_temperature(job["scc"]["electronic_temperature"])
+            calculator.set_max_iterations(job["scc"]["iterations"])
+        try:
+            return calculator.singlepoint().get_charges().tolist()
+        except XTBException: # charge calculation failed
+            return None
+
+    def optimise(self,
+                 job: dict):
+        """
+        Optimises all atoms of one substructure except the constrained ones by GFN-FF.
+
+        :param job: see SubprocessXtbEngine.optimise
+        :return: list of optimised coordinates of substructure atoms or None if the optimisation failed
+        """
+        from xtb.interface import XTBException
+        elements, coords = _read_pdb_block(job["pdb"])
+        calculator = self._calculator("GFN-FF", elements, coords, 0)
+        positions = coords * ANGSTROM_IN_BOHR
+        free_atoms_mask = np.ones(len(elements), dtype=bool)
+        free_atoms_mask[job["constrained_atom_positions"]] = False
+
+        def energy_and_gradient(free_positions):
+            positions[free_atoms_mask] = free_positions.reshape(-1, 3)
+            calculator.update(positions)
+            results = calculator.singlepoint()
+            return results.get_energy(), results.get_gradient()[free_atoms_mask].flatten()
+
+        try:
+            optimisation = minimize(energy_and_gradient,
+                                    positions[free_atoms_mask].flatten(),
+                                    jac=True,
+                                    method="L-BFGS-B")
+        except XTBException:
+            return None
+        if not optimisation.success: # e.g. the limit of iterations was reached or the line search failed, as xtb without convergence
+            return None
+        positions[free_atoms_mask] = optimisation.x.reshape(-1, 3)
+        return (positions / ANGSTROM_IN_BOHR).tolist()
+
+
+# engines selectable by the argument --xtb_engine
+XTB_ENGINES = {"xtb": SubprocessXtbEngine,
+               "xtb-python": XtbPythonEngine}